@@ -0,0 +1,646 @@
+"""
+Offline benchmark for the workflow runner.
+
+Starts local stand-ins for every upstream provider (Trustana search, SerpAPI,
+Gemini generateContent, Perplexity, OpenAI chat/responses and Slack) with
+configurable latency distributions, error rates and payload sizes, launches
+the real runner against them in a subprocess, and drives it through
+POST /runs + GET /runs/<run_id> at a target concurrency. No paid API is touched.
+
+Reports throughput, p50/p95/p99 end-to-end and per-step latency (per-step
+timings come from GET /runs/<run_id>/trace), peak RSS and thread count of the
+runner process, and writes everything to a JSON file for comparison across commits.
+
+Usage:
+  python benchmark.py --flow aeo --runs 200 --concurrency 16
+  python benchmark.py --flow localization --latency openai=lognormal:800:0.4 --error-rate openai=0.05
+  python benchmark.py --flow aeo --latency-scale 0.1 --output after.json --compare before.json
+
+Latency distributions (milliseconds): fixed:MS, uniform:LO:HI, normal:MEAN:STD, lognormal:MEDIAN:SIGMA.
+Per-provider options take PROVIDER=VALUE, with provider "default" applying to all.
+"""
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+from pathlib import Path
+from threading import Thread, Lock, Event
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import httpx
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+RUNNER_DIR = Path(__file__).resolve().parent
+
+PROVIDERS = ("trustana", "serpapi", "gemini", "perplexity", "openai", "slack")
+
+# Default upstream latency per provider endpoint, roughly what production sees
+DEFAULT_LATENCY = {
+    "trustana": "lognormal:120:0.3",
+    "serpapi": "lognormal:900:0.4",
+    "gemini": "lognormal:2500:0.5",
+    "perplexity": "lognormal:3000:0.5",
+    "openai": "lognormal:2000:0.5",
+    "openai_responses": "lognormal:6000:0.4",
+    "slack": "lognormal:150:0.3",
+}
+
+RETAILER_DOMAINS = ["amazon.com", "noon.com", "carrefouruae.com", "walmart.com", "bestbuy.com", "ebay.com"]
+
+FLOWS = {
+    "aeo": "aeo-visibility-score",
+    "aeo-batch": "aeo-visibility-score",
+    "localization": "localization",
+    "serpapi": "trustana-serpapi-csv",
+}
+
+TERMINAL_STATUSES = ("completed", "failed")
+
+
+class LatencyDistribution:
+    """Samples upstream latencies (seconds) from a distribution spec such as lognormal:800:0.4."""
+
+    def __init__(self, spec: str, scale: float = 1.0):
+        kind, *params = spec.split(":")
+        expected = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2}
+        if kind not in expected or len(params) != expected[kind]:
+            raise ValueError(f"Invalid latency distribution {spec!r}")
+        self.spec = spec
+        self.kind = kind
+        # Parameters are milliseconds, except the lognormal sigma
+        self.params = [float(param) if kind == "lognormal" and i == 1 else float(param) / 1000 for i, param in enumerate(params)]
+        self.scale = scale
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            value = self.params[0]
+        elif self.kind == "uniform":
+            value = rng.uniform(*self.params)
+        elif self.kind == "normal":
+            value = rng.gauss(*self.params)
+        else:
+            median, sigma = self.params
+            value = median * math.exp(rng.gauss(0, sigma))
+        return max(value, 0.0) * self.scale
+
+
+def per_provider(values: list[str], cast, defaults: dict) -> dict:
+    """Parse repeated PROVIDER=VALUE options over per-provider defaults ("default" sets every provider)."""
+    parsed = dict(defaults)
+    for value in values or []:
+        provider, _, setting = value.partition("=")
+        if not setting:
+            raise SystemExit(f"Expected PROVIDER=VALUE, got {value!r}")
+        targets = list(parsed) if provider == "default" else [provider]
+        for target in targets:
+            parsed[target] = cast(setting)
+    return parsed
+
+
+class MockProvider:
+    """Behaviour of one upstream stand-in: latency, failure injection and payload shape."""
+
+    def __init__(self, name: str, latency: dict[str, LatencyDistribution], error_rate: float, throttle_rate: float,
+                 urls: int, text_bytes: int, products: int, seed: int):
+        self.name = name
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.urls = urls
+        self.text_bytes = text_bytes
+        self.products = products
+        self._rng = random.Random(f"{seed}-{name}")
+        self._lock = Lock()
+        self.stats = {"requests": 0, "errors": 0, "throttled": 0, "bytes_sent": 0}
+
+    def draw(self, endpoint: str) -> tuple[float, float]:
+        with self._lock:
+            latency = self.latency.get(endpoint, self.latency[self.name]).sample(self._rng)
+            return latency, self._rng.random()
+
+    def record(self, key: str, amount: int = 1) -> None:
+        with self._lock:
+            self.stats[key] += amount
+
+    def filler(self, size: int) -> str:
+        words = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor".split()
+        text = " ".join(words[i % len(words)] for i in range(size // 6 + 1))
+        return text[:size]
+
+    def product(self, sku: str) -> dict:
+        return {
+            "_id": f"id-{sku}",
+            "skuId": sku,
+            "longDescription": self.filler(self.text_bytes),
+            "attributes": [
+                {"key": "name", "value": f"Benchmark Product {sku}"},
+                {"key": "brand", "value": "BenchBrand"},
+                {"category": "Basic Info", "key": "Description", "value": f"<p>{self.filler(self.text_bytes)}</p>"},
+                {"category": "Basic Info", "key": "Short Description", "value": self.filler(self.text_bytes // 4)},
+            ],
+        }
+
+    def citations(self) -> list[str]:
+        with self._lock:
+            return [
+                f"https://www.{self._rng.choice(RETAILER_DOMAINS)}/p/{self._rng.randrange(10 ** 6)}"
+                for _ in range(self.urls)
+            ]
+
+    def respond(self, method: str, path: str, query: dict, body: dict) -> tuple[str, dict]:
+        """(endpoint name, JSON payload) for a request."""
+        if self.name == "trustana":
+            pagination = body.get("pagination", {})
+            wanted = (body.get("filter") or {}).get("skuId", {}).get("in")
+            if wanted:
+                skus = [sku for sku in wanted if sku.startswith("BENCH-")]
+            else:
+                offset = pagination.get("offset", 0)
+                skus = [f"BENCH-{i}" for i in range(offset, min(offset + pagination.get("limit", 1), self.products))]
+            return "trustana", {"errorCode": 0, "data": {"result": [self.product(sku) for sku in skus], "total": self.products}}
+
+        if self.name == "serpapi":
+            return "serpapi", {"organic_results": [
+                {"position": i + 1, "title": f"Result {i + 1}", "link": url, "snippet": self.filler(200), "displayed_link": url}
+                for i, url in enumerate(self.citations())
+            ]}
+
+        if self.name == "gemini":
+            urls = self.citations()
+            return "gemini", {
+                "candidates": [{
+                    "content": {"parts": [{"text": self.filler(self.text_bytes)}]},
+                    "groundingMetadata": {"groundingChunks": [
+                        {"web": {"uri": f"https://vertexaisearch.cloud.google.com/grounding-api-redirect/{i}", "title": urlsplit(url).hostname[4:]}}
+                        for i, url in enumerate(urls)
+                    ]},
+                }],
+                "usageMetadata": {"promptTokenCount": 40, "candidatesTokenCount": self.text_bytes // 4},
+            }
+
+        if self.name == "perplexity":
+            return "perplexity", {
+                "choices": [{"message": {"content": self.filler(self.text_bytes)}}],
+                "citations": self.citations(),
+                "usage": {"prompt_tokens": 60, "completion_tokens": self.text_bytes // 4},
+            }
+
+        if self.name == "openai" and path.endswith("/responses"):
+            prompt = json.dumps(body.get("input", ""))
+            fields = re.findall(r"=== (.+?) ===", prompt)
+            text = "\n".join(f"=== {field} ===\n{self.filler(self.text_bytes)}" for field in dict.fromkeys(fields))
+            return "openai_responses", {
+                "output": [{"type": "message", "role": "assistant", "content": [{"type": "output_text", "text": text}]}],
+                "usage": {"input_tokens": len(prompt) // 4, "output_tokens": len(text) // 4, "total_tokens": (len(prompt) + len(text)) // 4},
+            }
+
+        if self.name == "openai":
+            return "openai", {
+                "choices": [{"message": {"content": "\n".join(f"- {url}" for url in self.citations())}}],
+                "usage": {"prompt_tokens": 50, "completion_tokens": 20 * self.urls},
+            }
+
+        return "slack", {"ok": True, "ts": f"{time.time():.6f}", "channel": body.get("channel", "C000")}
+
+
+def make_handler(provider: MockProvider):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _handle(self):
+            length = int(self.headers.get("content-length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            try:
+                body = json.loads(raw) if raw else {}
+            except ValueError:
+                body = {}
+            parts = urlsplit(self.path)
+            endpoint, payload = provider.respond(self.command, parts.path, parse_qs(parts.query), body)
+            latency, roll = provider.draw(endpoint)
+            time.sleep(latency)
+            provider.record("requests")
+
+            headers = {}
+            if roll < provider.throttle_rate:
+                provider.record("throttled")
+                status, payload, headers = 429, {"error": {"message": "Rate limited (benchmark)"}}, {"Retry-After": "1"}
+            elif roll < provider.throttle_rate + provider.error_rate:
+                provider.record("errors")
+                status, payload = 503, {"error": {"message": "Unavailable (benchmark)"}}
+            else:
+                status = 200
+
+            data = json.dumps(payload).encode()
+            provider.record("bytes_sent", len(data))
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = _handle
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_mock(provider: MockProvider) -> tuple[ThreadingHTTPServer, str]:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(provider))
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name=f"mock-{provider.name}", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def write_workflows(workflow_dir: Path) -> None:
+    """Workflow files for the built-in flows (localization keeps its real input_schema)."""
+    workflow_dir.mkdir(parents=True, exist_ok=True)
+    for flow_id in ("aeo-visibility-score", "trustana-serpapi-csv"):
+        (workflow_dir / f"{flow_id}.json").write_text(json.dumps({"flow_id": flow_id, "name": flow_id}))
+    shutil.copy(RUNNER_DIR / "localization.json", workflow_dir / "localization.json")
+
+
+def start_runner(args, base_urls: dict[str, str], workdir: Path) -> tuple[subprocess.Popen, str]:
+    port = free_port()
+    env = {
+        **os.environ,
+        **{f"{provider.upper()}_BASE_URL": url for provider, url in base_urls.items()},
+        **{name: "benchmark" for name in (
+            "TRUSTANA_API_KEY", "SERPAPI_API_KEY", "GEMINI_API_KEY", "PERPLEXITY_API_KEY", "OPENAI_API_KEY", "SLACK_BOT_TOKEN",
+        )},
+        "WORKFLOW_DIR": str(workdir / "workflows"),
+        "OUTPUT_DIR": str(workdir / "output"),
+        "DATA_DIR": str(workdir / "data"),
+        "CACHE_ENABLED": "true" if args.cache else "false",
+        "RUNNER_WORKERS": str(args.workers),
+        "RUNNER_QUEUE_SIZE": str(args.queue_size),
+    }
+    if args.unlimited_providers:
+        env["PROVIDER_LIMITS"] = json.dumps({provider: {"rps": 0, "max_concurrency": 1024} for provider in PROVIDERS})
+    for assignment in args.runner_env or []:
+        name, _, value = assignment.partition("=")
+        env[name] = value
+
+    code = (
+        f"import sys; sys.path.insert(0, {str(RUNNER_DIR)!r}); import workflow_runner as w; "
+        f"w.app.run(host='127.0.0.1', port={port}, threaded=True)"
+    )
+    log = open(workdir / "runner.log", "w")
+    process = subprocess.Popen([sys.executable, "-c", code], env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Runner exited during startup, see {workdir / 'runner.log'}")
+        try:
+            if httpx.get(f"{base_url}/health", timeout=1).status_code == 200:
+                return process, base_url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    process.kill()
+    raise SystemExit(f"Runner did not become healthy, see {workdir / 'runner.log'}")
+
+
+class ProcessSampler:
+    """Samples RSS and thread count of a process until stopped, keeping the peaks."""
+
+    def __init__(self, pid: int, interval: float = 0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss_bytes = 0
+        self.peak_threads = 0
+        self.samples = 0
+        self._stop = Event()
+        self._thread = Thread(target=self._run, name="sampler", daemon=True)
+
+    def _read(self) -> tuple[int, int] | None:
+        status_path = Path(f"/proc/{self.pid}/status")
+        if status_path.exists():
+            fields = dict(line.split(":", 1) for line in status_path.read_text().splitlines() if ":" in line)
+            rss = max(int(fields.get("VmRSS", "0 kB").split()[0]), int(fields.get("VmHWM", "0 kB").split()[0])) * 1024
+            return rss, int(fields.get("Threads", "0"))
+        if psutil is not None:
+            process = psutil.Process(self.pid)
+            return process.memory_info().rss, process.num_threads()
+        return None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                sample = self._read()
+            except (OSError, ValueError):
+                sample = None
+            if sample:
+                self.samples += 1
+                self.peak_rss_bytes = max(self.peak_rss_bytes, sample[0])
+                self.peak_threads = max(self.peak_threads, sample[1])
+            self._stop.wait(self.interval)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def run_input(args, index: int) -> dict:
+    if args.input_json:
+        return json.loads(args.input_json)
+    sku = f"BENCH-{index % args.products}"
+    if args.flow == "aeo":
+        return {"product_id": sku, "retailer_domain": "amazon.com", "retailer_domains": args.retailers}
+    if args.flow == "aeo-batch":
+        start = index * args.batch_size
+        return {
+            "product_ids": [f"BENCH-{(start + i) % args.products}" for i in range(args.batch_size)],
+            "retailer_domain": "amazon.com",
+            "retailer_domains": args.retailers,
+        }
+    if args.flow == "localization":
+        return {
+            "fields_to_translate": ["Basic Info//Description", "Basic Info//Short Description", "name"],
+            "target_language": args.languages if len(args.languages) > 1 else args.languages[0],
+            "glossary": "V → فولت\nW → واط",
+            "cache": "off",
+        }
+    return {}
+
+
+def step_durations(trace: dict) -> dict[str, float]:
+    root = trace.get("root") or {}
+    durations: dict[str, float] = {}
+    for child in root.get("children", []):
+        if child["kind"] == "step":
+            durations[child["name"]] = durations.get(child["name"], 0.0) + child["duration_ms"]
+    return durations
+
+
+def drive(args, base_url: str, total: int, record: bool) -> list[dict]:
+    """Run `total` workflow runs with args.concurrency clients; returns one record per run."""
+    results: list[dict] = []
+    lock = Lock()
+    issued = iter(range(total))
+
+    def client_loop() -> None:
+        with httpx.Client(base_url=base_url, timeout=30) as client:
+            while True:
+                with lock:
+                    index = next(issued, None)
+                if index is None:
+                    return
+                payload = {"flow_id": FLOWS[args.flow], "tenant_id": "benchmark", "input": run_input(args, index)}
+                started = time.monotonic()
+                rejected = 0
+                while True:
+                    response = client.post("/runs", json=payload)
+                    if response.status_code != 429:
+                        break
+                    rejected += 1
+                    time.sleep(float(response.headers.get("Retry-After", "1")))
+                if response.status_code != 201:
+                    outcome = {"status": "rejected", "http_status": response.status_code, "error": response.text[:200]}
+                else:
+                    run_id = response.json()["run_id"]
+                    while True:
+                        run = client.get(f"/runs/{run_id}").json()
+                        if run["status"] in TERMINAL_STATUSES:
+                            break
+                        time.sleep(args.poll_interval)
+                    outcome = {"run_id": run_id, "status": run["status"], "error": run.get("error")}
+                    if record and args.steps:
+                        trace = client.get(f"/runs/{run_id}/trace")
+                        if trace.status_code == 200:
+                            outcome["steps_ms"] = step_durations(trace.json())
+                outcome["e2e_ms"] = round((time.monotonic() - started) * 1000, 2)
+                outcome["queue_rejections"] = rejected
+                with lock:
+                    results.append(outcome)
+
+    threads = [Thread(target=client_loop, name=f"client-{i}") for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    """Linearly interpolated percentile (q in 0..100)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * q / 100
+    low = math.floor(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return round(ordered[low] + (ordered[high] - ordered[low]) * (rank - low), 2)
+
+
+def latency_summary(values: list[float]) -> dict:
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 2) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": round(max(values), 2) if values else None,
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=RUNNER_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(args, results: list[dict], elapsed: float, sampler: ProcessSampler, mocks: dict[str, MockProvider]) -> dict:
+    completed = [result for result in results if result["status"] == "completed"]
+    steps: dict[str, list[float]] = {}
+    for result in completed:
+        for step, duration in result.get("steps_ms", {}).items():
+            steps.setdefault(step, []).append(duration)
+    errors: dict[str, int] = {}
+    for result in results:
+        if result["status"] != "completed":
+            key = (result.get("error") or result["status"])[:120]
+            errors[key] = errors.get(key, 0) + 1
+
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        },
+        "runs": {
+            "total": len(results),
+            "completed": len(completed),
+            "failed": sum(result["status"] == "failed" for result in results),
+            "rejected": sum(result["status"] == "rejected" for result in results),
+            "queue_rejections": sum(result["queue_rejections"] for result in results),
+            "errors": errors,
+        },
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_runs_per_second": round(len(completed) / elapsed, 3) if elapsed else None,
+        "e2e_ms": latency_summary([result["e2e_ms"] for result in completed]),
+        "steps_ms": {step: latency_summary(values) for step, values in sorted(steps.items())},
+        "runner": {
+            "peak_rss_mb": round(sampler.peak_rss_bytes / 2 ** 20, 1) if sampler.samples else None,
+            "peak_threads": sampler.peak_threads if sampler.samples else None,
+        },
+        "upstream": {name: dict(mock.stats) for name, mock in mocks.items()},
+    }
+
+
+def print_report(report: dict, baseline: dict | None) -> None:
+    def delta(path: list[str]) -> str:
+        if baseline is None:
+            return ""
+        old, new = baseline, report
+        for key in path:
+            old = (old or {}).get(key)
+            new = (new or {}).get(key)
+        if not isinstance(old, (int, float)) or not isinstance(new, (int, float)) or not old:
+            return ""
+        return f"  ({(new - old) / old * 100:+.1f}% vs baseline)"
+
+    runs = report["runs"]
+    print(f"\nRuns: {runs['completed']} completed, {runs['failed']} failed, {runs['rejected']} rejected "
+          f"({runs['queue_rejections']} queue-full retries) in {report['elapsed_seconds']}s")
+    print(f"Throughput: {report['throughput_runs_per_second']} runs/s{delta(['throughput_runs_per_second'])}")
+    e2e = report["e2e_ms"]
+    for q in ("p50", "p95", "p99"):
+        print(f"End-to-end {q}: {e2e[q]} ms{delta(['e2e_ms', q])}")
+    if report["steps_ms"]:
+        print("\nStep latency (ms)        p50        p95        p99")
+        for step, summary in report["steps_ms"].items():
+            print(f"  {step:<20} {summary['p50']:>10} {summary['p95']:>10} {summary['p99']:>10}")
+    runner = report["runner"]
+    print(f"\nRunner peak RSS: {runner['peak_rss_mb']} MB{delta(['runner', 'peak_rss_mb'])}, "
+          f"peak threads: {runner['peak_threads']}{delta(['runner', 'peak_threads'])}")
+    print("Upstream requests: " + ", ".join(
+        f"{name} {stats['requests']} ({stats['errors']} errors, {stats['throttled']} throttled)"
+        for name, stats in report["upstream"].items() if stats["requests"]
+    ))
+    for error, count in report["runs"]["errors"].items():
+        print(f"  {count} x {error}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--flow", choices=sorted(FLOWS), default="aeo")
+    parser.add_argument("--runs", type=int, default=100, help="Measured runs")
+    parser.add_argument("--warmup", type=int, default=5, help="Runs before measuring (excluded from results)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent API clients")
+    parser.add_argument("--poll-interval", type=float, default=0.05, help="Seconds between GET /runs/<id> polls")
+    parser.add_argument("--workers", type=int, default=8, help="Runner RUNNER_WORKERS")
+    parser.add_argument("--queue-size", type=int, default=100, help="Runner RUNNER_QUEUE_SIZE")
+    parser.add_argument("--latency", action="append", metavar="PROVIDER=DIST",
+                        help="Latency distribution per provider (openai_responses for the Responses API)")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Multiply every sampled latency")
+    parser.add_argument("--error-rate", action="append", metavar="PROVIDER=RATE", help="Fraction of 503 responses")
+    parser.add_argument("--throttle-rate", action="append", metavar="PROVIDER=RATE", help="Fraction of 429 responses")
+    parser.add_argument("--urls", type=int, default=10, help="Cited URLs per search/engine response")
+    parser.add_argument("--text-bytes", type=int, default=2000, help="Size of response texts and product descriptions")
+    parser.add_argument("--products", type=int, default=1000, help="Catalog size served by the Trustana stand-in")
+    parser.add_argument("--batch-size", type=int, default=20, help="Products per run for --flow aeo-batch")
+    parser.add_argument("--retailers", nargs="*", default=[], help="Extra retailer_domains for AEO flows")
+    parser.add_argument("--languages", nargs="+", default=["Modern Standard Arabic"], help="Localization target languages")
+    parser.add_argument("--input-json", help="Literal run input, overriding the flow's generated input")
+    parser.add_argument("--cache", action="store_true", help="Leave the runner's response cache enabled")
+    parser.add_argument("--unlimited-providers", action="store_true", help="Disable the runner's per-provider rate limits")
+    parser.add_argument("--no-steps", dest="steps", action="store_false", help="Skip per-step timings (no trace fetches)")
+    parser.add_argument("--runner-env", action="append", metavar="NAME=VALUE", help="Extra environment for the runner")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Results JSON path (default: benchmark-<flow>-<timestamp>.json)")
+    parser.add_argument("--compare", help="Earlier results JSON to compare against")
+    parser.add_argument("--keep-workdir", action="store_true", help="Keep the runner's temporary data and logs")
+    args = parser.parse_args()
+
+    latency_specs = per_provider(args.latency, str, DEFAULT_LATENCY)
+    latencies = {name: LatencyDistribution(spec, args.latency_scale) for name, spec in latency_specs.items()}
+    error_rates = per_provider(args.error_rate, float, dict.fromkeys(PROVIDERS, 0.0))
+    throttle_rates = per_provider(args.throttle_rate, float, dict.fromkeys(PROVIDERS, 0.0))
+
+    mocks = {
+        name: MockProvider(name, latencies, error_rates[name], throttle_rates[name], args.urls, args.text_bytes,
+                           args.products, args.seed)
+        for name in PROVIDERS
+    }
+    servers, base_urls = [], {}
+    for name, mock in mocks.items():
+        server, base_urls[name] = start_mock(mock)
+        servers.append(server)
+
+    workdir = Path(tempfile.mkdtemp(prefix="runner-bench-"))
+    write_workflows(workdir / "workflows")
+    process, runner_url = start_runner(args, base_urls, workdir)
+    print(f"Runner pid {process.pid} at {runner_url}; stand-ins: " + ", ".join(f"{k} {v}" for k, v in base_urls.items()))
+
+    sampler = ProcessSampler(process.pid)
+    try:
+        if args.warmup:
+            drive(args, runner_url, args.warmup, record=False)
+            for mock in mocks.values():
+                mock.stats = dict.fromkeys(mock.stats, 0)
+        sampler.start()
+        started = time.monotonic()
+        results = drive(args, runner_url, args.runs, record=True)
+        elapsed = time.monotonic() - started
+    finally:
+        sampler.stop()
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        for server in servers:
+            server.shutdown()
+
+    report = summarize(args, results, elapsed, sampler, mocks)
+    baseline = json.loads(Path(args.compare).read_text()) if args.compare else None
+    print_report(report, baseline)
+
+    output = Path(args.output or f"benchmark-{args.flow}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    output.write_text(json.dumps(report, indent=2))
+    print(f"\nResults written to {output}")
+    if args.keep_workdir:
+        print(f"Runner workdir kept at {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
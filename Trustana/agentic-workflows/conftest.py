@@ -0,0 +1,77 @@
+"""Shared fixtures for the workflow runner tests.
+
+State directories point into a temporary directory before workflow_runner is
+imported, so tests never touch /app. Each test gets its own run store, and the
+fixtures below swap in a fresh scheduler, batch feeder and coalescer.
+"""
+
+import json
+import os
+import tempfile
+import time
+
+_STATE_DIR = tempfile.mkdtemp(prefix="workflow-runner-test-")
+os.environ.setdefault("OUTPUT_DIR", os.path.join(_STATE_DIR, "output"))
+os.environ.setdefault("DATA_DIR", os.path.join(_STATE_DIR, "data"))
+os.environ.setdefault("WORKFLOW_DIR", os.path.join(_STATE_DIR, "workflows"))
+os.environ.setdefault("CACHE_ENABLED", "false")
+os.environ.setdefault("RESULT_SINK_FORMAT", "none")
+# Tests expire waiting runs themselves
+os.environ.setdefault("CALLBACK_SWEEP_SECONDS", "3600")
+
+import pytest
+
+import workflow_runner as wr
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """A fresh SQLite run store in place of RUN_STORE."""
+    store = wr.SQLiteRunStore(tmp_path / "runs.db", recover_interrupted=False)
+    monkeypatch.setattr(wr, "RUN_STORE", store)
+    return store
+
+
+@pytest.fixture
+def client(store, monkeypatch):
+    """API test client executing runs in this process (local mode) on a fresh scheduler."""
+    monkeypatch.setattr(wr, "RUNNER_MODE", "local")
+    monkeypatch.setattr(wr, "SCHEDULER", wr.RunScheduler(2, 8))
+    monkeypatch.setattr(wr, "BATCH_FEEDER", wr.BatchFeeder())
+    monkeypatch.setattr(wr, "RUN_COALESCER", wr.RunCoalescer())
+    # Batches left over by other tests' stores are not this test's to resume
+    monkeypatch.setattr(wr, "_batches_resumed", True)
+    return wr.app.test_client()
+
+
+@pytest.fixture
+def flows(tmp_path, monkeypatch):
+    """Install workflow specs keyed by flow_id in a fresh registry: flows({"flow": spec})."""
+    directory = tmp_path / "workflows"
+    directory.mkdir()
+
+    def install(specs: dict) -> wr.WorkflowRegistry:
+        for flow_id, spec in specs.items():
+            (directory / f"{flow_id}.json").write_text(json.dumps({"flow_id": flow_id, **spec}))
+        registry = wr.WorkflowRegistry(directory)
+        registry.refresh()
+        monkeypatch.setattr(wr, "WORKFLOWS", registry)
+        return registry
+
+    return install
+
+
+@pytest.fixture
+def wait_until():
+    """Poll a predicate until it returns something truthy (which is returned), failing after a timeout."""
+
+    def wait(predicate, timeout: float = 5.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            value = predicate()
+            if value:
+                return value
+            time.sleep(0.01)
+        pytest.fail("Timed out waiting for condition")
+
+    return wait
@@ -0,0 +1,151 @@
+"""Tests for batch submission (POST /runs:batch), pacing, progress and restart recovery.
+
+Run with: python -m pytest test_batches.py
+"""
+
+import json
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+import workflow_runner as wr
+
+SPEC = {
+    "input": {"market": "SG"},
+    "input_schema": {
+        "type": "object",
+        "properties": {"sku": {"type": "string"}, "market": {"type": "string"}},
+        "required": ["sku"],
+    },
+    "sw_spec": {
+        "do": [
+            {"fetch": {"call": "data_gateway", "with": {"sku": "${ .input.sku }", "market": "${ .input.market }"}}},
+            {"finish": {"set": {"workflow_result": "${ .context.fetch }"}}},
+        ]
+    },
+}
+
+
+@pytest.fixture
+def gateway(flows, monkeypatch):
+    """The batch flow; its data_gateway step echoes its args, blocking while gateway.hold is set."""
+    flows({"catalog": SPEC})
+    gateway = type("Gateway", (), {})()
+    gateway.hold = threading.Event()
+    gateway.release = threading.Event()
+    gateway.calls = []
+
+    def fetch(args):
+        gateway.calls.append(args["sku"])
+        if gateway.hold.is_set():
+            assert gateway.release.wait(5)
+        return args
+
+    monkeypatch.setitem(wr.SPEC_CALL_HANDLERS, "data_gateway", fetch)
+    return gateway
+
+
+def batch_done(client, batch_id):
+    status = client.get(f"/batches/{batch_id}").json
+    return status if status["status"] == "completed" else None
+
+
+def test_json_batch_runs_each_item_and_records_invalid_ones_as_failed(client, gateway, wait_until):
+    response = client.post("/runs:batch", json={
+        "flow_id": "catalog",
+        "input": {"market": "MY"},
+        "items": [{"sku": "S0"}, {"market": "TH"}, "S2", {"sku": "S3", "market": "TH"}],
+    })
+    assert response.status_code == 201
+    assert (response.json["total"], response.json["accepted"], response.json["rejected"]) == (4, 2, 2)
+    batch_id = response.json["batch_id"]
+
+    status = wait_until(lambda: batch_done(client, batch_id))
+
+    assert status["counts"] == {"completed": 2, "failed": 2}
+    assert "workflow" not in status
+    assert [(item["index"], item["error"]) for item in sorted(status["failures"]["items"], key=lambda item: item["index"])] == [
+        (1, "Invalid input: input.sku is required"),
+        (2, "Invalid input: item must be an object"),
+    ]
+    # Spec defaults, then the shared input, then the item
+    assert wr.RUN_STORE.get_result(f"{batch_id}-0") == {"sku": "S0", "market": "MY"}
+    assert wr.RUN_STORE.get_result(f"{batch_id}-3") == {"sku": "S3", "market": "TH"}
+
+
+def test_ndjson_batch(client, gateway, wait_until):
+    body = "\n".join(json.dumps({"sku": f"S{i}"}) for i in range(3)) + "\n\n"
+    response = client.post("/runs:batch?flow_id=catalog", data=body, content_type="application/x-ndjson")
+    assert response.status_code == 201
+    assert response.json["accepted"] == 3
+
+    status = wait_until(lambda: batch_done(client, response.json["batch_id"]))
+    assert status["counts"] == {"completed": 3}
+    assert sorted(gateway.calls) == ["S0", "S1", "S2"]
+
+    broken = client.post("/runs:batch?flow_id=catalog", data='{"sku": "S0"}\n{oops\n', content_type="application/x-ndjson")
+    assert broken.status_code == 400
+    assert "line 2" in broken.json["error"]
+
+
+def test_batch_items_leave_queue_room_for_single_runs(client, gateway, wait_until, monkeypatch):
+    # 2 workers, room for 8 queued runs, half of which batch items may take
+    monkeypatch.setattr(wr, "BATCH_QUEUE_SHARE", 0.5)
+    gateway.hold.set()
+    batch_id = client.post("/runs:batch", json={"flow_id": "catalog", "items": [{"sku": f"S{i}"} for i in range(20)]}).json["batch_id"]
+
+    wait_until(lambda: wr.SCHEDULER.stats()["queued"] == 4)
+    assert wr.SCHEDULER.stats()["active"] == 2
+    assert client.get(f"/batches/{batch_id}").json["pending_submission"] == 14
+    for i in range(4):
+        assert client.post("/runs", json={"flow_id": "catalog", "input": {"sku": f"single-{i}"}}).status_code == 201
+
+    gateway.release.set()
+    assert wait_until(lambda: batch_done(client, batch_id))["counts"] == {"completed": 20}
+
+
+def test_batch_status_counts_and_eta(store):
+    created_at = datetime.utcnow() - timedelta(minutes=2)
+    store.put_batch({"batch_id": "b1", "flow_id": "catalog", "created_at": created_at.isoformat(), "total": 5})
+    completed_at = (created_at + timedelta(minutes=1)).isoformat()
+    store.put_many([
+        {"run_id": "b1-0", "flow_id": "catalog", "batch_id": "b1", "status": "completed", "completed_at": completed_at},
+        {"run_id": "b1-1", "flow_id": "catalog", "batch_id": "b1", "status": "failed", "completed_at": completed_at, "error": "boom"},
+        {"run_id": "b1-2", "flow_id": "catalog", "batch_id": "b1", "status": "running"},
+        {"run_id": "b1-3", "flow_id": "catalog", "batch_id": "b1", "status": "queued"},
+        {"run_id": "b1-4", "flow_id": "catalog", "batch_id": "b1", "status": "queued"},
+    ])
+
+    status = wr.batch_status(store.get_batch("b1"))
+
+    assert status["status"] == "running"
+    assert status["counts"] == {"completed": 1, "failed": 1, "running": 1, "queued": 2}
+    assert status["finished"] == 2
+    # Two finished in two minutes: the three left take three more
+    assert status["throughput_per_minute"] == pytest.approx(1.0, rel=0.01)
+    assert status["eta_seconds"] == pytest.approx(180, rel=0.01)
+    assert status["failures"]["items"] == [{"run_id": "b1-1", "index": None, "error": "boom"}]
+
+
+def test_queued_items_resume_after_restart(client, gateway, tmp_path, wait_until, monkeypatch):
+    # A previous process accepted the batch and stopped before feeding any item
+    stopped = wr.SQLiteRunStore(tmp_path / "runs.db", recover_interrupted=False)
+    stopped.put_batch({
+        "batch_id": "b1", "flow_id": "catalog", "created_at": datetime.utcnow().isoformat(), "total": 3, "workflow": SPEC,
+    })
+    stopped.put_many([
+        {"run_id": f"b1-{i}", "flow_id": "catalog", "batch_id": "b1", "batch_index": i, "status": "queued", "input": {"sku": f"S{i}"}}
+        for i in range(3)
+    ])
+
+    # Restart recovery leaves the queued items for resume_batches, on the first request
+    monkeypatch.setattr(wr, "RUN_STORE", wr.SQLiteRunStore(tmp_path / "runs.db"))
+    monkeypatch.setattr(wr, "RUN_STORE_BACKEND", "sqlite")
+    monkeypatch.setattr(wr, "_batches_resumed", False)
+    assert not gateway.calls
+
+    status = wait_until(lambda: batch_done(client, "b1"))
+
+    assert status["counts"] == {"completed": 3}
+    assert sorted(gateway.calls) == ["S0", "S1", "S2"]
@@ -0,0 +1,143 @@
+"""Tests for callback steps: runs suspended as waiting, resumed by POST /runs/<id>/callback or expiry.
+
+Run with: python -m pytest test_callbacks.py
+"""
+
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import workflow_runner as wr
+
+
+def approval_spec(**wait_options) -> dict:
+    return {
+        "sw_spec": {
+            "do": [
+                {"prepare": {"set": {"sku": "${ .input.sku }"}}},
+                {"request_approval": {
+                    "call": "external_actions_bridge",
+                    "with": {"channel": "api", "await_callback": True, "payload": {"sku": "${ .variables.sku }"}, **wait_options},
+                }},
+                {"finish": {"set": {"workflow_result": {
+                    "sku": "${ .variables.sku }",
+                    "decision": "${ .context.request_approval.payload }",
+                }}}},
+            ]
+        }
+    }
+
+
+@pytest.fixture
+def bridge(monkeypatch):
+    """Deliveries made by external_actions_bridge steps (their args, including the callback URL)."""
+    delivered = []
+
+    def deliver(args):
+        delivered.append(args)
+        return {"channel": "api", "status_code": 200, "payload": {}}
+
+    monkeypatch.setitem(wr.SPEC_CALL_HANDLERS, "external_actions_bridge", deliver)
+    return delivered
+
+
+def start(client, wait_until) -> str:
+    response = client.post("/runs", json={"flow_id": "approval", "input": {"sku": "S1"}})
+    assert response.status_code == 201, response.json
+    run_id = response.json["run_id"]
+    wait_until(lambda: client.get(f"/runs/{run_id}").json["status"] == wr.WAITING_STATUS)
+    return run_id
+
+
+def callback_query(delivery: dict) -> dict:
+    return {key: values[0] for key, values in parse_qs(urlparse(delivery["callback"]["url"]).query).items()}
+
+
+def finished(client, run_id):
+    run = client.get(f"/runs/{run_id}").json
+    return run if run["status"] in wr.FINISHED_STATUSES else None
+
+
+def test_callback_resumes_the_waiting_run(client, flows, bridge, wait_until):
+    flows({"approval": approval_spec()})
+    run_id = start(client, wait_until)
+    query = callback_query(bridge[0])
+
+    assert client.get(f"/runs/{run_id}").json["waiting"]["steps"] == ["request_approval"]
+    assert client.post(f"/runs/{run_id}/callback?token=wrong", json={"approved": True}).status_code == 403
+    accepted = client.post(f"/runs/{run_id}/callback", json={"approved": True}, headers={"X-Callback-Token": query["token"]})
+    assert accepted.status_code == 202
+    assert accepted.json["step"] == query["step"] == "request_approval"
+
+    run = wait_until(lambda: finished(client, run_id))
+    assert run["status"] == "completed"
+    assert run["result"] == {"sku": "S1", "decision": {"approved": True}}
+    # The run has been claimed: later callbacks are refused
+    assert client.post(f"/runs/{run_id}/callback?token={query['token']}", json={"approved": False}).status_code == 409
+
+
+@pytest.mark.parametrize("make_store", [
+    lambda tmp_path: wr.MemoryRunStore(),
+    lambda tmp_path: wr.SQLiteRunStore(tmp_path / "runs.db", recover_interrupted=False),
+])
+def test_only_one_claim_on_a_waiting_run_wins(tmp_path, make_store):
+    store = make_store(tmp_path)
+    store.put({"run_id": "run-1", "flow_id": "approval", "status": wr.WAITING_STATUS}, live=False)
+
+    assert store.transition("run-1", wr.WAITING_STATUS, "queued")
+    assert not store.transition("run-1", wr.WAITING_STATUS, "queued")
+    assert store.get("run-1")["status"] == "queued"
+
+
+def test_expired_callback_step_fails_the_run(client, flows, bridge, wait_until):
+    flows({"approval": approval_spec(callback_timeout_sec=0.05)})
+    run_id = start(client, wait_until)
+    query = callback_query(bridge[0])
+
+    wait_until(lambda: wr.expire_waiting_runs() == 1)
+
+    run = client.get(f"/runs/{run_id}").json
+    assert run["status"] == "failed"
+    assert run["error"] == "Timed out waiting for callback on request_approval"
+    # The expiry claimed the run, so a late callback loses
+    assert client.post(f"/runs/{run_id}/callback?token={query['token']}", json={"approved": True}).status_code == 409
+
+
+def test_on_timeout_continue_resumes_with_a_timed_out_payload(client, flows, bridge, wait_until):
+    flows({"approval": approval_spec(callback_timeout_sec=0.05, on_timeout="continue")})
+    run_id = start(client, wait_until)
+
+    wait_until(lambda: wr.expire_waiting_runs() == 1)
+
+    run = wait_until(lambda: finished(client, run_id))
+    assert run["status"] == "completed"
+    assert run["result"]["decision"] == {"timed_out": True}
+
+
+def test_restart_recovery_leaves_waiting_runs_alone(tmp_path):
+    store = wr.SQLiteRunStore(tmp_path / "runs.db", recover_interrupted=False)
+    store.put({"run_id": "running", "flow_id": "approval", "status": "running"}, live=False)
+    store.put({"run_id": "waiting", "flow_id": "approval", "status": wr.WAITING_STATUS}, live=False)
+
+    restarted = wr.SQLiteRunStore(tmp_path / "runs.db")
+
+    assert restarted.get("running")["status"] == "failed"
+    assert restarted.get("running")["error"] == "Interrupted by runner restart"
+    assert restarted.get("waiting")["status"] == wr.WAITING_STATUS
+
+
+def test_resumed_run_keeps_its_start_and_continues_its_trace(client, flows, bridge, wait_until):
+    flows({"approval": approval_spec()})
+    run_id = start(client, wait_until)
+    started_at = wr.RUN_STORE.get(run_id)["started_at"]
+    suspended = client.get(f"/runs/{run_id}/trace").json
+
+    client.post(f"/runs/{run_id}/callback?token={callback_query(bridge[0])['token']}", json={"approved": True})
+    wait_until(lambda: finished(client, run_id))
+
+    assert wr.RUN_STORE.get(run_id)["started_at"] == started_at
+    trace = client.get(f"/runs/{run_id}/trace").json
+    assert trace["trace_id"] == suspended["trace_id"]
+    children = [child["name"] for child in trace["root"]["children"]]
+    assert children == ["prepare", "request_approval", "callback wait", "finish"]
+    assert trace["root"]["status"] == "ok"
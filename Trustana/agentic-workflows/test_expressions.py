@@ -0,0 +1,93 @@
+"""Tests for the jq-style expression engine behind `${ ... }` values in workflow specs.
+
+Run with: python -m pytest test_expressions.py
+"""
+
+import pytest
+
+import workflow_runner as wr
+
+DATA = {
+    "product": {"name": "Widget", "tags": ["red", "blue"], "sizes": [1, 2, 3]},
+    "items": [{"sku": "A", "qty": 2}, {"sku": "B", "qty": 3}],
+    "csv": "a,b",
+    "count": 5,
+    "empty": None,
+    "mixed": [1, "a"],
+}
+
+
+@pytest.mark.parametrize("expression, expected", [
+    # Paths
+    (".product.name", "Widget"),
+    (".product.sizes[0]", 1),
+    (".product.sizes[-1]", 3),
+    (".product[\"name\"]", "Widget"),
+    (".missing.deeper", None),
+    ("[.items[].sku]", ["A", "B"]),
+    (".items | map(.qty) | add", 5),
+    # Alternatives
+    (".empty // \"default\"", "default"),
+    (".missing // .product.name", "Widget"),
+    ("false // 1", 1),
+    (".count // 1", 5),
+    # Optional access suppresses errors
+    (".product.name.first?", None),
+    ("[.product.name[]?]", []),
+    ("(.count | ascii_upcase)? // \"fallback\"", "fallback"),
+    # try / catch
+    ("try (.count | ascii_downcase) catch \"not a string\"", "not a string"),
+    ("try error(\"boom\") catch .", "boom"),
+    ("try error(\"boom\")", None),
+    ("try .product.name catch \"unused\"", "Widget"),
+    # Slices
+    (".product.sizes[1:]", [2, 3]),
+    (".product.sizes[:2]", [1, 2]),
+    (".product.sizes[-2:]", [2, 3]),
+    (".product.name[1:3]", "id"),
+    (".empty[1:2]", None),
+    # Builtins given the right types
+    (".csv | split(\",\")", ["a", "b"]),
+    (".product.tags | join(\"/\")", "red/blue"),
+    (".product.name | ascii_downcase", "widget"),
+    ("\"42\" | tonumber", 42),
+    ("[.product.tags[] | select(. == \"blue\")]", ["blue"]),
+    ("if .count > 3 then \"many\" else \"few\" end", "many"),
+])
+def test_evaluates(expression, expected):
+    assert wr.evaluate_expression(expression, DATA) == expected
+
+
+@pytest.mark.parametrize("expression, message", [
+    (".count | ascii_downcase", "number cannot be passed to ascii_downcase, a string is required"),
+    (".product.tags | split(\",\")", "split input and separator must be strings, not array and string"),
+    (".csv | split(1)", "split input and separator must be strings, not string and number"),
+    (".count | join(\",\")", "Cannot iterate over number"),
+    (".count | keys", "Cannot iterate over number"),
+    (".count | map(.)", "Cannot iterate over number"),
+    (".product.name | tonumber", "Cannot parse 'Widget' as a number"),
+    (".csv | fromjson", "fromjson: "),
+    (".mixed | add", "Cannot apply + to number and string"),
+    (".mixed | min", "min: "),
+    ("true | length", "boolean has no length"),
+    (".count[1:]", "Cannot slice number"),
+    (".product.sizes[\"a\":]", "Slice bounds must be integers"),
+    (".product.sizes[\"a\"]", "Cannot index array with 'a'"),
+    ("error(\"boom\")", "boom"),
+])
+def test_errors_are_expression_errors(expression, message):
+    with pytest.raises(wr.ExpressionError) as raised:
+        wr.evaluate_expression(expression, DATA)
+    assert str(raised.value).startswith(message)
+
+
+@pytest.mark.parametrize("expression", ["1 +", ".a | ", "foo(1)", "map(1; 2)", "try", "if . then 1 end end"])
+def test_rejects_invalid_expressions_at_compile_time(expression):
+    with pytest.raises(wr.ExpressionError):
+        wr.compile_expression(expression)
+
+
+def test_render_template_replaces_whole_string_expressions_only():
+    scope = {"input": {"sku": "A1"}, "variables": {"n": 2}}
+    rendered = wr.render_template({"sku": "${ .input.sku }", "n": ["${ .variables.n }"], "text": "sku ${ .input.sku }"}, scope)
+    assert rendered == {"sku": "A1", "n": [2], "text": "sku ${ .input.sku }"}
@@ -0,0 +1,100 @@
+"""Tests for the durable job queue (RUNNER_MODE=queue): claims, lease reclaim and abandonment.
+
+Run with: python -m pytest test_job_queue.py
+"""
+
+import pytest
+
+import workflow_runner as wr
+
+
+@pytest.fixture
+def queue(tmp_path, store):
+    return wr.JobQueue(tmp_path / "jobs.db")
+
+
+def enqueue(queue, run_id):
+    wr.RUN_STORE.put({"run_id": run_id, "flow_id": "flow", "status": "queued"}, live=False)
+    return queue.enqueue(run_id, "flow", {"sw_spec": {}}, {"n": run_id})
+
+
+def expire_leases(monkeypatch):
+    # Leases granted from now on have already expired
+    monkeypatch.setattr(wr, "JOB_LEASE_SECONDS", -1)
+
+
+def test_claims_jobs_in_order_and_completes_them(queue):
+    assert enqueue(queue, "run-1") == 1
+    assert enqueue(queue, "run-2") == 2
+
+    first = queue.claim("worker-a")
+    second = queue.claim("worker-b")
+
+    assert (first["run_id"], first["attempt"], first["input"]) == ("run-1", 1, {"n": "run-1"})
+    assert second["run_id"] == "run-2"
+    assert queue.claim("worker-c") is None
+    assert queue.stats()["leased"] == 2
+
+    queue.complete("run-1", "worker-a")
+    queue.complete("run-2", "worker-a")  # not its lease: left in place
+    assert queue.stats()["leased"] == 1
+
+
+def test_enqueue_rejects_jobs_beyond_max_pending(queue, monkeypatch):
+    monkeypatch.setattr(wr, "JOB_QUEUE_MAX_PENDING", 1)
+    enqueue(queue, "run-1")
+    with pytest.raises(wr.SchedulerFull):
+        enqueue(queue, "run-2")
+
+
+def test_reclaims_job_after_lease_expires(queue, monkeypatch):
+    enqueue(queue, "run-1")
+    expire_leases(monkeypatch)
+    assert queue.claim("worker-a")["attempt"] == 1
+
+    reclaimed = queue.claim("worker-b")
+
+    assert (reclaimed["run_id"], reclaimed["attempt"]) == ("run-1", 2)
+    assert queue.heartbeat(["run-1"], "worker-a") == ["run-1"]
+    assert queue.heartbeat(["run-1"], "worker-b") == []
+    # The first worker finishing late must not drop the job from its new owner
+    queue.complete("run-1", "worker-a")
+    assert queue.stats()["leased"] == 1
+
+
+def test_heartbeat_keeps_lease_from_being_reclaimed(queue):
+    enqueue(queue, "run-1")
+    queue.claim("worker-a")
+
+    assert queue.heartbeat(["run-1"], "worker-a") == []
+    assert queue.claim("worker-b") is None
+
+
+def test_abandons_run_after_max_attempts(queue, monkeypatch):
+    monkeypatch.setattr(wr, "JOB_MAX_ATTEMPTS", 2)
+    enqueue(queue, "run-1")
+    expire_leases(monkeypatch)
+    queue.claim("worker-a")
+    queue.claim("worker-b")
+
+    assert queue.claim("worker-c") is None
+
+    run = wr.RUN_STORE.get("run-1")
+    assert run["status"] == "failed"
+    assert run["error"] == "Worker lease expired 2 times"
+    assert run["worker"] is None
+    assert queue.stats()["leased"] == 0
+
+
+def test_worker_that_lost_its_lease_stops_writing_the_run(queue):
+    stale = wr.LiveRun({"run_id": "run-1", "flow_id": "flow", "status": "running", "worker": "worker-a", "attempt": 1})
+    wr.RUN_STORE.put(stale)
+    # Another worker reclaims the job and takes over the stored run
+    wr.RUN_STORE.put({**stale, "status": "starting", "worker": "worker-b", "attempt": 2}, live=False)
+
+    stale["status"] = "completed"
+    wr.RUN_STORE.save("run-1")
+
+    assert stale.detached
+    assert wr.RUN_STORE.get("run-1")["worker"] == "worker-b"
+    assert wr.RUN_STORE.get("run-1")["status"] == "starting"
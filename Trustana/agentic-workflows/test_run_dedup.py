@@ -0,0 +1,141 @@
+"""Tests for run deduplication: identical requests share one execution through RunCoalescer.
+
+Run with: python -m pytest test_run_dedup.py
+"""
+
+import threading
+
+import pytest
+
+import workflow_runner as wr
+
+SPEC = {
+    "sw_spec": {
+        "do": [
+            {"fetch": {"call": "data_gateway", "with": {"sku": "${ .input.sku }"}}},
+            {"finish": {"set": {"workflow_result": "${ .context.fetch }"}}},
+        ]
+    }
+}
+
+
+@pytest.fixture
+def gateway(flows, monkeypatch):
+    """The dedup flow, whose data_gateway step blocks until gateway.release is set."""
+    flows({"dedup": SPEC})
+    gateway = type("Gateway", (), {})()
+    gateway.release = threading.Event()
+    gateway.calls = []
+    gateway.error = None
+
+    def fetch(args):
+        gateway.calls.append(args["sku"])
+        assert gateway.release.wait(5)
+        if gateway.error:
+            raise wr.SpecError(gateway.error)
+        return {"records": [args["sku"]]}
+
+    monkeypatch.setitem(wr.SPEC_CALL_HANDLERS, "data_gateway", fetch)
+    return gateway
+
+
+def start(client, sku="S1", tenant_id="acme"):
+    response = client.post("/runs", json={"flow_id": "dedup", "tenant_id": tenant_id, "input": {"sku": sku}, "dedup": True})
+    assert response.status_code == 201, response.json
+    return response.json
+
+
+def finished(client, run_id):
+    run = client.get(f"/runs/{run_id}").json
+    return run if run["status"] in wr.FINISHED_STATUSES else None
+
+
+def settled(run_id):
+    run = wr.RUN_STORE.get(run_id)
+    return run if run["status"] in wr.FINISHED_STATUSES else None
+
+
+def test_identical_request_attaches_to_run_in_flight(client, gateway, wait_until):
+    primary = start(client)
+    alias = start(client)
+    other = start(client, sku="S2")
+
+    assert alias["alias_of"] == primary["run_id"]
+    assert "alias_of" not in other
+    gateway.release.set()
+
+    run = wait_until(lambda: finished(client, alias["run_id"]))
+    assert run["status"] == "completed"
+    assert run["result"] == {"records": ["S1"]}
+    assert sorted(gateway.calls) == ["S1", "S2"]
+
+
+def test_aliases_are_settled_with_the_outcome(client, gateway, wait_until):
+    primary = start(client)
+    alias = start(client)
+    gateway.error = "upstream down"
+    gateway.release.set()
+
+    wait_until(lambda: finished(client, primary["run_id"]))
+    # Settled in the store by the run itself, not only when the alias is read
+    stored = wait_until(lambda: settled(alias["run_id"]))
+    assert stored["status"] == "failed"
+    assert "upstream down" in stored["error"]
+    # A failed run is not reused
+    assert "alias_of" not in start(client)
+
+
+def test_completed_run_is_reused_until_the_reuse_window_expires(client, gateway, wait_until, monkeypatch):
+    monkeypatch.setattr(wr, "RUN_DEDUP_REUSE_SECONDS", 60)
+    gateway.release.set()
+    primary = start(client)
+    wait_until(lambda: finished(client, primary["run_id"]))
+
+    assert start(client)["alias_of"] == primary["run_id"]
+
+    monkeypatch.setattr(wr, "RUN_DEDUP_REUSE_SECONDS", 0)
+    assert "alias_of" not in start(client)
+
+
+def test_fingerprints_are_per_tenant(client, gateway):
+    start(client, tenant_id="acme")
+    assert "alias_of" not in start(client, tenant_id="globex")
+    gateway.release.set()
+
+
+def test_run_rejected_by_a_full_queue_is_forgotten(client, gateway, monkeypatch):
+    monkeypatch.setattr(wr, "SCHEDULER", wr.RunScheduler(1, 0))
+    rejected = client.post("/runs", json={"flow_id": "dedup", "input": {"sku": "S1"}, "dedup": True})
+    assert rejected.status_code == 429
+    assert wr.RUN_COALESCER.stats()["tracked"] == 0
+
+    monkeypatch.setattr(wr, "SCHEDULER", wr.RunScheduler(1, 8))
+    assert "alias_of" not in start(client, tenant_id="default")
+    gateway.release.set()
+
+
+def test_run_registered_but_not_yet_stored_counts_as_in_flight(store, monkeypatch):
+    coalescer = wr.RunCoalescer()
+    # Between attach and create_run storing the run, the store does not know it
+    assert coalescer.attach("fp", "run-a") is None
+    assert store.get("run-a") is None
+    assert coalescer.attach("fp", "run-b") == "run-a"
+
+    monkeypatch.setattr(wr, "RUN_DEDUP_PENDING_SECONDS", 0)
+    assert coalescer.attach("fp2", "run-c") is None
+    # A registration that never got stored is not waited on forever
+    assert coalescer.attach("fp2", "run-d") is None
+
+
+def test_runs_are_found_through_the_shared_store(store):
+    # As registered by another replica: absent from this process's index
+    store.put({"run_id": "run-a", "flow_id": "dedup", "status": "running", "fingerprint": "fp"}, live=False)
+    store.put({"run_id": "run-b", "flow_id": "dedup", "status": "queued", "fingerprint": "fp", "alias_of": "run-a"}, live=False)
+
+    assert wr.RunCoalescer().attach("fp", "run-c") == "run-a"
+
+
+def test_waiting_runs_are_not_reused(store):
+    store.put({"run_id": "run-a", "flow_id": "dedup", "status": wr.WAITING_STATUS, "fingerprint": "fp"}, live=False)
+
+    assert wr.RunCoalescer().attach("fp", "run-b") is None
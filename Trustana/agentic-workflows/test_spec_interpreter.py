@@ -0,0 +1,117 @@
+"""Tests for the sw_spec interpreter: dependency ordering, parallel steps and failure handling.
+
+Run with: python -m pytest test_spec_interpreter.py
+"""
+
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+import workflow_runner as wr
+
+
+class StepExecutor:
+    """Runs each submitted step on its own thread; steps named in hold start only once release is set."""
+
+    def __init__(self, hold=()):
+        self.hold = set(hold)
+        self.release = threading.Event()
+
+    def submit(self, fn, step, *args):
+        future = Future()
+
+        def run():
+            if step["name"] in self.hold:
+                self.release.wait(5)
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(fn(step, *args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    """data_gateway calls dispatch to gateway.behaviour[args["name"]](args); gateway.events records them."""
+    gateway = type("Gateway", (), {})()
+    gateway.events = []
+    gateway.behaviour = {}
+
+    def fetch(args):
+        name = args["name"]
+        gateway.events.append(("start", name))
+        try:
+            return gateway.behaviour.get(name, lambda args: {"name": name})(args)
+        finally:
+            gateway.events.append(("end", name))
+
+    monkeypatch.setitem(wr.SPEC_CALL_HANDLERS, "data_gateway", fetch)
+    return gateway
+
+
+def fetch_step(name: str, **args) -> dict:
+    return {name: {"call": "data_gateway", "with": {"name": name, **args}}}
+
+
+def execute(steps: list[dict]) -> dict:
+    run_id = f"run-{time.monotonic_ns()}"
+    wr.RUN_STORE.put(wr.LiveRun({"run_id": run_id, "flow_id": "spec", "status": "starting"}))
+    wr.execute_spec_workflow(run_id, {"flow_id": "spec", "sw_spec": {"do": steps}}, {})
+    return wr.RUN_STORE.get(run_id)
+
+
+def test_independent_steps_run_in_parallel_and_dependents_wait(store, gateway):
+    # Each of a and b only returns once the other has started
+    both_started = threading.Barrier(2, timeout=2)
+    gateway.behaviour = {name: lambda args: (both_started.wait(), {"value": args["name"]})[1] for name in ("a", "b")}
+
+    run = execute([
+        {"init": {"set": {"prefix": "sku"}}},
+        fetch_step("a", prefix="${ .variables.prefix }"),
+        fetch_step("b"),
+        fetch_step("c", after=["${ .context.a.value }", "${ .context.b.value }"]),
+        {"finish": {"set": {"workflow_result": "${ [.context.a.value, .context.b.value, .context.c.name] }"}}},
+    ])
+
+    assert run["status"] == "completed", run.get("error")
+    assert run["result"] == ["a", "b", "c"]
+    assert {event for event in gateway.events[:2]} == {("start", "a"), ("start", "b")}
+    assert gateway.events[-2:] == [("start", "c"), ("end", "c")]
+    assert run["steps"] == dict.fromkeys(("init", "a", "b", "c", "finish"), "completed")
+
+
+def test_failed_step_cancels_steps_not_started_and_drains_running_ones(store, gateway, monkeypatch):
+    executor = StepExecutor(hold={"later"})
+    monkeypatch.setattr(wr, "SPEC_STEP_EXECUTOR", executor)
+    slow_started = threading.Event()
+
+    def slow(args):
+        slow_started.set()
+        time.sleep(0.2)
+        return {}
+
+    def bad(args):
+        assert slow_started.wait(2)
+        raise wr.SpecError("upstream down")
+
+    gateway.behaviour = {"slow": slow, "bad": bad}
+
+    started = time.monotonic()
+    run = execute([fetch_step("slow"), fetch_step("bad"), fetch_step("later"), fetch_step("after", on="${ .context.bad }")])
+
+    # Not held up by the cancelled step, which no worker has picked up
+    assert time.monotonic() - started < 2
+    assert run["status"] == "failed"
+    assert "upstream down" in run["error"]
+    # slow was waited for before the run failed; later never started
+    assert ("end", "slow") in gateway.events
+    assert run["steps"] == {"slow": "completed", "bad": "failed", "later": "cancelled", "after": "pending"}
+    executor.release.set()
+    time.sleep(0.05)
+    assert ("start", "later") not in gateway.events
@@ -2,28 +2,77 @@
 Minimal Workflow Runner Service
 
 Executes SW 1.0.2 workflow specifications via HTTP API.
-Supports: trustana-serpapi-csv, aeo-visibility-score workflows
+Built-in handlers: trustana-serpapi-csv, aeo-visibility-score (single product or batch), localization.
+Any other workflow is run by interpreting its sw_spec (call: data_gateway / agent_adapter /
+external_actions_bridge, set, switch), with independent steps executed concurrently.
 
 API:
-  POST /runs - Start a workflow run
-  GET /runs/<run_id> - Get run status
+  POST /runs - Start a workflow run ("dedup": true attaches to an identical in-flight run)
+  POST /runs:batch - Start one run per item (JSON items array or NDJSON body)
+  GET /batches/<batch_id> - Aggregate batch status: counts, throughput, ETA, failed items
+  GET /batches/<batch_id>/export - All batch items and results as NDJSON
+  GET /runs - List runs (filter by tenant_id, flow_id, status; status=waiting for suspended runs)
+  GET /runs/<run_id> - Get run status (?fields= projection, ETag/304, gzip)
+  GET /runs/<run_id>/result - Full result of a completed run (?path=, paginated lists with ?limit=&offset=)
+  POST /runs/<run_id>/callback - Resume a run waiting at a callback (approval) step
+  GET /runs/<run_id>/events - Server-sent event stream of a run's progress
+  GET /runs/<run_id>/trace - Span tree of a run (?format=otlp for OTLP/JSON)
+  GET /events - Server-sent events for all runs of a tenant, flow or batch
   GET /health - Health check
+  GET /metrics - Prometheus metrics
   GET /workflows - List available workflows
+  GET /output/<path> - Download an output file (Range, ETag/Last-Modified, gzip)
+  GET /stats/http-pool - Shared HTTP connection pool statistics
+  GET /stats/cache - Search response cache statistics
+  GET /stats/result-sink - Result dataset sink statistics
+  GET /stats/expressions - Per-expression evaluation timings of compiled specs
+
+Upstream base URLs can be overridden with <PROVIDER>_BASE_URL (see benchmark.py).
+
+With RUNNER_MODE=queue, POST /runs enqueues into a durable SQLite job queue
+(JOB_QUEUE_PATH) and runs are executed by any number of worker processes:
+  RUNNER_MODE=queue python workflow_runner.py worker [--concurrency N]
+Workers lease jobs and renew the leases with heartbeats; a job whose worker
+dies is reclaimed once its lease expires (a worker that loses a lease stops
+writing that run). API replicas and workers must share DATA_DIR (run store
+and job queue). Step, upstream and token metrics are recorded where runs
+execute, so each worker serves its own /metrics on WORKER_METRICS_PORT.
 """
 
 import os
 import json
+import time
+import atexit
 import csv
 import re
 import uuid
+import sqlite3
+import hashlib
+import gzip
+import queue
+import random
+import zlib
 import logging
-from datetime import datetime
+import hmac
+import secrets
+import signal
+import socket
+import argparse
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from threading import Thread
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from functools import partial
+from threading import Thread, Lock, Condition, Event
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeoutError
 from typing import Any
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, send_file
+from werkzeug.security import safe_join
+from werkzeug.serving import make_server
 import httpx
 
 # Configure logging
@@ -32,55 +81,2032 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
-# In-memory run storage
-RUNS: dict[str, dict] = {}
 WORKFLOW_DIR = os.environ.get("WORKFLOW_DIR", "/app/workflows")
 OUTPUT_DIR = Path(os.environ.get("OUTPUT_DIR", "/app/output"))
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+# Persistent runner state (caches, stores) that must not be served from /output
+DATA_DIR = Path(os.environ.get("DATA_DIR", "/app/data"))
+DATA_DIR.mkdir(parents=True, exist_ok=True)
+
+# Models used by the search providers (part of the response cache key)
+GEMINI_MODEL = "gemini-2.0-flash"
+PERPLEXITY_MODEL = "sonar"
+OPENAI_SEARCH_MODEL = "gpt-4o"
+TRANSLATION_MODEL = "gpt-5.1"
+
+# Metrics settings: histogram buckets (seconds) for step, run and upstream call durations
+METRICS_BUCKETS = tuple(
+    float(bucket) for bucket in os.environ.get("METRICS_BUCKETS", "0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,120,300").split(",")
+)
+
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric:
+    """A labelled counter, gauge or histogram, rendered in the Prometheus text format."""
+
+    def __init__(self, kind: str, name: str, help_text: str, labels: tuple[str, ...] = (), buckets: tuple = ()):
+        self.kind = kind
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._values: dict[tuple, Any] = {}
+        self._lock = Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = float(value)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def _labels(self, key: tuple, le: str | None = None) -> str:
+        pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(self.labels, key)]
+        if le is not None:
+            pairs.append(f'le="{le}"')
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{self._labels(key)} {value:g}")
+                continue
+            for bound, count in zip(self.buckets, value["buckets"]):
+                lines.append(f"{self.name}_bucket{self._labels(key, f'{bound:g}')} {count}")
+            lines.append(f"{self.name}_bucket{self._labels(key, '+Inf')} {value['count']}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {value['sum']:g}")
+            lines.append(f"{self.name}_count{self._labels(key)} {value['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    """Process-wide metrics; collectors refresh point-in-time gauges when /metrics is scraped."""
+
+    def __init__(self):
+        self._metrics: list[Metric] = []
+        self._collectors: list = []
+
+    def _register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: tuple[str, ...] = ()) -> Metric:
+        return self._register(Metric("counter", name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: tuple[str, ...] = ()) -> Metric:
+        return self._register(Metric("gauge", name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: tuple[str, ...] = (), buckets: tuple = METRICS_BUCKETS) -> Metric:
+        return self._register(Metric("histogram", name, help_text, labels, buckets))
+
+    def collector(self, fn):
+        self._collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        for collect in self._collectors:
+            try:
+                collect()
+            except Exception as e:
+                logger.warning(f"Metrics collector {collect.__name__} failed: {e}")
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+
+METRICS = MetricsRegistry()
+STEP_DURATION = METRICS.histogram(
+    "workflow_step_duration_seconds", "Duration of workflow steps", ("flow_id", "step", "outcome")
+)
+RUN_DURATION = METRICS.histogram(
+    "workflow_run_duration_seconds", "Duration of workflow runs from start to finish", ("flow_id", "status")
+)
+RUNS_FINISHED = METRICS.counter("workflow_runs_total", "Finished workflow runs", ("flow_id", "status"))
+RUNS_ACTIVE = METRICS.gauge("workflow_runs_active", "Runs currently executing")
+RUNS_QUEUED = METRICS.gauge("workflow_runs_queued", "Runs waiting for a scheduler worker")
+RUNS_WAITING = METRICS.gauge("workflow_runs_waiting", "Runs suspended until a callback or their expiry")
+RUN_QUEUE_CAPACITY = METRICS.gauge("workflow_run_queue_capacity", "Maximum number of queued runs")
+RUNS_COALESCED = METRICS.counter(
+    "workflow_runs_coalesced_total", "Runs attached to an identical in-flight or recent run", ("flow_id",)
+)
+UPSTREAM_DURATION = METRICS.histogram(
+    "upstream_request_duration_seconds", "Latency of upstream HTTP requests (each attempt)", ("provider", "status")
+)
+UPSTREAM_RETRIES = METRICS.counter("upstream_retries_total", "Retried upstream HTTP requests", ("provider",))
+UPSTREAM_LIMITER_WAIT = METRICS.histogram(
+    "upstream_limiter_wait_seconds", "Time requests waited for a provider rate/concurrency slot", ("provider",)
+)
+LLM_TOKENS = METRICS.counter("llm_tokens_total", "LLM tokens reported by provider usage payloads", ("provider", "model", "type"))
+
+
+def record_llm_usage(provider: str, model: str, payload: dict) -> None:
+    """Count the tokens in a Responses, Chat Completions or Gemini usage payload."""
+    usage = payload.get("usage") or {}
+    gemini_usage = payload.get("usageMetadata") or {}
+    counts = {
+        "input": usage.get("input_tokens", usage.get("prompt_tokens", gemini_usage.get("promptTokenCount"))),
+        "output": usage.get("output_tokens", usage.get("completion_tokens", gemini_usage.get("candidatesTokenCount"))),
+    }
+    for token_type, count in counts.items():
+        if isinstance(count, (int, float)) and count:
+            LLM_TOKENS.inc(count, provider=provider, model=model, type=token_type)
+
+
+# Run tracing settings
+TRACE_MAX_SPANS = int(os.environ.get("TRACE_MAX_SPANS", "2000"))
+# Directory for OTLP JSON exports of finished run traces (no export when unset)
+TRACE_EXPORT_DIR = os.environ.get("TRACE_EXPORT_DIR", "")
+
+_CURRENT_SPAN: ContextVar["Span | None"] = ContextVar("current_span", default=None)
+
+
+class Span:
+    """One timed operation in a run trace."""
+
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns", "status", "attributes")
+
+    def __init__(self, trace: "RunTrace", name: str, kind: str, parent_id: str | None, attributes: dict):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns: int | None = None
+        self.status = "ok"
+        self.attributes = {key: value for key, value in attributes.items() if value is not None}
+
+    def set(self, **attributes) -> None:
+        self.attributes.update({key: value for key, value in attributes.items() if value is not None})
+
+    def end(self, status: str | None = None) -> None:
+        if status:
+            self.status = status
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+
+    @classmethod
+    def restore(cls, trace: "RunTrace", exported: dict) -> "Span":
+        """A span recorded by an earlier segment of the run, from its exported form."""
+        span = cls.__new__(cls)
+        span.trace = trace
+        for field in ("span_id", "parent_id", "name", "kind", "start_ns", "end_ns", "status"):
+            setattr(span, field, exported[field])
+        span.attributes = dict(exported["attributes"])
+        return span
+
+    def export(self) -> dict:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "status": self.status,
+            "attributes": dict(self.attributes),
+        }
 
 
-def load_workflow(flow_id: str) -> dict | None:
-    """Load workflow spec from JSON file."""
-    workflow_path = Path(WORKFLOW_DIR) / f"{flow_id}.json"
-    if workflow_path.exists():
-        with open(workflow_path) as f:
-            return json.load(f)
-    return None
+class RunTrace:
+    """Tree of timed spans for one run: workflow -> step -> upstream call -> attempt.
+
+    Spans beyond TRACE_MAX_SPANS are dropped (and counted) so large batch runs
+    keep a bounded trace. A run resumed after waiting for callbacks continues
+    the trace exported when it was suspended (previous): its root is reopened
+    and a span covers the wait.
+    """
+
+    def __init__(self, run_id: str, flow_id: str | None, previous: dict | None = None):
+        self.run_id = run_id
+        self.trace_id = uuid.uuid4().hex
+        self.dropped = 0
+        self._spans: list[Span] = []
+        self._steps: dict[str, Span] = {}
+        self._lock = Lock()
+        if previous and previous.get("spans"):
+            self.trace_id = previous["trace_id"]
+            self.dropped = previous.get("dropped_spans", 0)
+            self._spans = [Span.restore(self, span) for span in previous["spans"]]
+            self.root = next((span for span in self._spans if span.parent_id is None), self._spans[0])
+            suspended_ns, self.root.end_ns, self.root.status = self.root.end_ns, None, "ok"
+            wait_span = self.start_span("callback wait", "wait", self.root)
+            if wait_span is not None:
+                wait_span.start_ns = suspended_ns or wait_span.start_ns
+                wait_span.end()
+        else:
+            self.root = Span(self, flow_id or "workflow", "workflow", None, {"run_id": run_id, "flow_id": flow_id})
+            self._spans.append(self.root)
+
+    def start_span(self, name: str, kind: str, parent: Span, attributes: dict | None = None) -> Span | None:
+        with self._lock:
+            return self._start_span(name, kind, parent, attributes)
+
+    def _start_span(self, name: str, kind: str, parent: Span, attributes: dict | None = None) -> Span | None:
+        # Caller holds the lock
+        if len(self._spans) >= TRACE_MAX_SPANS:
+            self.dropped += 1
+            return None
+        span = Span(self, name, kind, parent.span_id, attributes or {})
+        self._spans.append(span)
+        return span
+
+    def step_span(self, name: str) -> Span | None:
+        """The open span of a workflow step, started on first use.
+
+        The step's own thread and the run's current_step updates both ask for it,
+        so lookup and start happen under one lock to record a single span.
+        """
+        with self._lock:
+            span = self._steps.get(name)
+            if span is None:
+                span = self._start_span(name, "step", self.root)
+                if span is not None:
+                    self._steps[name] = span
+            return span
+
+    def end_step(self, name: str, status: str = "ok") -> None:
+        with self._lock:
+            span = self._steps.pop(name, None)
+        if span is not None:
+            span.end(status)
+
+    def finish(self, status: str, error: str | None = None) -> None:
+        failed = status != "completed"
+        with self._lock:
+            steps, self._steps = list(self._steps.values()), {}
+        for span in steps:
+            span.end("error" if failed else "ok")
+        self.root.set(status=status, error=error)
+        self.root.end("error" if failed else "ok")
+
+    def export(self) -> dict:
+        """Flat, JSON-serialisable form stored with the run."""
+        with self._lock:
+            spans = [span.export() for span in self._spans]
+        return {"run_id": self.run_id, "trace_id": self.trace_id, "dropped_spans": self.dropped, "spans": spans}
+
+
+def trace_tree(trace: dict) -> dict:
+    """Nest an exported trace's spans under their parents, with offsets and durations in ms."""
+    spans = trace["spans"]
+    origin = spans[0]["start_ns"] if spans else 0
+    now = time.time_ns()
+    nodes = {}
+    for span in spans:
+        nodes[span["span_id"]] = {
+            "name": span["name"],
+            "kind": span["kind"],
+            "status": span["status"] if span["end_ns"] is not None else "running",
+            "start_offset_ms": round((span["start_ns"] - origin) / 1e6, 2),
+            "duration_ms": round(((span["end_ns"] or now) - span["start_ns"]) / 1e6, 2),
+            "attributes": span["attributes"],
+            "children": [],
+        }
+    roots = []
+    for span in spans:
+        parent = nodes.get(span["parent_id"])
+        (parent["children"] if parent else roots).append(nodes[span["span_id"]])
+    for node in nodes.values():
+        node["children"].sort(key=lambda child: child["start_offset_ms"])
+    return {
+        "run_id": trace["run_id"],
+        "trace_id": trace["trace_id"],
+        "dropped_spans": trace["dropped_spans"],
+        "span_count": len(spans),
+        "root": roots[0] if len(roots) == 1 else None,
+        **({"roots": roots} if len(roots) != 1 else {}),
+    }
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def trace_to_otlp(trace: dict) -> dict:
+    """An exported trace as an OTLP/JSON ExportTraceServiceRequest."""
+    end_fallback = time.time_ns()
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "workflow-runner"}}]},
+            "scopeSpans": [{
+                "scope": {"name": "workflow_runner"},
+                "spans": [
+                    {
+                        "traceId": trace["trace_id"],
+                        "spanId": span["span_id"],
+                        **({"parentSpanId": span["parent_id"]} if span["parent_id"] else {}),
+                        "name": span["name"],
+                        # SPAN_KIND_CLIENT for upstream calls, SPAN_KIND_INTERNAL otherwise
+                        "kind": 3 if span["kind"] == "client" else 1,
+                        "startTimeUnixNano": str(span["start_ns"]),
+                        "endTimeUnixNano": str(span["end_ns"] or end_fallback),
+                        "attributes": [
+                            {"key": key, "value": _otlp_value(value)}
+                            for key, value in {"span.kind": span["kind"], **span["attributes"]}.items()
+                        ],
+                        "status": {"code": 2 if span["status"] == "error" else 1},
+                    }
+                    for span in trace["spans"]
+                ],
+            }],
+        }],
+    }
+
+
+def export_trace_file(trace: dict) -> None:
+    """Write a finished run's trace as OTLP JSON to TRACE_EXPORT_DIR."""
+    if not TRACE_EXPORT_DIR:
+        return
+    try:
+        export_dir = Path(TRACE_EXPORT_DIR)
+        export_dir.mkdir(parents=True, exist_ok=True)
+        (export_dir / f"{trace['run_id']}.otlp.json").write_text(json.dumps(trace_to_otlp(trace), default=str))
+    except OSError as e:
+        logger.warning(f"Could not export trace of run {trace['run_id']}: {e}")
+
+
+@contextmanager
+def trace_span(name: str, kind: str = "internal", **attributes):
+    """Record a child span of the current span (a no-op outside a traced run); yields the span or None."""
+    parent = _CURRENT_SPAN.get()
+    span = parent.trace.start_span(name, kind, parent, attributes) if parent is not None else None
+    if span is None:
+        yield None
+        return
+    token = _CURRENT_SPAN.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.set(error=f"{type(e).__name__}: {e}"[:500])
+        span.end("error")
+        raise
+    finally:
+        _CURRENT_SPAN.reset(token)
+        span.end()
+
+
+def annotate_span(**attributes) -> None:
+    """Set attributes on the current span, if any."""
+    span = _CURRENT_SPAN.get()
+    if span is not None:
+        span.set(**attributes)
+
+
+def activate_step(name: str) -> None:
+    """Make a workflow step's span current, so work done for the step nests under it."""
+    span = _CURRENT_SPAN.get()
+    if span is not None:
+        step = span.trace.step_span(name)
+        if step is not None:
+            _CURRENT_SPAN.set(step)
+
+
+def in_context(fn):
+    """Bind fn to a copy of the caller's context, so spans started on pool threads nest under the current span."""
+    return partial(copy_context().run, fn)
+
+
+# Shared HTTP connection pool settings
+HTTP_POOL_MAX_CONNECTIONS = int(os.environ.get("HTTP_POOL_MAX_CONNECTIONS", "100"))
+HTTP_POOL_MAX_KEEPALIVE = int(os.environ.get("HTTP_POOL_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_POOL_TIMEOUT = float(os.environ.get("HTTP_POOL_TIMEOUT", "10"))
+HTTP2_ENABLED = os.environ.get("HTTP2_ENABLED", "false").lower() == "true"
+
+# Upstream base URLs, overridable (e.g. OPENAI_BASE_URL=http://127.0.0.1:9005) to run against local stand-ins
+PROVIDER_BASE_URLS = {
+    provider: os.environ.get(f"{provider.upper()}_BASE_URL", default).rstrip("/")
+    for provider, default in {
+        "trustana": "https://api.trustana.com",
+        "serpapi": "https://serpapi.com",
+        "gemini": "https://generativelanguage.googleapis.com",
+        "perplexity": "https://api.perplexity.ai",
+        "openai": "https://api.openai.com",
+        "slack": "https://slack.com",
+    }.items()
+}
+
+
+def host_key(url: str | httpx.URL) -> str:
+    """Host a URL is pooled and rate-limited under (host:port when the port is not the scheme default)."""
+    url = httpx.URL(url)
+    return f"{url.host}:{url.port}" if url.port else url.host
+
+
+# Upstream providers by host; rate limits and retries are shared per provider across all runs
+PROVIDER_HOSTS = {host_key(url): provider for provider, url in PROVIDER_BASE_URLS.items()}
+
+# Default request timeout (seconds) per upstream host, overridable via
+# HTTP_HOST_TIMEOUTS='{"api.openai.com": 240}'
+HTTP_HOST_TIMEOUTS: dict[str, float] = {
+    host_key(PROVIDER_BASE_URLS[provider]): timeout
+    for provider, timeout in {"trustana": 30, "serpapi": 30, "slack": 30, "gemini": 90, "perplexity": 90, "openai": 180}.items()
+}
+HTTP_HOST_TIMEOUTS.update(json.loads(os.environ.get("HTTP_HOST_TIMEOUTS", "{}")))
+HTTP_DEFAULT_TIMEOUT = 30
+
+# Requests per second (0 = unlimited), bucket burst and concurrency cap per provider,
+# overridable per key via PROVIDER_LIMITS='{"openai": {"rps": 20, "max_concurrency": 32}}'
+PROVIDER_LIMITS: dict[str, dict] = {
+    "trustana": {"rps": 10, "max_concurrency": 16},
+    "serpapi": {"rps": 5, "max_concurrency": 8},
+    "gemini": {"rps": 10, "max_concurrency": 16},
+    "perplexity": {"rps": 5, "max_concurrency": 8},
+    "openai": {"rps": 10, "max_concurrency": 16},
+    "slack": {"rps": 1, "burst": 3, "max_concurrency": 2},
+    "default": {"rps": 0, "max_concurrency": 32},
+}
+for _provider, _limits in json.loads(os.environ.get("PROVIDER_LIMITS", "{}")).items():
+    PROVIDER_LIMITS[_provider] = {**PROVIDER_LIMITS.get(_provider, PROVIDER_LIMITS["default"]), **_limits}
+
+# Retry policy: total attempts, full-jitter exponential backoff, and the longest
+# Retry-After we are willing to wait before handing the response back to the caller
+HTTP_RETRY_MAX_ATTEMPTS = int(os.environ.get("HTTP_RETRY_MAX_ATTEMPTS", "4"))
+HTTP_RETRY_BASE_DELAY = float(os.environ.get("HTTP_RETRY_BASE_DELAY", "0.5"))
+HTTP_RETRY_MAX_DELAY = float(os.environ.get("HTTP_RETRY_MAX_DELAY", "30"))
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+# Failures before any of the request was sent, so resending is safe for every method
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# A connection dropped mid-exchange may have been acted on: only idempotent requests are resent after it
+RETRYABLE_ERRORS = UNSENT_ERRORS + (httpx.RemoteProtocolError,)
+# Methods retried by default; POSTs that only read (searches) opt in with idempotent=True
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+# Halve a provider's concurrency at most once per interval, so one burst of 429s counts once
+AIMD_DECREASE_INTERVAL = 1.0
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request cannot start or finish before its caller's deadline."""
+
+
+def parse_retry_after(headers: httpx.Headers) -> float | None:
+    """Seconds to wait from Retry-After (seconds or HTTP date) or retry-after-ms, if present."""
+    if headers.get("retry-after-ms"):
+        try:
+            return max(float(headers["retry-after-ms"]) / 1000, 0.0)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff for the given (1-based) failed attempt."""
+    return random.uniform(0, min(HTTP_RETRY_MAX_DELAY, HTTP_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+class ProviderLimiter:
+    """Token-bucket rate limit plus an AIMD concurrency limit for one upstream provider.
+
+    The concurrency limit grows by one per window of successful requests and
+    halves on 429s; a Retry-After pauses every request to the provider.
+    """
+
+    def __init__(self, name: str, rps: float = 0, max_concurrency: int = 32, burst: float | None = None,
+                 min_concurrency: int = 1):
+        self.name = name
+        self.rps = float(rps or 0)
+        self.burst = float(burst or max(1.0, self.rps))
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.limit = float(max_concurrency)
+        self._tokens = self.burst
+        self._refilled_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._decreased_at = 0.0
+        self._in_flight = 0
+        self._cond = Condition()
+        self._stats = {"requests": 0, "throttled": 0, "retries": 0, "wait_seconds_total": 0.0}
+
+    def acquire(self, deadline: float | None = None) -> float:
+        """Block until a request may start (or the monotonic deadline passes); returns the seconds spent waiting."""
+        started = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    raise DeadlineExceeded(f"Deadline passed waiting for a {self.name} request slot")
+                if self.rps:
+                    self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rps)
+                    self._refilled_at = now
+                delay = self._blocked_until - now
+                if delay <= 0 and self._in_flight >= int(self.limit):
+                    self._cond.wait(deadline - now if deadline is not None else None)
+                    continue
+                if delay <= 0 and self.rps and self._tokens < 1:
+                    delay = (1 - self._tokens) / self.rps
+                if delay > 0:
+                    self._cond.wait(min(delay, deadline - now) if deadline is not None else delay)
+                    continue
+
+                if self.rps:
+                    self._tokens -= 1
+                self._in_flight += 1
+                waited = now - started
+                self._stats["requests"] += 1
+                self._stats["wait_seconds_total"] += waited
+                return waited
+
+    def release(self, status_code: int | None = None, retry_after: float | None = None) -> None:
+        """Finish a request and adapt the concurrency limit to its outcome."""
+        with self._cond:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if status_code == 429 or retry_after:
+                self._stats["throttled"] += 1
+                if retry_after:
+                    # Longer waits are left to the caller, who gets the 429 back instead of a stalled provider
+                    self._blocked_until = max(self._blocked_until, now + min(retry_after, HTTP_RETRY_MAX_DELAY))
+                if now - self._decreased_at >= AIMD_DECREASE_INTERVAL:
+                    self._decreased_at = now
+                    self.limit = max(float(self.min_concurrency), self.limit / 2)
+                    logger.warning(
+                        f"Provider {self.name} throttled (status {status_code}, retry-after {retry_after}); "
+                        f"concurrency limit -> {int(self.limit)}"
+                    )
+            elif status_code is not None and status_code < 500:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def record_retry(self) -> None:
+        with self._cond:
+            self._stats["retries"] += 1
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "rps": self.rps or None,
+                "burst": self.burst,
+                "concurrency_limit": int(self.limit),
+                "max_concurrency": self.max_concurrency,
+                "in_flight": self._in_flight,
+                "blocked_for_seconds": round(max(self._blocked_until - time.monotonic(), 0.0), 2),
+                **self._stats,
+                "wait_seconds_total": round(self._stats["wait_seconds_total"], 3),
+            }
+
+
+_PROVIDER_LIMITERS: dict[str, ProviderLimiter] = {}
+_PROVIDER_LIMITERS_LOCK = Lock()
+
+
+def provider_limiter(host: str) -> ProviderLimiter:
+    """The shared limiter for a host's provider (unknown hosts get their own default-limited one)."""
+    provider = PROVIDER_HOSTS.get(host, host)
+    limiter = _PROVIDER_LIMITERS.get(provider)
+    if limiter is None:
+        with _PROVIDER_LIMITERS_LOCK:
+            limiter = _PROVIDER_LIMITERS.get(provider)
+            if limiter is None:
+                limits = PROVIDER_LIMITS.get(provider, PROVIDER_LIMITS["default"])
+                limiter = _PROVIDER_LIMITERS[provider] = ProviderLimiter(provider, **limits)
+    return limiter
+
+
+class HTTPPool:
+    """Process-wide pool of long-lived httpx clients, one per upstream host."""
+
+    def __init__(self):
+        self._clients: dict[str, httpx.Client] = {}
+        self._stats: dict[str, dict] = {}
+        self._lock = Lock()
+        self._http2 = HTTP2_ENABLED
+        if self._http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("HTTP2_ENABLED is set but the 'h2' package is not installed; using HTTP/1.1")
+                self._http2 = False
+
+    def client(self, host: str) -> httpx.Client:
+        """Get (or lazily create) the shared client for a host."""
+        client = self._clients.get(host)
+        if client is not None:
+            return client
+
+        with self._lock:
+            if host not in self._clients:
+                limits = httpx.Limits(
+                    max_connections=HTTP_POOL_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_POOL_MAX_KEEPALIVE,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                )
+                timeout = httpx.Timeout(HTTP_HOST_TIMEOUTS.get(host, HTTP_DEFAULT_TIMEOUT), pool=HTTP_POOL_TIMEOUT)
+                self._clients[host] = httpx.Client(limits=limits, timeout=timeout, http2=self._http2)
+                self._stats[host] = {
+                    "requests": 0,
+                    "new_connections": 0,
+                    "errors": 0,
+                    "wait_seconds_total": 0.0,
+                    "wait_seconds_max": 0.0,
+                }
+                logger.info(f"Created pooled HTTP client for {host} (http2={self._http2})")
+            return self._clients[host]
+
+    def request(self, method: str, url: str, timeout: float | None = None, max_attempts: int | None = None,
+                deadline: float | None = None, idempotent: bool | None = None, **kwargs) -> httpx.Response:
+        """Send a request through the shared client for the URL's host.
+
+        Requests are throttled by the host's provider limiter. Idempotent
+        requests (IDEMPOTENT_METHODS unless `idempotent` says otherwise) are
+        retried with backoff on retryable statuses and connection failures,
+        honouring Retry-After; others (e.g. posting a message) only when the
+        connection could not be made. The last response is returned once retries run out.
+        A monotonic `deadline` bounds the waits, each attempt's timeout and
+        the retries; DeadlineExceeded is raised if it passes before a request starts.
+        """
+        parsed = httpx.URL(url)
+        provider = PROVIDER_HOSTS.get(host_key(parsed), parsed.host)
+        with trace_span(f"{method} {provider}", "client", provider=provider, method=method,
+                        url=str(parsed.copy_with(query=None))) as span:
+            response = self._request(method, url, timeout, max_attempts, deadline, idempotent, **kwargs)
+            if span is not None:
+                span.set(status_code=response.status_code)
+                if response.status_code >= 400:
+                    span.status = "error"
+            return response
+
+    def _request(self, method: str, url: str, timeout: float | None, max_attempts: int | None,
+                 deadline: float | None, idempotent: bool | None, **kwargs) -> httpx.Response:
+        host = host_key(url)
+        client = self.client(host)
+        limiter = provider_limiter(host)
+        max_attempts = max_attempts or HTTP_RETRY_MAX_ATTEMPTS
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        timeout = timeout if timeout is not None else HTTP_HOST_TIMEOUTS.get(host, HTTP_DEFAULT_TIMEOUT)
+        kwargs["timeout"] = httpx.Timeout(timeout, pool=HTTP_POOL_TIMEOUT)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            waited = limiter.acquire(deadline)
+            UPSTREAM_LIMITER_WAIT.observe(waited, provider=limiter.name)
+            annotate_span(attempts=attempt)
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0.001)
+                kwargs["timeout"] = httpx.Timeout(min(timeout, remaining), pool=min(HTTP_POOL_TIMEOUT, remaining))
+            started = time.monotonic()
+            try:
+                response = self._send(client, host, method, url, attempt, waited, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                UPSTREAM_DURATION.observe(time.monotonic() - started, provider=limiter.name, status="error")
+                limiter.release()
+                if attempt >= max_attempts or not (idempotent or isinstance(e, UNSENT_ERRORS)):
+                    raise
+                delay = backoff_delay(attempt)
+                if deadline is not None and time.monotonic() + delay >= deadline:
+                    raise
+                logger.warning(f"{method} {host} failed ({type(e).__name__}), retry {attempt}/{max_attempts - 1} in {delay:.2f}s")
+            except Exception:
+                UPSTREAM_DURATION.observe(time.monotonic() - started, provider=limiter.name, status="error")
+                limiter.release()
+                raise
+            else:
+                UPSTREAM_DURATION.observe(time.monotonic() - started, provider=limiter.name, status=response.status_code)
+                retry_after = parse_retry_after(response.headers) if response.status_code in RETRYABLE_STATUSES else None
+                limiter.release(response.status_code, retry_after)
+                if response.status_code not in RETRYABLE_STATUSES or attempt >= max_attempts or not idempotent:
+                    return response
+                delay = retry_after if retry_after is not None else backoff_delay(attempt)
+                if delay > HTTP_RETRY_MAX_DELAY or (deadline is not None and time.monotonic() + delay >= deadline):
+                    return response
+                response.close()
+                logger.warning(f"{method} {host} returned {response.status_code}, retry {attempt}/{max_attempts - 1} in {delay:.2f}s")
+
+            limiter.record_retry()
+            UPSTREAM_RETRIES.inc(provider=limiter.name)
+            time.sleep(delay)
+
+    def _send(self, client: httpx.Client, host: str, method: str, url: str, attempt: int = 1,
+              limiter_wait: float = 0.0, **kwargs) -> httpx.Response:
+        # httpcore trace events tell us whether a new connection was opened,
+        # how long the request waited before it could start sending headers,
+        # and when the response headers and body arrived.
+        events: dict[str, float] = {}
+
+        def trace(name: str, info: dict) -> None:
+            events.setdefault(name, time.monotonic())
+
+        extensions = dict(kwargs.pop("extensions", None) or {})
+        extensions["trace"] = trace
+
+        with trace_span("attempt", "client", attempt=attempt, limiter_wait_ms=round(limiter_wait * 1000, 2)) as span:
+            started = time.monotonic()
+            try:
+                response = client.request(method, url, extensions=extensions, **kwargs)
+            except httpx.HTTPError:
+                with self._lock:
+                    self._stats[host]["errors"] += 1
+                raise
+            finally:
+                timings = self._record(host, started, events)
+                if span is not None:
+                    span.set(**timings)
+            if span is not None:
+                span.set(
+                    status_code=response.status_code,
+                    request_bytes=int(response.request.headers.get("content-length", 0)),
+                    response_bytes=response.num_bytes_downloaded,
+                )
+            return response
+
+    def _record(self, host: str, started: float, events: dict[str, float]) -> dict:
+        """Update the host's pool stats from an attempt's trace events; returns its timings in ms."""
+        connect = 0.0
+        new_connection = "connection.connect_tcp.started" in events
+        if new_connection:
+            connect_end = events.get("connection.start_tls.complete") or events.get("connection.connect_tcp.complete")
+            if connect_end:
+                connect = connect_end - events["connection.connect_tcp.started"]
+
+        headers_sent = events.get("http11.send_request_headers.started") or events.get("http2.send_request_headers.started")
+        wait = max((headers_sent - started) - connect, 0.0) if headers_sent else 0.0
+
+        with self._lock:
+            stats = self._stats[host]
+            stats["requests"] += 1
+            stats["new_connections"] += int(new_connection)
+            stats["wait_seconds_total"] += wait
+            stats["wait_seconds_max"] = max(stats["wait_seconds_max"], wait)
+
+        headers_received = events.get("http11.receive_response_headers.complete") or events.get("http2.receive_response_headers.complete")
+        body_received = events.get("http11.receive_response_body.complete") or events.get("http2.receive_response_body.complete")
+        return {
+            "new_connection": new_connection,
+            "pool_wait_ms": round(wait * 1000, 2),
+            "connect_ms": round(connect * 1000, 2),
+            "ttfb_ms": round((headers_received - headers_sent) * 1000, 2) if headers_received and headers_sent else None,
+            "body_ms": round((body_received - headers_received) * 1000, 2) if body_received and headers_received else None,
+            "total_ms": round((time.monotonic() - started) * 1000, 2),
+        }
+
+    def stats(self) -> dict:
+        """Pool statistics per host: open connections, reuse ratio and pool wait time."""
+        report = {}
+        with self._lock:
+            for host, client in self._clients.items():
+                stats = dict(self._stats[host])
+                pool = getattr(getattr(client, "_transport", None), "_pool", None)
+                connections = list(getattr(pool, "connections", []))
+                requests_count = stats["requests"]
+                stats["open_connections"] = sum(1 for c in connections if not c.is_closed())
+                stats["idle_connections"] = sum(1 for c in connections if c.is_idle())
+                stats["reuse_ratio"] = round(1 - stats["new_connections"] / requests_count, 3) if requests_count else 0.0
+                stats["wait_seconds_avg"] = round(stats["wait_seconds_total"] / requests_count, 4) if requests_count else 0.0
+                stats["wait_seconds_total"] = round(stats["wait_seconds_total"], 4)
+                stats["wait_seconds_max"] = round(stats["wait_seconds_max"], 4)
+                report[host] = stats
+        return {
+            "http2": self._http2,
+            "limits": {
+                "max_connections": HTTP_POOL_MAX_CONNECTIONS,
+                "max_keepalive_connections": HTTP_POOL_MAX_KEEPALIVE,
+                "keepalive_expiry": HTTP_KEEPALIVE_EXPIRY,
+                "pool_timeout": HTTP_POOL_TIMEOUT,
+            },
+            "hosts": report,
+            "providers": {name: limiter.stats() for name, limiter in list(_PROVIDER_LIMITERS.items())},
+        }
+
+    def close(self) -> None:
+        """Close every pooled client (called on interpreter shutdown)."""
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.close()
+        if clients:
+            logger.info(f"Closed {len(clients)} pooled HTTP clients")
+
+
+HTTP_POOL = HTTPPool()
+atexit.register(HTTP_POOL.close)
+
+
+# Response cache settings
+CACHE_ENABLED = os.environ.get("CACHE_ENABLED", "true").lower() == "true"
+CACHE_DB_PATH = Path(os.environ.get("CACHE_DB_PATH", str(DATA_DIR / "response-cache.db")))
+CACHE_MEMORY_ENTRIES = int(os.environ.get("CACHE_MEMORY_ENTRIES", "1000"))
+CACHE_MAX_DISK_MB = float(os.environ.get("CACHE_MAX_DISK_MB", "512"))
+# Disk hits refresh accessed_at (the LRU eviction order) in batches of this many, or after this many seconds
+CACHE_TOUCH_BATCH = int(os.environ.get("CACHE_TOUCH_BATCH", "256"))
+CACHE_TOUCH_SECONDS = float(os.environ.get("CACHE_TOUCH_SECONDS", "30"))
+
+# Per-engine TTL (seconds), overridable via CACHE_TTLS='{"gemini": 3600}'
+CACHE_TTLS: dict[str, int] = {
+    "gemini": 6 * 3600,
+    "perplexity": 6 * 3600,
+    "openai": 24 * 3600,
+    "serpapi": 24 * 3600,
+}
+CACHE_TTLS.update(json.loads(os.environ.get("CACHE_TTLS", "{}")))
+
+
+class ResponseCache:
+    """Two-tier (in-memory LRU over SQLite) cache for search/LLM responses."""
+
+    def __init__(self, db_path: Path, memory_entries: int, max_disk_bytes: int):
+        self._memory: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._memory_entries = memory_entries
+        self._max_disk_bytes = max_disk_bytes
+        self._lock = Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+        # accessed_at updates from disk hits not yet written, and when they were last written
+        self._touched: dict[str, float] = {}
+        self._touched_flushed_at = time.monotonic()
+
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(db_path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, engine TEXT NOT NULL, value TEXT NOT NULL, size INTEGER NOT NULL,"
+            " expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        self._db.commit()
+        self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(engine: str, model: str, query: str) -> str:
+        """Cache key from engine, model and the whitespace/case-normalized query."""
+        normalized = " ".join(query.lower().split())
+        return hashlib.sha256(f"{engine}\x00{model}\x00{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, engine: str, model: str, query: str) -> Any | None:
+        key = self.make_key(engine, model, query)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and entry[0] > now:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return entry[1]
+
+            row = self._db.execute("SELECT value, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and row[1] > now:
+                self._touched[key] = now
+                if len(self._touched) >= CACHE_TOUCH_BATCH or time.monotonic() - self._touched_flushed_at >= CACHE_TOUCH_SECONDS:
+                    self._flush_touched()
+                    self._db.commit()
+                value = json.loads(row[0])
+                self._remember(key, row[1], value)
+                self._stats["disk_hits"] += 1
+                return value
+
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, engine: str, model: str, query: str, value: Any) -> None:
+        key = self.make_key(engine, model, query)
+        now = time.time()
+        expires_at = now + CACHE_TTLS.get(engine, 3600)
+        payload = json.dumps(value)
+        with self._lock:
+            self._remember(key, expires_at, value)
+            old = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, engine, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, engine, payload, len(payload), expires_at, now),
+            )
+            self._disk_bytes += len(payload) - (old[0] if old else 0)
+            self._stats["writes"] += 1
+            self._touched.pop(key, None)
+            if self._disk_bytes > self._max_disk_bytes:
+                # Evict by up-to-date access times
+                self._flush_touched()
+                self._evict(now)
+            self._db.commit()
+
+    def flush(self) -> None:
+        """Write pending accessed_at updates."""
+        with self._lock:
+            self._flush_touched()
+            self._db.commit()
+
+    def _flush_touched(self) -> None:
+        if self._touched:
+            self._db.executemany(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?", [(at, key) for key, at in self._touched.items()]
+            )
+            self._touched.clear()
+        self._touched_flushed_at = time.monotonic()
+
+    def _remember(self, key: str, expires_at: float, value: Any) -> None:
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self, now: float) -> None:
+        # Drop expired rows first, then least recently used rows down to 90% of the budget
+        evicted = self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (now,)).rowcount
+        self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        target = self._max_disk_bytes * 0.9
+        while self._disk_bytes > target:
+            rows = self._db.execute("SELECT key, size FROM responses ORDER BY accessed_at LIMIT 100").fetchall()
+            if not rows:
+                break
+            self._db.executemany("DELETE FROM responses WHERE key = ?", [(k,) for k, _ in rows])
+            self._disk_bytes -= sum(size for _, size in rows)
+            evicted += len(rows)
+        self._stats["evictions"] += evicted
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+            stats["hit_ratio"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 3) if lookups else 0.0
+            stats["memory_entries"] = len(self._memory)
+            stats["disk_bytes"] = self._disk_bytes
+            return stats
+
+
+RESPONSE_CACHE = ResponseCache(CACHE_DB_PATH, CACHE_MEMORY_ENTRIES, int(CACHE_MAX_DISK_MB * 1024 * 1024)) if CACHE_ENABLED else None
+if RESPONSE_CACHE is not None:
+    atexit.register(RESPONSE_CACHE.flush)
+
+
+def cached_call(engine: str, model: str, query: str, fn, *args, cache_mode: str = "use", **kwargs):
+    """Return fn(*args, **kwargs) through the response cache.
+
+    cache_mode: "use" (default), "refresh" (skip lookup but store the fresh
+    response) or "off" (bypass the cache entirely). Error responses are never cached.
+    """
+    with trace_span(engine, model=model, cache_mode=cache_mode) as span:
+        if RESPONSE_CACHE is None or cache_mode == "off":
+            return fn(*args, **kwargs)
+
+        if cache_mode != "refresh":
+            cached = RESPONSE_CACHE.get(engine, model, query)
+            if cached is not None:
+                logger.info(f"Cache hit for {engine} query: {query}")
+                if span is not None:
+                    span.set(cache_hit=True)
+                return cached
+
+        value = fn(*args, **kwargs)
+        if not (isinstance(value, dict) and value.get("error")):
+            RESPONSE_CACHE.put(engine, model, query, value)
+        return value
+
+
+# Run store settings
+RUN_STORE_BACKEND = os.environ.get("RUN_STORE_BACKEND", "sqlite")
+RUN_STORE_PATH = Path(os.environ.get("RUN_STORE_PATH", str(DATA_DIR / "runs.db")))
+RUN_RETENTION_DAYS = float(os.environ.get("RUN_RETENTION_DAYS", "7"))
+RUN_STORE_MAX_RUNS = int(os.environ.get("RUN_STORE_MAX_RUNS", "100000"))
+RUN_STORE_EVICT_EVERY = 100
+# "local" executes runs on this process's scheduler; "queue" enqueues them in the shared job queue
+# for `workflow_runner.py worker` processes (needs the sqlite run store on storage they all share)
+RUNNER_MODE = os.environ.get("RUNNER_MODE", "local").lower()
+
+FINISHED_STATUSES = ("completed", "failed")
+# Suspended at a callback step: persisted, holding no thread, until POST /runs/<id>/callback or expiry
+WAITING_STATUS = "waiting"
+
+
+class MemoryRunStore:
+    """Run store that keeps runs in process memory, bounded by the retention policy."""
+
+    def __init__(self):
+        self._runs: dict[str, dict] = {}
+        self._traces: dict[str, dict] = {}
+        self._batches: dict[str, dict] = {}
+        self._lock = Lock()
+        self._released = 0
+
+    def put(self, run: dict, live: bool = True) -> None:
+        """Register a new run; the same dict is handed to the executor and mutated in place.
+
+        live=False only persists it, for runs executed by another process (ignored in memory).
+        """
+        with self._lock:
+            self._runs[run["run_id"]] = run
+
+    def put_many(self, runs: list[dict]) -> None:
+        """Persist runs that are not executing yet (batch items awaiting the feeder)."""
+        with self._lock:
+            for run in runs:
+                self._runs[run["run_id"]] = run
+
+    def put_batch(self, batch: dict) -> None:
+        with self._lock:
+            self._batches[batch["batch_id"]] = batch
+
+    def get_batch(self, batch_id: str) -> dict | None:
+        return self._batches.get(batch_id)
+
+    def batch_counts(self, batch_id: str) -> dict:
+        """Run count and latest completion time per status of a batch's runs."""
+        counts = {}
+        with self._lock:
+            for run in self._runs.values():
+                if run.get("batch_id") == batch_id:
+                    entry = counts.setdefault(run.get("status"), {"runs": 0, "last_completed_at": None})
+                    entry["runs"] += 1
+                    entry["last_completed_at"] = max(
+                        filter(None, (entry["last_completed_at"], run.get("completed_at"))), default=None
+                    )
+        return counts
+
+    def live(self, run_id: str) -> dict:
+        """The mutable run dict of an active run."""
+        return self._runs[run_id]
+
+    def get(self, run_id: str) -> dict | None:
+        """Run metadata (status, step, timestamps...) without loading the result payload."""
+        return self._runs.get(run_id)
+
+    def get_result(self, run_id: str) -> Any:
+        run = self._runs.get(run_id)
+        return run.get("result") if run else None
+
+    def save(self, run_id: str) -> None:
+        """Persist the current state of an active run (no-op in memory)."""
+
+    def release(self, run_id: str) -> None:
+        """Called once a run has finished executing."""
+        self.save(run_id)
+        with self._lock:
+            self._released += 1
+            evict = self._released % RUN_STORE_EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def amend(self, run_id: str, fields: dict, result: Any = None) -> None:
+        """Update a run after it has finished executing (e.g. with results that arrived late)."""
+        with self._lock:
+            run = self._runs.get(run_id)
+            if run is not None:
+                run.update(fields, updated_at=datetime.utcnow().isoformat())
+                if result is not None:
+                    run["result"] = result
+
+    def disown(self, run_id: str) -> None:
+        """Stop tracking an executing run whose job lease passed to another worker; nothing its
+        executor does from here on is persisted."""
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+        if isinstance(run, LiveRun):
+            run.detached = True
+
+    def transition(self, run_id: str, expected: str, status: str) -> bool:
+        """Atomically move a run from one status to another; False if it was not in the expected status."""
+        with self._lock:
+            run = self._runs.get(run_id)
+            if run is None or run.get("status") != expected:
+                return False
+            run["status"] = status
+            return True
+
+    def count(self, tenant_id: str | None = None, flow_id: str | None = None, status: str | None = None) -> int:
+        return len(self.list(tenant_id, flow_id, status, limit=len(self._runs)))
+
+    def waiting_expired(self, now: str) -> list[str]:
+        """Waiting runs whose earliest callback deadline is at or before now (ISO timestamp)."""
+        with self._lock:
+            return [
+                run_id for run_id, run in self._runs.items()
+                if run.get("status") == WAITING_STATUS and (run.get("expires_at") or now) <= now
+            ]
+
+    def put_trace(self, run_id: str, trace: dict) -> None:
+        """Store a finished run's exported trace."""
+        with self._lock:
+            self._traces[run_id] = trace
+
+    def get_trace(self, run_id: str) -> dict | None:
+        run = self._runs.get(run_id)
+        if isinstance(run, LiveRun) and run.trace is not None and run_id not in self._traces:
+            return run.trace.export()
+        return self._traces.get(run_id)
+
+    def delete(self, run_id: str) -> None:
+        with self._lock:
+            self._runs.pop(run_id, None)
+            self._traces.pop(run_id, None)
+
+    def queued_batch_runs(self) -> list[dict]:
+        """Batch items persisted as queued but not yet handed to execution."""
+        with self._lock:
+            return [run for run in self._runs.values() if run.get("batch_id") and run.get("status") == "queued"]
+
+    def find_by_fingerprint(self, fingerprint: str) -> dict | None:
+        """The newest run (not alias) deduplicated under fingerprint.
+
+        A memory store is private to its process, whose RunCoalescer index already covers it.
+        """
+        return None
+
+    def list(self, tenant_id: str | None = None, flow_id: str | None = None, status: str | None = None,
+             limit: int = 100, offset: int = 0, batch_id: str | None = None) -> list[dict]:
+        with self._lock:
+            runs = [
+                run for run in self._runs.values()
+                if (tenant_id is None or run.get("tenant_id") == tenant_id)
+                and (flow_id is None or run.get("flow_id") == flow_id)
+                and (status is None or run.get("status") == status)
+                and (batch_id is None or run.get("batch_id") == batch_id)
+            ]
+        runs.sort(key=lambda run: run["created_at"], reverse=True)
+        return runs[offset:offset + limit]
+
+    def evict(self) -> int:
+        """Drop finished runs past RUN_RETENTION_DAYS, then the oldest beyond RUN_STORE_MAX_RUNS."""
+        cutoff = (datetime.utcnow() - timedelta(days=RUN_RETENTION_DAYS)).isoformat()
+        with self._lock:
+            finished = sorted(
+                (run for run in self._runs.values() if run.get("status") in FINISHED_STATUSES),
+                key=lambda run: run["created_at"],
+            )
+            excess = max(len(self._runs) - RUN_STORE_MAX_RUNS, 0)
+            doomed = [run["run_id"] for i, run in enumerate(finished) if i < excess or run["created_at"] < cutoff]
+            for run_id in doomed:
+                del self._runs[run_id]
+                self._traces.pop(run_id, None)
+            for batch_id in [b for b, batch in self._batches.items() if batch["created_at"] < cutoff]:
+                del self._batches[batch_id]
+        if doomed:
+            logger.info(f"Evicted {len(doomed)} finished runs from the run store")
+        return len(doomed)
+
+
+class SQLiteRunStore(MemoryRunStore):
+    """Durable run store on SQLite (WAL).
+
+    Only active runs are held in memory. Finished runs are written to the
+    database and dropped from memory; their result payload lives in a
+    separate table and is only read when a caller asks for it.
+    """
+
+    INDEXED_COLUMNS = ("run_id", "tenant_id", "flow_id", "status", "current_step", "created_at", "completed_at", "batch_id")
+
+    def __init__(self, db_path: Path, recover_interrupted: bool = True):
+        super().__init__()
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(db_path), check_same_thread=False)
+        self._db_lock = Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            " run_id TEXT PRIMARY KEY, tenant_id TEXT, flow_id TEXT, status TEXT, current_step TEXT,"
+            " created_at TEXT, completed_at TEXT, batch_id TEXT, data TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS runs_tenant ON runs (tenant_id, created_at);"
+            "CREATE INDEX IF NOT EXISTS runs_flow ON runs (flow_id, created_at);"
+            "CREATE INDEX IF NOT EXISTS runs_status ON runs (status, created_at);"
+            "CREATE INDEX IF NOT EXISTS runs_created ON runs (created_at);"
+            "CREATE TABLE IF NOT EXISTS run_results (run_id TEXT PRIMARY KEY, result TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS run_traces (run_id TEXT PRIMARY KEY, trace TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS batches (batch_id TEXT PRIMARY KEY, created_at TEXT, data TEXT NOT NULL);"
+        )
+        # Stores created before batches carry batch_id only inside data
+        if "batch_id" not in {row[1] for row in self._db.execute("PRAGMA table_info(runs)")}:
+            self._db.execute("ALTER TABLE runs ADD COLUMN batch_id TEXT")
+            self._db.execute("UPDATE runs SET batch_id = json_extract(data, '$.batch_id')")
+        self._db.execute("CREATE INDEX IF NOT EXISTS runs_batch ON runs (batch_id, status)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS runs_fingerprint ON runs (json_extract(data, '$.fingerprint'), created_at)"
+            " WHERE json_extract(data, '$.fingerprint') IS NOT NULL"
+        )
+        self._db.commit()
+        if not recover_interrupted:
+            # Shared with other processes: in-flight runs belong to them (and to the job queue's leases)
+            return
+        # Runs that were in flight when the previous process stopped will never finish
+        # (waiting runs hold no execution state, and batch items still queued are fed again by resume_batches)
+        interrupted = self._db.execute(
+            "UPDATE runs SET status = 'failed', current_step = NULL,"
+            " data = json_set(data, '$.error', 'Interrupted by runner restart')"
+            " WHERE status NOT IN ('completed', 'failed', 'waiting') AND NOT (status = 'queued' AND batch_id IS NOT NULL)"
+        ).rowcount
+        self._db.commit()
+        if interrupted:
+            logger.warning(f"Marked {interrupted} runs interrupted by restart as failed")
+
+    _INSERT_RUN = (
+        f"INSERT OR REPLACE INTO runs ({', '.join(INDEXED_COLUMNS)}, data)"
+        f" VALUES ({', '.join('?' * (len(INDEXED_COLUMNS) + 1))})"
+    )
+
+    def _row(self, run: dict) -> tuple:
+        data = {key: value for key, value in run.items() if key not in self.INDEXED_COLUMNS and key != "result"}
+        return (*(run.get(column) for column in self.INDEXED_COLUMNS), json.dumps(data, default=str))
+
+    # Writes by a queue worker only land while the stored run still names that worker and attempt
+    # (fencing off a worker that kept executing after its lease was reclaimed)
+    _UPSERT_OWNED_RUN = (
+        f"INSERT INTO runs ({', '.join(INDEXED_COLUMNS)}, data)"
+        f" VALUES ({', '.join('?' * (len(INDEXED_COLUMNS) + 1))})"
+        f" ON CONFLICT (run_id) DO UPDATE SET"
+        f" {', '.join(f'{column} = excluded.{column}' for column in INDEXED_COLUMNS[1:])}, data = excluded.data"
+        " WHERE json_extract(runs.data, '$.worker') IS json_extract(excluded.data, '$.worker')"
+        " AND json_extract(runs.data, '$.attempt') IS json_extract(excluded.data, '$.attempt')"
+    )
+
+    def _write(self, run: dict, include_result: bool, owned: bool = False) -> bool:
+        """Persist a run; with owned, only if the worker executing it still owns it (False if not)."""
+        with self._db_lock:
+            if owned and run.get("worker"):
+                if not self._db.execute(self._UPSERT_OWNED_RUN, self._row(run)).rowcount:
+                    self._db.commit()
+                    return False
+            else:
+                self._db.execute(self._INSERT_RUN, self._row(run))
+            if include_result and run.get("result") is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO run_results (run_id, result) VALUES (?, ?)",
+                    (run["run_id"], json.dumps(run["result"], default=str)),
+                )
+            self._db.commit()
+        return True
+
+    @classmethod
+    def _from_row(cls, row: tuple) -> dict:
+        run = dict(zip(cls.INDEXED_COLUMNS, row[:-1]))
+        run.update(json.loads(row[-1]))
+        return run
+
+    def put(self, run: dict, live: bool = True) -> None:
+        if live:
+            super().put(run)
+        self._write(run, include_result=False)
+
+    def put_many(self, runs: list[dict]) -> None:
+        rows = [self._row(run) for run in runs]
+        with self._db_lock:
+            self._db.executemany(self._INSERT_RUN, rows)
+            self._db.commit()
+
+    def put_batch(self, batch: dict) -> None:
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO batches (batch_id, created_at, data) VALUES (?, ?, ?)",
+                (batch["batch_id"], batch["created_at"], json.dumps(batch, default=str)),
+            )
+            self._db.commit()
+
+    def get_batch(self, batch_id: str) -> dict | None:
+        with self._db_lock:
+            row = self._db.execute("SELECT data FROM batches WHERE batch_id = ?", (batch_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def batch_counts(self, batch_id: str) -> dict:
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT status, COUNT(*), MAX(completed_at) FROM runs WHERE batch_id = ? GROUP BY status", (batch_id,)
+            ).fetchall()
+        counts = {status: {"runs": runs, "last_completed_at": completed_at} for status, runs, completed_at in rows}
+        # Live runs may be ahead of their last persisted status
+        with self._lock:
+            live = {run_id: run.get("status") for run_id, run in self._runs.items() if run.get("batch_id") == batch_id}
+        if live:
+            with self._db_lock:
+                persisted = self._db.execute(
+                    f"SELECT run_id, status FROM runs WHERE run_id IN ({', '.join('?' * len(live))})", tuple(live)
+                ).fetchall()
+            for run_id, status in persisted:
+                if live[run_id] != status and status in counts:
+                    counts[status]["runs"] -= 1
+                    counts.setdefault(live[run_id], {"runs": 0, "last_completed_at": None})["runs"] += 1
+        return {status: entry for status, entry in counts.items() if entry["runs"]}
+
+    def get(self, run_id: str) -> dict | None:
+        run = self._runs.get(run_id)
+        if run is not None:
+            return run
+        with self._db_lock:
+            row = self._db.execute(
+                f"SELECT {', '.join(self.INDEXED_COLUMNS)}, data FROM runs WHERE run_id = ?", (run_id,)
+            ).fetchone()
+        return self._from_row(row) if row else None
+
+    def get_result(self, run_id: str) -> Any:
+        run = self._runs.get(run_id)
+        if run is not None:
+            return run.get("result")
+        with self._db_lock:
+            row = self._db.execute("SELECT result FROM run_results WHERE run_id = ?", (run_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, run_id: str) -> None:
+        run = self._runs.get(run_id)
+        if run is not None and not self._write(run, include_result=run.get("status") in FINISHED_STATUSES, owned=True):
+            logger.warning(f"Run {run_id} was reclaimed from worker {run.get('worker')}; discarding its copy")
+            self.disown(run_id)
+
+    def release(self, run_id: str) -> None:
+        super().release(run_id)
+        with self._lock:
+            self._runs.pop(run_id, None)
+
+    def amend(self, run_id: str, fields: dict, result: Any = None) -> None:
+        with self._lock:
+            run = self._runs.get(run_id)
+        live = run is not None
+        if not live:
+            run = self.get(run_id)
+            if run is None:
+                return
+            if result is None:
+                result = self.get_result(run_id)
+        run.update(fields, updated_at=datetime.utcnow().isoformat())
+        if result is not None:
+            run["result"] = result
+        if not self._write(run, include_result=True, owned=live):
+            logger.warning(f"Run {run_id} was reclaimed from worker {run.get('worker')}; discarding its copy")
+            self.disown(run_id)
+
+    def transition(self, run_id: str, expected: str, status: str) -> bool:
+        if run_id in self._runs:
+            return super().transition(run_id, expected, status)
+        # The conditional update is atomic across every process sharing the database
+        with self._db_lock:
+            moved = self._db.execute(
+                "UPDATE runs SET status = ? WHERE run_id = ? AND status = ?", (status, run_id, expected)
+            ).rowcount
+            self._db.commit()
+        return bool(moved)
+
+    def count(self, tenant_id: str | None = None, flow_id: str | None = None, status: str | None = None) -> int:
+        clauses, params = [], []
+        for column, value in (("tenant_id", tenant_id), ("flow_id", flow_id), ("status", status)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._db_lock:
+            return self._db.execute(f"SELECT COUNT(*) FROM runs {where}", params).fetchone()[0]
+
+    def waiting_expired(self, now: str) -> list[str]:
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT run_id FROM runs WHERE status = 'waiting' AND json_extract(data, '$.expires_at') <= ?", (now,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def put_trace(self, run_id: str, trace: dict) -> None:
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO run_traces (run_id, trace) VALUES (?, ?)", (run_id, json.dumps(trace, default=str))
+            )
+            self._db.commit()
+
+    def get_trace(self, run_id: str) -> dict | None:
+        run = self._runs.get(run_id)
+        if isinstance(run, LiveRun) and run.trace is not None:
+            return run.trace.export()
+        with self._db_lock:
+            row = self._db.execute("SELECT trace FROM run_traces WHERE run_id = ?", (run_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def delete(self, run_id: str) -> None:
+        super().delete(run_id)
+        with self._db_lock:
+            self._db.execute("DELETE FROM runs WHERE run_id = ?", (run_id,))
+            self._db.execute("DELETE FROM run_results WHERE run_id = ?", (run_id,))
+            self._db.execute("DELETE FROM run_traces WHERE run_id = ?", (run_id,))
+            self._db.commit()
+
+    def queued_batch_runs(self) -> list[dict]:
+        with self._db_lock:
+            rows = self._db.execute(
+                f"SELECT {', '.join(self.INDEXED_COLUMNS)}, data FROM runs WHERE batch_id IS NOT NULL AND status = 'queued'"
+            ).fetchall()
+        return [self._runs.get(row[0]) or self._from_row(row) for row in rows]
+
+    def find_by_fingerprint(self, fingerprint: str) -> dict | None:
+        with self._db_lock:
+            row = self._db.execute(
+                f"SELECT {', '.join(self.INDEXED_COLUMNS)}, data FROM runs"
+                " WHERE json_extract(data, '$.fingerprint') = ? AND json_extract(data, '$.alias_of') IS NULL"
+                " ORDER BY created_at DESC LIMIT 1",
+                (fingerprint,),
+            ).fetchone()
+        return (self._runs.get(row[0]) or self._from_row(row)) if row else None
+
+    def list(self, tenant_id: str | None = None, flow_id: str | None = None, status: str | None = None,
+             limit: int = 100, offset: int = 0, batch_id: str | None = None) -> list[dict]:
+        clauses, params = [], []
+        for column, value in (("tenant_id", tenant_id), ("flow_id", flow_id), ("status", status), ("batch_id", batch_id)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._db_lock:
+            rows = self._db.execute(
+                f"SELECT {', '.join(self.INDEXED_COLUMNS)}, data FROM runs {where} ORDER BY created_at DESC, run_id DESC LIMIT ? OFFSET ?",
+                (*params, limit, offset),
+            ).fetchall()
+        # Live runs carry fresher state than their last persisted snapshot
+        return [self._runs.get(row[0]) or self._from_row(row) for row in rows]
+
+    def evict(self) -> int:
+        cutoff = (datetime.utcnow() - timedelta(days=RUN_RETENTION_DAYS)).isoformat()
+        with self._db_lock:
+            evicted = self._db.execute(
+                "DELETE FROM runs WHERE status IN ('completed', 'failed') AND (created_at < ? OR run_id IN ("
+                " SELECT run_id FROM runs WHERE status IN ('completed', 'failed') ORDER BY created_at DESC LIMIT -1 OFFSET ?))",
+                (cutoff, RUN_STORE_MAX_RUNS),
+            ).rowcount
+            self._db.execute("DELETE FROM run_results WHERE run_id NOT IN (SELECT run_id FROM runs)")
+            self._db.execute("DELETE FROM run_traces WHERE run_id NOT IN (SELECT run_id FROM runs)")
+            self._db.execute(
+                "DELETE FROM batches WHERE created_at < ? AND batch_id NOT IN"
+                " (SELECT batch_id FROM runs WHERE batch_id IS NOT NULL)",
+                (cutoff,),
+            )
+            self._db.commit()
+        if evicted:
+            logger.info(f"Evicted {evicted} finished runs from the run store")
+        return evicted
+
+
+if RUNNER_MODE == "queue" and RUN_STORE_BACKEND != "sqlite":
+    logger.warning("RUNNER_MODE=queue requires RUN_STORE_BACKEND=sqlite, executing runs locally")
+    RUNNER_MODE = "local"
+RUN_STORE: MemoryRunStore = (
+    SQLiteRunStore(RUN_STORE_PATH, recover_interrupted=RUNNER_MODE == "local")
+    if RUN_STORE_BACKEND == "sqlite" else MemoryRunStore()
+)
+RUN_STORE.evict()
+
+
+# Run event stream settings
+RUN_EVENT_HISTORY = int(os.environ.get("RUN_EVENT_HISTORY", "256"))
+# How long a finished run's events stay replayable for late or reconnecting subscribers
+RUN_EVENT_RETENTION_SECONDS = float(os.environ.get("RUN_EVENT_RETENTION_SECONDS", "300"))
+RUN_EVENT_SUBSCRIBER_QUEUE = int(os.environ.get("RUN_EVENT_SUBSCRIBER_QUEUE", "1000"))
+RUN_EVENT_HEARTBEAT_SECONDS = float(os.environ.get("RUN_EVENT_HEARTBEAT_SECONDS", "15"))
+TERMINAL_EVENTS = ("completed", "failed")
+
+
+class EventSubscription:
+    """A subscriber's bounded queue of events matching its filter."""
+
+    def __init__(self, match):
+        self.match = match
+        self.queue: queue.Queue = queue.Queue(maxsize=RUN_EVENT_SUBSCRIBER_QUEUE)
+        self.dropped = 0
+
+
+class RunEventBus:
+    """In-process pub/sub of run events, with a short per-run history for replay."""
+
+    def __init__(self):
+        self._history: dict[str, deque] = {}
+        self._finished: dict[str, float] = {}
+        self._subscribers: list[EventSubscription] = []
+        self._lock = Lock()
+        self._sequence = 0
+
+    def publish(self, run: dict, event_type: str, data: dict | None = None) -> None:
+        """Publish an event for a run to its history and every matching subscriber."""
+        run_id = run["run_id"]
+        with self._lock:
+            self._sequence += 1
+            event = {
+                "id": self._sequence,
+                "type": event_type,
+                "run_id": run_id,
+                "flow_id": run.get("flow_id"),
+                "tenant_id": run.get("tenant_id"),
+                "batch_id": run.get("batch_id"),
+                "at": datetime.utcnow().isoformat(),
+                "data": data or {},
+            }
+            history = self._history.get(run_id)
+            if history is None:
+                history = self._history[run_id] = deque(maxlen=RUN_EVENT_HISTORY)
+            history.append(event)
+            if event_type in TERMINAL_EVENTS:
+                self._finished[run_id] = time.monotonic()
+            if self._sequence % 100 == 0:
+                self._expire()
+            subscribers = list(self._subscribers)
+
+        for subscription in subscribers:
+            if subscription.match(event):
+                try:
+                    subscription.queue.put_nowait(event)
+                except queue.Full:
+                    subscription.dropped += 1
+
+    def _expire(self) -> None:
+        cutoff = time.monotonic() - RUN_EVENT_RETENTION_SECONDS
+        for run_id in [run_id for run_id, finished in self._finished.items() if finished < cutoff]:
+            self._finished.pop(run_id)
+            self._history.pop(run_id, None)
+
+    def history(self, run_id: str) -> list[dict]:
+        with self._lock:
+            return list(self._history.get(run_id, ()))
+
+    def subscribe(self, match) -> EventSubscription:
+        subscription = EventSubscription(match)
+        with self._lock:
+            self._subscribers.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: EventSubscription) -> None:
+        with self._lock:
+            if subscription in self._subscribers:
+                self._subscribers.remove(subscription)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "subscribers": len(self._subscribers),
+                "runs_with_history": len(self._history),
+                "events_published": self._sequence,
+            }
+
+
+EVENT_BUS = RunEventBus()
+
+
+class LiveRun(dict):
+    """Run dict that publishes status and step transitions to EVENT_BUS as executors update it.
+
+    current_step may hold several comma-separated steps (spec workflows run
+    steps concurrently); each one gets its own step_started/step_finished pair.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._step_started: dict[str, float] = {}
+        self.trace: RunTrace | None = None
+        # Set when its job lease was lost (RUN_STORE.disown): another worker owns the run now
+        self.detached = False
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        previous = self.get(key)
+        super().__setitem__(key, value)
+        if value == previous:
+            return
+        if key == "current_step":
+            self._steps_changed(previous, value)
+        elif key == "status" and value not in FINISHED_STATUSES:
+            EVENT_BUS.publish(self, "status", {"status": value, "previous": previous})
+
+    def _steps_changed(self, previous: str | None, current: str | None) -> None:
+        before = previous.split(", ") if previous else []
+        after = current.split(", ") if current else []
+        now = time.monotonic()
+        if self.trace is not None:
+            for step in before:
+                if step not in after:
+                    self.trace.end_step(step, "error" if self.get("status") == "failed" else "ok")
+            # Work done by the executor from here on nests under its (single) current step
+            step_span = self.trace.step_span(after[0]) if len(after) == 1 else None
+            _CURRENT_SPAN.set(step_span or self.trace.root)
+        for step in before:
+            if step not in after:
+                started = self._step_started.pop(step, now)
+                STEP_DURATION.observe(now - started, flow_id=self.get("flow_id"), step=step,
+                                      outcome="failed" if self.get("status") == "failed" else "ok")
+                EVENT_BUS.publish(self, "step_finished", {
+                    "step": step,
+                    "duration_ms": round((now - started) * 1000, 1),
+                    "failed": self.get("status") == "failed",
+                })
+        for step in after:
+            if step not in before:
+                self._step_started[step] = now
+                EVENT_BUS.publish(self, "step_started", {"step": step})
+
+
+def record_run_metrics(run: dict) -> None:
+    """Count a finished run and observe its duration, closing steps a failed run left open."""
+    flow_id = run.get("flow_id")
+    status = run.get("status")
+    if isinstance(run, LiveRun):
+        now = time.monotonic()
+        for step, started in run._step_started.items():
+            STEP_DURATION.observe(now - started, flow_id=flow_id, step=step, outcome="failed")
+        run._step_started.clear()
+    RUNS_FINISHED.inc(flow_id=flow_id, status=status)
+    if run.get("started_at"):
+        duration = (datetime.utcnow() - datetime.fromisoformat(run["started_at"])).total_seconds()
+        RUN_DURATION.observe(duration, flow_id=flow_id, status=status)
+
+
+def publish_run_finished(run: dict) -> None:
+    """Publish a run's terminal event (completed with its result, or failed with its error)."""
+    started = run.get("started_at")
+    duration_ms = None
+    if started:
+        duration_ms = round((datetime.utcnow() - datetime.fromisoformat(started)).total_seconds() * 1000, 1)
+    if run.get("status") == "completed":
+        EVENT_BUS.publish(run, "completed", {"result": run.get("result"), "duration_ms": duration_ms})
+    else:
+        EVENT_BUS.publish(run, "failed", {
+            "error": run.get("error") or f"Run ended with status {run.get('status')}",
+            "step": run.get("current_step"),
+            "duration_ms": duration_ms,
+        })
+
+
+def format_sse(event: dict) -> str:
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+
+
+# Result sink settings
+# jsonl (gzip-compressed JSON lines), parquet (requires pyarrow) or none
+RESULT_SINK_FORMAT = os.environ.get("RESULT_SINK_FORMAT", "jsonl").lower()
+# Outside OUTPUT_DIR, so partial datasets cannot be downloaded through /output
+RESULT_SINK_DIR = Path(os.environ.get("RESULT_SINK_DIR", str(DATA_DIR / "datasets")))
+# A partition file is closed and a new one started after this many rows or seconds, or when the day changes
+RESULT_SINK_ROTATE_ROWS = int(os.environ.get("RESULT_SINK_ROTATE_ROWS", "100000"))
+RESULT_SINK_ROTATE_SECONDS = float(os.environ.get("RESULT_SINK_ROTATE_SECONDS", "900"))
+# How often open part files are flushed and checked for rotation, even when no records arrive
+RESULT_SINK_CHECK_SECONDS = float(os.environ.get("RESULT_SINK_CHECK_SECONDS", "60"))
+RESULT_SINK_GZIP_LEVEL = int(os.environ.get("RESULT_SINK_GZIP_LEVEL", "6"))
+RESULT_SINK_PARQUET_COMPRESSION = os.environ.get("RESULT_SINK_PARQUET_COMPRESSION", "zstd")
+RESULT_SINK_PARQUET_ROW_GROUP = int(os.environ.get("RESULT_SINK_PARQUET_ROW_GROUP", "5000"))
+
+
+class JSONLPartFile:
+    """Gzip-compressed JSON lines part file."""
+
+    suffix = ".jsonl.gz"
+
+    def __init__(self, path: Path):
+        self._file = gzip.open(path, "wt", encoding="utf-8", compresslevel=RESULT_SINK_GZIP_LEVEL)
+
+    def write(self, records: list[dict]) -> None:
+        for record in records:
+            self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class ParquetPartFile:
+    """Parquet part file written in row groups; nested values are stored as JSON strings."""
+
+    suffix = ".parquet"
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._writer = None
+        self._buffer: list[dict] = []
+
+    def write(self, records: list[dict]) -> None:
+        self._buffer.extend(
+            {key: json.dumps(value, default=str) if isinstance(value, (dict, list)) else value for key, value in record.items()}
+            for record in records
+        )
+        if len(self._buffer) >= RESULT_SINK_PARQUET_ROW_GROUP:
+            self._flush()
+
+    def flush(self) -> None:
+        # Buffered rows stay buffered: flushing them would write tiny row groups
+        pass
+
+    def _flush(self) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if not self._buffer:
+            return
+        if self._writer is None:
+            table = pa.Table.from_pylist(self._buffer)
+            # Columns that were all null in the first row group are typed as strings
+            schema = pa.schema([
+                pa.field(field.name, pa.string()) if pa.types.is_null(field.type) else field for field in table.schema
+            ])
+            self._writer = pq.ParquetWriter(str(self.path), schema, compression=RESULT_SINK_PARQUET_COMPRESSION)
+        # Later rows follow the first row group's schema; keys not in it are dropped
+        self._writer.write_table(pa.Table.from_pylist(self._buffer, schema=self._writer.schema))
+        self._buffer = []
+
+    def close(self) -> None:
+        self._flush()
+        if self._writer is not None:
+            self._writer.close()
+
+
+class ResultSink:
+    """Append-only dataset writer, partitioned by dataset, flow_id and date.
+
+    Records from all runs in the process are appended to one open part file
+    per partition, laid out as <dataset>/flow_id=<flow>/date=<YYYY-MM-DD>/.
+    Part files are written under a hidden in-progress name and renamed into
+    place when rotated or closed, so readers only ever see complete files.
+    File names carry the process ID, so several runner processes can write
+    to the same dataset directory without sharing files. A background thread
+    rotates and flushes parts of idle partitions every RESULT_SINK_CHECK_SECONDS.
+    """
+
+    def __init__(self, directory: Path, fmt: str):
+        self.directory = directory
+        self.part_class = ParquetPartFile if fmt == "parquet" else JSONLPartFile
+        self.format = "parquet" if fmt == "parquet" else "jsonl"
+        self._parts: dict[tuple[str, str, str], dict] = {}
+        self._lock = Lock()
+        self._sequence = 0
+        self._thread: Thread | None = None
+        self.rows_written = 0
+        self.files_written = 0
+
+    def _open_part(self, dataset: str, flow_id: str, date: str) -> dict:
+        partition = self.directory / dataset / f"flow_id={flow_id}" / f"date={date}"
+        partition.mkdir(parents=True, exist_ok=True)
+        self._sequence += 1
+        name = f"part-{datetime.utcnow():%Y%m%dT%H%M%S}-{os.getpid()}-{self._sequence:05d}{self.part_class.suffix}"
+        tmp_path = partition / f".{name}.inprogress"
+        return {
+            "file": self.part_class(tmp_path),
+            "tmp_path": tmp_path,
+            "path": partition / name,
+            "rows": 0,
+            "opened_at": time.monotonic(),
+        }
+
+    def _finalize(self, key: tuple) -> None:
+        part = self._parts.pop(key)
+        try:
+            part["file"].close()
+            if part["tmp_path"].exists():
+                os.replace(part["tmp_path"], part["path"])
+                self.files_written += 1
+        except Exception as e:
+            logger.error(f"Failed to finalize result part {part['path']}: {e}")
+
+    def write(self, dataset: str, flow_id: str, records: list[dict]) -> None:
+        """Append records to the current part file of their partition."""
+        if not records:
+            return
+        flow_id = re.sub(r"[^A-Za-z0-9_.-]", "_", flow_id or "unknown")
+        key = (dataset, flow_id, datetime.utcnow().strftime("%Y-%m-%d"))
+        with self._lock:
+            self._rotate(key[2])
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="result-sink", daemon=True)
+                self._thread.start()
+            part = self._parts.get(key)
+            if part is None:
+                part = self._parts[key] = self._open_part(*key)
+            part["file"].write(records)
+            part["rows"] += len(records)
+            self.rows_written += len(records)
+
+    def _rotate(self, today: str) -> None:
+        """Finalize parts that are full, too old, or belong to a previous day (caller holds the lock)."""
+        now = time.monotonic()
+        for key, part in list(self._parts.items()):
+            if (part["rows"] >= RESULT_SINK_ROTATE_ROWS or now - part["opened_at"] >= RESULT_SINK_ROTATE_SECONDS
+                    or key[2] != today):
+                self._finalize(key)
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(RESULT_SINK_CHECK_SECONDS)
+            with self._lock:
+                try:
+                    self._rotate(datetime.utcnow().strftime("%Y-%m-%d"))
+                    for part in self._parts.values():
+                        part["file"].flush()
+                except Exception as e:
+                    logger.error(f"Result sink rotation failed: {e}")
+
+    def close(self) -> None:
+        """Finalize all open part files."""
+        with self._lock:
+            for key in list(self._parts):
+                self._finalize(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "format": self.format,
+                "directory": str(self.directory),
+                "rows_written": self.rows_written,
+                "files_written": self.files_written,
+                "open_partitions": [
+                    {"dataset": key[0], "flow_id": key[1], "date": key[2], "rows": part["rows"]}
+                    for key, part in self._parts.items()
+                ],
+            }
+
+
+def _create_result_sink() -> ResultSink | None:
+    if RESULT_SINK_FORMAT == "none":
+        return None
+    fmt = RESULT_SINK_FORMAT
+    if fmt == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            logger.warning("RESULT_SINK_FORMAT is parquet but the 'pyarrow' package is not installed; using jsonl")
+            fmt = "jsonl"
+    elif fmt != "jsonl":
+        logger.warning(f"Unknown RESULT_SINK_FORMAT {RESULT_SINK_FORMAT!r}; using jsonl")
+        fmt = "jsonl"
+    return ResultSink(RESULT_SINK_DIR, fmt)
+
+
+RESULT_SINK = _create_result_sink()
+if RESULT_SINK is not None:
+    atexit.register(RESULT_SINK.close)
+
+
+def sink_records(dataset: str, flow_id: str, run_id: str, records: list[dict]) -> None:
+    """Append a run's records to the result sink; sink failures are logged, never fail the run."""
+    if RESULT_SINK is None:
+        return
+    recorded_at = datetime.utcnow().isoformat()
+    try:
+        RESULT_SINK.write(dataset, flow_id, [{"run_id": run_id, "recorded_at": recorded_at, **record} for record in records])
+    except Exception as e:
+        logger.error(f"Result sink write to {dataset} failed: {e}")
 
 
-def fetch_trustana_product(api_key: str) -> dict:
-    """Fetch first product from Trustana API."""
-    logger.info("Fetching product from Trustana...")
+# Trustana search field used to filter products by ID (the AEO input's product_id is the SKU)
+TRUSTANA_ID_FIELD = os.environ.get("TRUSTANA_ID_FIELD", "skuId")
+# Page size and read-ahead depth for streaming catalog iteration
+TRUSTANA_PAGE_SIZE = int(os.environ.get("TRUSTANA_PAGE_SIZE", "100"))
+TRUSTANA_PREFETCH_PAGES = int(os.environ.get("TRUSTANA_PREFETCH_PAGES", "1"))
 
+
+def search_trustana_products(api_key: str, offset: int = 0, limit: int = 1, filters: dict | None = None) -> tuple[list[dict], int | None]:
+    """Fetch one page of products from the Trustana search API; returns (products, total)."""
     headers = {
         "x-api-key": api_key,
         "Content-Type": "application/json"
     }
 
-    with httpx.Client(timeout=30) as client:
-        response = client.post(
-            "https://api.trustana.com/v1/products/search",
-            headers=headers,
-            json={"pagination": {"offset": 0, "limit": 1}}
-        )
+    body: dict[str, Any] = {"pagination": {"offset": offset, "limit": limit}}
+    if filters:
+        body["filter"] = filters
+
+    response = HTTP_POOL.request(
+        "POST",
+        f"{PROVIDER_BASE_URLS['trustana']}/v1/products/search",
+        headers=headers,
+        json=body,
+        idempotent=True,
+    )
 
     if response.status_code != 200:
         raise Exception(f"Trustana API error: {response.status_code} - {response.text}")
 
     data = response.json()
     # Trustana API returns: {"errorCode": ..., "data": {"result": [...], "total": N}}
-    products = data.get("data", {}).get("result", [])
-    logger.info(f"Products count: {len(products)}")
-
-    if not products:
-        raise Exception("No products found in Trustana")
+    page = data.get("data", {})
+    return page.get("result", []), page.get("total")
 
-    product = products[0]
 
-    # Extract name and brand from attributes array
+def flatten_product(product: dict) -> dict:
+    """Extract name and brand from the attributes array onto the product."""
     attrs = {attr["key"]: attr["value"] for attr in product.get("attributes", [])}
     product["name"] = attrs.get("name", "Unknown")
     product["brand"] = attrs.get("brand", "")
+    return product
+
+
+def product_matches_id(product: dict, product_id: str) -> bool:
+    """True if the product's Trustana _id or SKU equals product_id."""
+    return str(product_id) in (str(product.get("_id")), str(product.get(TRUSTANA_ID_FIELD)))
+
+
+def _iter_trustana_pages(api_key: str, filters: dict | None, product_ids: list[str] | None,
+                         page_size: int, max_records: int | None):
+    """Yield raw product pages, walking pagination.offset/limit until the catalog is exhausted."""
+    if product_ids:
+        # Look up IDs one page-sized chunk at a time; results are re-checked client-side
+        # so a backend that ignores the filter cannot leak unrelated products into a batch.
+        for i in range(0, len(product_ids), page_size):
+            chunk = [str(pid) for pid in product_ids[i:i + page_size]]
+            products, _ = search_trustana_products(api_key, 0, len(chunk), {TRUSTANA_ID_FIELD: {"in": chunk}})
+            yield [product for product in products if any(product_matches_id(product, pid) for pid in chunk)]
+        return
+
+    offset = 0
+    while True:
+        limit = page_size if max_records is None else min(page_size, max_records - offset)
+        if limit <= 0:
+            return
+        products, total = search_trustana_products(api_key, offset, limit, filters)
+        yield products
+        offset += len(products)
+        if len(products) < limit or (total is not None and offset >= total):
+            return
+
+
+_PREFETCH_DONE = object()
+
+
+def prefetch(items, depth: int):
+    """Iterate `items` while a background thread produces up to `depth` items ahead."""
+    if depth <= 0:
+        yield from items
+        return
+
+    buffer: queue.Queue = queue.Queue(maxsize=depth)
+    stop = Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for item in items:
+                if not put(item):
+                    return
+            put(_PREFETCH_DONE)
+        except BaseException as e:
+            put(e)
+
+    Thread(target=in_context(produce), name="prefetch", daemon=True).start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _PREFETCH_DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # Consumer finished or abandoned the iterator; let the producer exit
+        stop.set()
+
+
+def iter_trustana_products(api_key: str, filters: dict | None = None, product_ids: list[str] | None = None,
+                           page_size: int = TRUSTANA_PAGE_SIZE, max_records: int | None = None,
+                           prefetch_pages: int = TRUSTANA_PREFETCH_PAGES):
+    """Stream flattened products from Trustana, fetching the next page while the current one is consumed.
+
+    At most prefetch_pages + 1 pages are held in memory regardless of catalog size.
+    """
+    pages = _iter_trustana_pages(api_key, filters, product_ids, page_size, max_records)
+    for page in prefetch(pages, prefetch_pages):
+        for product in page:
+            yield flatten_product(product)
+
+
+def fetch_trustana_product(api_key: str, product_id: str | None = None) -> dict:
+    """Fetch a product from Trustana API: the given product_id, or the first product."""
+    logger.info(f"Fetching product {product_id or '(first)'} from Trustana...")
+
+    if product_id:
+        products = iter_trustana_products(api_key, product_ids=[product_id], prefetch_pages=0)
+    else:
+        products = iter_trustana_products(api_key, max_records=1, prefetch_pages=0)
+    product = next(products, None)
+
+    if product is None:
+        raise Exception(f"Product {product_id} not found in Trustana" if product_id else "No products found in Trustana")
+
     logger.info(f"Fetched product: {product.get('name', 'Unknown')}")
     return product
 
@@ -97,8 +2123,7 @@ def search_serpapi(api_key: str, query: str, num_results: int = 10) -> list[dict
         "hl": "en"
     }
 
-    with httpx.Client(timeout=30) as client:
-        response = client.get("https://serpapi.com/search", params=params)
+    response = HTTP_POOL.request("GET", f"{PROVIDER_BASE_URLS['serpapi']}/search", params=params)
 
     if response.status_code != 200:
         raise Exception(f"SerpAPI error: {response.status_code} - {response.text}")
@@ -147,12 +2172,12 @@ def export_to_csv(product: dict, search_results: list[dict], filename: str) -> s
     return str(filepath)
 
 
-def search_gemini(api_key: str, query: str) -> dict:
+def search_gemini(api_key: str, query: str, deadline: float | None = None) -> dict:
     """Search with Gemini using Google Search grounding."""
     logger.info(f"Searching Gemini (grounded) for: {query}")
 
-    model = "gemini-2.0-flash"
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
+    model = GEMINI_MODEL
+    url = f"{PROVIDER_BASE_URLS['gemini']}/v1beta/models/{model}:generateContent"
 
     body = {
         "contents": [
@@ -175,14 +2200,14 @@ def search_gemini(api_key: str, query: str) -> dict:
         }
     }
 
-    with httpx.Client(timeout=90) as client:
-        response = client.post(url, params={"key": api_key}, json=body)
+    response = HTTP_POOL.request("POST", url, params={"key": api_key}, json=body, deadline=deadline, idempotent=True)
 
     if response.status_code != 200:
         logger.error(f"Gemini error: {response.status_code} - {response.text[:500]}")
         return {"response": "", "urls": [], "error": response.text[:500]}
 
     data = response.json()
+    record_llm_usage("gemini", model, data)
 
     # Extract response text
     candidates = data.get("candidates", [])
@@ -219,18 +2244,18 @@ def search_gemini(api_key: str, query: str) -> dict:
     return {"response": text_response, "urls": urls}
 
 
-def search_perplexity(api_key: str, query: str) -> dict:
+def search_perplexity(api_key: str, query: str, deadline: float | None = None) -> dict:
     """Search with Perplexity API with citations."""
     logger.info(f"Searching Perplexity for: {query}")
 
-    url = "https://api.perplexity.ai/chat/completions"
+    url = f"{PROVIDER_BASE_URLS['perplexity']}/chat/completions"
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json",
     }
 
     body = {
-        "model": "sonar",
+        "model": PERPLEXITY_MODEL,
         "messages": [
             {
                 "role": "system",
@@ -246,14 +2271,14 @@ def search_perplexity(api_key: str, query: str) -> dict:
         "return_citations": True,
     }
 
-    with httpx.Client(timeout=90) as client:
-        response = client.post(url, headers=headers, json=body)
+    response = HTTP_POOL.request("POST", url, headers=headers, json=body, deadline=deadline, idempotent=True)
 
     if response.status_code != 200:
         logger.error(f"Perplexity error: {response.status_code} - {response.text[:500]}")
         return {"response": "", "urls": [], "error": response.text[:500]}
 
     data = response.json()
+    record_llm_usage(PROVIDER_HOSTS[host_key(url)], body["model"], data)
     choices = data.get("choices", [])
     if not choices:
         return {"response": "", "urls": [], "error": "No response"}
@@ -284,18 +2309,18 @@ def search_perplexity(api_key: str, query: str) -> dict:
     return {"response": text_response, "urls": urls}
 
 
-def search_openai(api_key: str, query: str) -> dict:
+def search_openai(api_key: str, query: str, deadline: float | None = None) -> dict:
     """Search with OpenAI (uses chat completions as fallback)."""
     logger.info(f"Searching OpenAI for: {query}")
 
-    url = "https://api.openai.com/v1/chat/completions"
+    url = f"{PROVIDER_BASE_URLS['openai']}/v1/chat/completions"
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json",
     }
 
     body = {
-        "model": "gpt-4o",
+        "model": OPENAI_SEARCH_MODEL,
         "messages": [
             {
                 "role": "system",
@@ -310,14 +2335,14 @@ def search_openai(api_key: str, query: str) -> dict:
         "max_tokens": 4096,
     }
 
-    with httpx.Client(timeout=90) as client:
-        response = client.post(url, headers=headers, json=body)
+    response = HTTP_POOL.request("POST", url, headers=headers, json=body, deadline=deadline, idempotent=True)
 
     if response.status_code != 200:
         logger.error(f"OpenAI error: {response.status_code} - {response.text[:500]}")
         return {"response": "", "urls": [], "error": response.text[:500]}
 
     data = response.json()
+    record_llm_usage(PROVIDER_HOSTS[host_key(url)], body["model"], data)
     choices = data.get("choices", [])
     if not choices:
         return {"response": "", "urls": [], "error": "No response"}
@@ -337,41 +2362,89 @@ def search_openai(api_key: str, query: str) -> dict:
     return {"response": text_response, "urls": urls}
 
 
-def calculate_aeo_score(urls: list[dict], retailer_domain: str) -> dict:
+_DOMAIN_TOKEN = re.compile(r"(?<![a-z0-9.-])[a-z0-9-]+(?:\.[a-z0-9-]+)+")
+
+
+def normalize_domain(value: str) -> str:
+    """Bare lowercase host for a domain or URL ("https://www.Amazon.com/x" -> "amazon.com")."""
+    value = value.strip().lower()
+    host = urlsplit(value if "//" in value else f"//{value}").hostname or ""
+    host = host.rstrip(".")
+    return host[4:] if host.startswith("www.") else host
+
+
+class RetailerMatcher:
+    """Matches cited URLs against a set of retailer domains in one pass.
+
+    Each retailer domain goes into a suffix index, and a URL's host is looked
+    up by walking its label suffixes (shop.amazon.com, amazon.com, com), so a
+    retailer matches its own domain and subdomains but not look-alikes such as
+    notamazon.com or amazon.com.evil. With match_titles, domain-like tokens in
+    the title are looked up the same way (Gemini cites redirect URLs whose
+    title is the source domain).
+    """
+
+    def __init__(self, domains: list[str], match_titles: bool = True):
+        self.domains = list(dict.fromkeys(normalize_domain(domain) for domain in domains if normalize_domain(domain)))
+        self.match_titles = match_titles
+        self._index = {domain: domain for domain in self.domains}
+
+    def match_host(self, host: str) -> str | None:
+        """The retailer owning a host, preferring the most specific retailer domain."""
+        labels = host.lower().rstrip(".").split(".")
+        for i in range(len(labels) - 1):
+            retailer = self._index.get(".".join(labels[i:]))
+            if retailer:
+                return retailer
+        return None
+
+    def match(self, url: str, title: str = "") -> set[str]:
+        """Retailers a cited result belongs to."""
+        matched = set()
+        try:
+            host = urlsplit(url.strip()).hostname
+        except ValueError:
+            host = None
+        if host and (retailer := self.match_host(host)):
+            matched.add(retailer)
+        if self.match_titles and title:
+            for token in _DOMAIN_TOKEN.findall(title.lower()):
+                if retailer := self.match_host(token):
+                    matched.add(retailer)
+        return matched
+
+    def score(self, urls: list[dict]) -> dict[str, dict]:
+        """Position-weighted score of every retailer over one engine's URLs.
+
+        1st position = 100 points, -10 per position (minimum 10); a retailer's
+        score is its best position.
+        """
+        scores = {domain: {"score": 0, "domain_found": False, "matched_positions": []} for domain in self.domains}
+        for url_info in urls:
+            position = url_info.get("position", 999)
+            for retailer in self.match(url_info.get("url", ""), url_info.get("title", "")):
+                score = scores[retailer]
+                score["domain_found"] = True
+                score["score"] = max(score["score"], max(100 - (position - 1) * 10, 10))
+                score["matched_positions"].append(position)
+        return scores
+
+
+def calculate_aeo_score(urls: list[dict], retailer_domain: str, match_titles: bool = True) -> dict:
     """
-    Calculate position-weighted AEO score.
+    Calculate position-weighted AEO score for one retailer.
     1st position = 100 points, -10 per position
-    Checks both URL and title fields for domain presence.
+    Checks both URL host and (optionally) title for the retailer's domain.
     """
-    score = 0
-    domain_found = False
-    matched_positions = []
-    retailer_domain_lower = retailer_domain.lower()
-
-    for url_info in urls:
-        url = url_info.get("url", "").lower()
-        title = url_info.get("title", "").lower()
-        position = url_info.get("position", 999)
-
-        # Check both URL and title for domain presence
-        if retailer_domain_lower in url or retailer_domain_lower in title:
-            domain_found = True
-            position_score = max(100 - (position - 1) * 10, 10)
-            score = max(score, position_score)
-            matched_positions.append(position)
-
-    return {
-        "score": score,
-        "domain_found": domain_found,
-        "matched_positions": matched_positions
-    }
+    matcher = RetailerMatcher([retailer_domain], match_titles)
+    return matcher.score(urls).get(normalize_domain(retailer_domain), {"score": 0, "domain_found": False, "matched_positions": []})
 
 
-def send_to_slack(token: str, channel: str, message: str) -> dict:
-    """Send message to Slack channel."""
+def send_to_slack(token: str, channel: str, message: str, blocks: list | None = None) -> dict:
+    """Send message (optionally with Block Kit blocks) to Slack channel."""
     logger.info(f"Sending to Slack channel {channel}")
 
-    url = "https://slack.com/api/chat.postMessage"
+    url = f"{PROVIDER_BASE_URLS['slack']}/api/chat.postMessage"
     headers = {
         "Authorization": f"Bearer {token}",
         "Content-Type": "application/json",
@@ -382,9 +2455,10 @@ def send_to_slack(token: str, channel: str, message: str) -> dict:
         "text": message,
         "mrkdwn": True,
     }
+    if blocks:
+        body["blocks"] = blocks
 
-    with httpx.Client(timeout=30) as client:
-        response = client.post(url, headers=headers, json=body)
+    response = HTTP_POOL.request("POST", url, headers=headers, json=body)
 
     data = response.json()
     if not data.get("ok"):
@@ -395,35 +2469,238 @@ def send_to_slack(token: str, channel: str, message: str) -> dict:
     return {"ts": data.get("ts"), "channel": data.get("channel")}
 
 
+# AEO engine fan-out settings
+AEO_ENGINES = ("gemini", "perplexity", "openai")
+AEO_ENGINE_WORKERS = int(os.environ.get("AEO_ENGINE_WORKERS", "24"))
+AEO_BATCH_CONCURRENCY = int(os.environ.get("AEO_BATCH_CONCURRENCY", "4"))
+AEO_BATCH_MAX_CONCURRENCY = int(os.environ.get("AEO_BATCH_MAX_CONCURRENCY", "16"))
+
+# Shared pool for engine searches, so runs and batch products don't each spin up threads
+ENGINE_EXECUTOR = ThreadPoolExecutor(max_workers=AEO_ENGINE_WORKERS, thread_name_prefix="aeo-engine")
+
+AEO_SEARCH_FUNCTIONS = {
+    "gemini": search_gemini,
+    "perplexity": search_perplexity,
+    "openai": search_openai,
+}
+AEO_ENGINE_MODELS = {
+    "gemini": GEMINI_MODEL,
+    "perplexity": PERPLEXITY_MODEL,
+    "openai": OPENAI_SEARCH_MODEL,
+}
+
+
+def get_aeo_engine_keys() -> dict[str, str | None]:
+    """API keys for each AEO engine from the environment."""
+    return {
+        "gemini": os.environ.get("GEMINI_API_KEY"),
+        "perplexity": os.environ.get("PERPLEXITY_API_KEY"),
+        "openai": os.environ.get("OPENAI_API_KEY"),
+    }
+
+
+def _engine_result(engine: str, future) -> dict:
+    try:
+        return future.result()
+    except Exception as e:
+        logger.error(f"{engine} error: {e}")
+        result = {"response": "", "urls": [], "error": str(e)}
+        if isinstance(e, (DeadlineExceeded, httpx.TimeoutException)):
+            result["timed_out"] = True
+        return result
+
+
+def search_ai_engines(search_query: str, engine_keys: dict[str, str | None], cache_mode: str = "use",
+                      deadline: float | None = None, on_late_result=None, on_result=None) -> dict:
+    """Search all AI engines in parallel on the shared engine pool.
+
+    With a monotonic `deadline`, engines that have not answered in time are
+    returned as timed out. Their calls are bounded by the deadline too, unless
+    `on_late_result(engine, result)` is given: then they keep their normal
+    timeouts and report through the callback when they finish.
+    `on_result(engine, result)` is called as each engine answers in time.
+    """
+    results = {}
+    futures = {}
+    engine_deadline = deadline if on_late_result is None else None
+
+    for engine in AEO_ENGINES:
+        key = engine_keys.get(engine)
+        if key:
+            kwargs = {"deadline": engine_deadline} if engine_deadline is not None else {}
+            future = ENGINE_EXECUTOR.submit(
+                in_context(cached_call), engine, AEO_ENGINE_MODELS[engine], search_query,
+                AEO_SEARCH_FUNCTIONS[engine], key, search_query, cache_mode=cache_mode, **kwargs,
+            )
+            futures[future] = engine
+        else:
+            results[engine] = {"response": "", "urls": [], "error": "API key not set"}
+
+    timeout = max(deadline - time.monotonic(), 0) if deadline is not None else None
+    pending = set(futures)
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            pending.discard(future)
+            engine = futures[future]
+            results[engine] = _engine_result(engine, future)
+            if on_result is not None:
+                on_result(engine, results[engine])
+    except FuturesTimeoutError:
+        pass
+
+    for future in pending:
+        engine = futures[future]
+        logger.warning(f"{engine} did not answer before the deadline for query: {search_query}")
+        results[engine] = {"response": "", "urls": [], "error": "Timed out before the run deadline", "timed_out": True}
+        if on_late_result is not None:
+            future.add_done_callback(lambda f, engine=engine: on_late_result(engine, _engine_result(engine, f)))
+        else:
+            future.cancel()
+
+    return results
+
+
+def score_aeo_results(results: dict, matcher: RetailerMatcher) -> dict[str, dict]:
+    """Score each engine's URLs for every retailer and average the engines where each retailer is present."""
+    engine_scores = {engine: matcher.score(results.get(engine, {}).get("urls", [])) for engine in AEO_ENGINES}
+    statuses = {engine: engine_status(results.get(engine, {})) for engine in AEO_ENGINES}
+
+    scored = {}
+    for domain in matcher.domains:
+        scores = {engine: engine_scores[engine][domain] for engine in AEO_ENGINES}
+        non_zero = [score["score"] for score in scores.values() if score["score"] > 0]
+        scored[domain] = {
+            "scores": scores,
+            "overall_score": round(sum(non_zero) / len(non_zero), 1) if non_zero else 0,
+            "engines_with_presence": len(non_zero),
+            "engine_status": statuses,
+        }
+    return scored
+
+
+def retailer_summary(scored: dict[str, dict]) -> dict[str, dict]:
+    """Per-retailer overall score, engine presence and engine scores for a run result."""
+    return {
+        domain: {
+            "overall_aeo_score": retailer["overall_score"],
+            "engines_with_presence": retailer["engines_with_presence"],
+            "scores": {engine: retailer["scores"][engine] for engine in AEO_ENGINES},
+        }
+        for domain, retailer in scored.items()
+    }
+
+
+def retailer_matcher(input_data: dict) -> RetailerMatcher:
+    """Matcher for a run's retailer_domain plus retailer_domains; the first one is the primary retailer."""
+    domains = [input_data["retailer_domain"]] if input_data.get("retailer_domain") else []
+    domains += input_data.get("retailer_domains") or []
+    matcher = RetailerMatcher(domains, input_data.get("match_titles", True))
+    if not matcher.domains:
+        raise Exception("retailer_domain is required")
+    return matcher
+
+
+def engine_status(result: dict) -> str:
+    """ok, error or timed_out for one engine's search result."""
+    if result.get("timed_out"):
+        return "timed_out"
+    return "error" if result.get("error") else "ok"
+
+
+class LateEngineResults:
+    """Applies engine results that arrive after a run's deadline to the stored run.
+
+    Results are held until finalize() is called once the run has stored its
+    own result, then each one re-scores the run and amends it in the store.
+    """
+
+    def __init__(self, run_id: str, matcher: RetailerMatcher):
+        self.run_id = run_id
+        self.matcher = matcher
+        self._lock = Lock()
+        self._finalized = False
+        self._buffered: list[tuple[str, dict]] = []
+
+    def __call__(self, engine: str, result: dict) -> None:
+        with self._lock:
+            if self._finalized:
+                self._apply(engine, result)
+            else:
+                self._buffered.append((engine, result))
+
+    def finalize(self) -> None:
+        with self._lock:
+            self._finalized = True
+            for engine, result in self._buffered:
+                self._apply(engine, result)
+            self._buffered = []
+
+    def _apply(self, engine: str, result: dict) -> None:
+        stored = RUN_STORE.get_result(self.run_id)
+        if not stored:
+            return
+        urls = {**stored["urls"], engine: result.get("urls", [])}
+        all_scored = score_aeo_results({name: {"urls": engine_urls} for name, engine_urls in urls.items()}, self.matcher)
+        scored = all_scored[self.matcher.domains[0]]
+        status = engine_status(result)
+        RUN_STORE.amend(self.run_id, {}, {
+            **stored,
+            "overall_aeo_score": scored["overall_score"],
+            "engines_with_presence": scored["engines_with_presence"],
+            "scores": scored["scores"],
+            "retailers": retailer_summary(all_scored),
+            "urls": urls,
+            "engine_status": {**stored["engine_status"], engine: "late" if status == "ok" else status},
+            "engines_timed_out": [name for name in stored["engines_timed_out"] if name != engine],
+            "late_results_applied": stored.get("late_results_applied", 0) + 1,
+        })
+        run = RUN_STORE.get(self.run_id)
+        if run is not None:
+            EVENT_BUS.publish(run, "result_updated", {
+                "engine": engine,
+                "status": status,
+                "overall_aeo_score": scored["overall_score"],
+                "score": scored["scores"][engine],
+            })
+        logger.info(f"AEO run {self.run_id}: applied late {engine} result, overall score now {scored['overall_score']}")
+
+
 def execute_aeo_visibility(run_id: str, input_data: dict) -> None:
     """Execute the AEO visibility score workflow."""
-    run = RUNS[run_id]
+    if input_data.get("product_ids") or input_data.get("product_filter"):
+        execute_aeo_visibility_batch(run_id, input_data)
+        return
+
+    run = RUN_STORE.live(run_id)
 
     try:
         # Get required inputs
         product_id = input_data.get("product_id")
-        retailer_domain = input_data.get("retailer_domain")
 
         if not product_id:
             raise Exception("product_id is required")
-        if not retailer_domain:
-            raise Exception("retailer_domain is required")
+        # Every retailer is scored from the same engine results; the first is reported at the top level
+        matcher = retailer_matcher(input_data)
+        retailer_domain = matcher.domains[0]
 
         # Get API keys
         trustana_key = os.environ.get("TRUSTANA_API_KEY")
-        gemini_key = os.environ.get("GEMINI_API_KEY")
-        perplexity_key = os.environ.get("PERPLEXITY_API_KEY")
-        openai_key = os.environ.get("OPENAI_API_KEY")
+        engine_keys = get_aeo_engine_keys()
         slack_token = os.environ.get("SLACK_BOT_TOKEN")
         slack_channel = os.environ.get("SLACK_CHANNEL", "C09M1SAG22E")
 
         if not trustana_key:
             raise Exception("TRUSTANA_API_KEY not set")
 
+        # Optional latency budget for the whole run; engines still pending at the deadline are reported as timed out
+        deadline_ms = input_data.get("deadline_ms")
+        deadline = time.monotonic() + float(deadline_ms) / 1000 if deadline_ms else None
+        late_results = LateEngineResults(run_id, matcher) if deadline and input_data.get("late_results") else None
+
         # Step 1: Fetch product from Trustana
         run["status"] = "running"
         run["current_step"] = "fetch_product"
-        product = fetch_trustana_product(trustana_key)
+        product = fetch_trustana_product(trustana_key, product_id)
 
         product_name = product.get("name", "Unknown")
         brand = product.get("brand", "")
@@ -434,44 +2711,30 @@ def execute_aeo_visibility(run_id: str, input_data: dict) -> None:
 
         # Step 2: Search all AI engines in parallel
         run["current_step"] = "search_ai_engines"
-        results = {}
-
-        with ThreadPoolExecutor(max_workers=3) as executor:
-            futures = {}
-
-            if gemini_key:
-                futures[executor.submit(search_gemini, gemini_key, search_query)] = "gemini"
-            else:
-                results["gemini"] = {"response": "", "urls": [], "error": "API key not set"}
-
-            if perplexity_key:
-                futures[executor.submit(search_perplexity, perplexity_key, search_query)] = "perplexity"
-            else:
-                results["perplexity"] = {"response": "", "urls": [], "error": "API key not set"}
-
-            if openai_key:
-                futures[executor.submit(search_openai, openai_key, search_query)] = "openai"
-            else:
-                results["openai"] = {"response": "", "urls": [], "error": "API key not set"}
+        def publish_engine_result(engine: str, result: dict) -> None:
+            urls = result.get("urls", [])
+            scores = matcher.score(urls)
+            EVENT_BUS.publish(run, "engine_result", {
+                "engine": engine,
+                "status": engine_status(result),
+                "url_count": len(urls),
+                **scores[retailer_domain],
+                "retailers": {domain: score["score"] for domain, score in scores.items()},
+            })
 
-            for future in as_completed(futures):
-                engine = futures[future]
-                try:
-                    results[engine] = future.result()
-                except Exception as e:
-                    logger.error(f"{engine} error: {e}")
-                    results[engine] = {"response": "", "urls": [], "error": str(e)}
+        results = search_ai_engines(
+            search_query, engine_keys, input_data.get("cache", "use"), deadline, late_results, publish_engine_result
+        )
 
         # Step 3: Calculate AEO scores
         run["current_step"] = "calculate_scores"
 
-        gemini_score = calculate_aeo_score(results.get("gemini", {}).get("urls", []), retailer_domain)
-        perplexity_score = calculate_aeo_score(results.get("perplexity", {}).get("urls", []), retailer_domain)
-        openai_score = calculate_aeo_score(results.get("openai", {}).get("urls", []), retailer_domain)
-
-        scores = [gemini_score["score"], perplexity_score["score"], openai_score["score"]]
-        non_zero = [s for s in scores if s > 0]
-        overall_score = round(sum(non_zero) / len(non_zero), 1) if non_zero else 0
+        all_scored = score_aeo_results(results, matcher)
+        scored = all_scored[retailer_domain]
+        gemini_score = scored["scores"]["gemini"]
+        perplexity_score = scored["scores"]["perplexity"]
+        openai_score = scored["scores"]["openai"]
+        overall_score = scored["overall_score"]
 
         logger.info(f"AEO Scores - Gemini: {gemini_score['score']}, Perplexity: {perplexity_score['score']}, OpenAI: {openai_score['score']}, Overall: {overall_score}")
 
@@ -495,14 +2758,17 @@ def execute_aeo_visibility(run_id: str, input_data: dict) -> None:
                 "openai_score", "openai_domain_found", "openai_positions"
             ])
 
-            # Write scores row
-            writer.writerow([
-                sku, product_name, brand, retailer_domain,
-                overall_score, len(non_zero),
-                gemini_score['score'], gemini_score['domain_found'], str(gemini_score['matched_positions']),
-                perplexity_score['score'], perplexity_score['domain_found'], str(perplexity_score['matched_positions']),
-                openai_score['score'], openai_score['domain_found'], str(openai_score['matched_positions'])
-            ])
+            # Write one scores row per retailer
+            for domain, retailer in all_scored.items():
+                writer.writerow([
+                    sku, product_name, brand, domain,
+                    retailer["overall_score"], retailer["engines_with_presence"],
+                    *(value for engine in AEO_ENGINES for value in (
+                        retailer["scores"][engine]["score"],
+                        retailer["scores"][engine]["domain_found"],
+                        str(retailer["scores"][engine]["matched_positions"]),
+                    )),
+                ])
 
             # Add blank row
             writer.writerow([])
@@ -559,8 +2825,20 @@ def execute_aeo_visibility(run_id: str, input_data: dict) -> None:
                 "perplexity": results.get("perplexity", {}).get("urls", []),
                 "openai": results.get("openai", {}).get("urls", []),
             },
+            "engines_with_presence": scored["engines_with_presence"],
+            "retailers": retailer_summary(all_scored),
+            "engine_status": scored["engine_status"],
+            "engines_timed_out": [engine for engine, status in scored["engine_status"].items() if status == "timed_out"],
+            "deadline_ms": deadline_ms,
             "csv_path": str(filepath),
         }
+        if late_results is not None:
+            late_results.finalize()
+
+        sink_records("aeo_scores", "aeo-visibility-score", run_id, [
+            aeo_score_row(product, domain, results, retailer) for domain, retailer in all_scored.items()
+        ])
+        sink_records("aeo_urls", "aeo-visibility-score", run_id, aeo_url_rows(sku, results))
 
         logger.info(f"AEO workflow {run_id} completed - Overall score: {overall_score} - CSV: {filepath}")
 
@@ -570,9 +2848,182 @@ def execute_aeo_visibility(run_id: str, input_data: dict) -> None:
         run["error"] = str(e)
 
 
-def execute_trustana_serpapi_csv(run_id: str) -> None:
+AEO_BATCH_COLUMNS = [
+    "product_id", "product_name", "brand", "retailer_domain",
+    "overall_aeo_score", "engines_with_presence",
+    "gemini_score", "gemini_domain_found", "gemini_positions",
+    "perplexity_score", "perplexity_domain_found", "perplexity_positions",
+    "openai_score", "openai_domain_found", "openai_positions",
+    "error",
+]
+
+
+def aeo_score_row(product: dict, retailer_domain: str, results: dict, scored: dict) -> dict:
+    """Flat per-product score row (AEO_BATCH_COLUMNS)."""
+    row = {
+        "product_id": product.get("skuId", product.get("_id", "")),
+        "product_name": product.get("name", "Unknown"),
+        "brand": product.get("brand", ""),
+        "retailer_domain": retailer_domain,
+        "overall_aeo_score": scored["overall_score"],
+        "engines_with_presence": scored["engines_with_presence"],
+        "error": "; ".join(f"{engine}: {results[engine]['error']}" for engine in AEO_ENGINES if results.get(engine, {}).get("error")),
+    }
+    for engine in AEO_ENGINES:
+        score = scored["scores"][engine]
+        row[f"{engine}_score"] = score["score"]
+        row[f"{engine}_domain_found"] = score["domain_found"]
+        row[f"{engine}_positions"] = str(score["matched_positions"])
+    return row
+
+
+def aeo_url_rows(product_id: str, results: dict) -> list[dict]:
+    """One row per URL cited by each engine."""
+    return [
+        {
+            "product_id": product_id,
+            "engine": engine,
+            "position": url_info.get("position"),
+            "url": url_info.get("url", ""),
+            "title": url_info.get("title", ""),
+        }
+        for engine in AEO_ENGINES
+        for url_info in results.get(engine, {}).get("urls", [])
+    ]
+
+
+def score_product_visibility(product: dict, matcher: RetailerMatcher, engine_keys: dict[str, str | None],
+                             cache_mode: str = "use", deadline_ms: float | None = None) -> tuple[list[dict], list[dict]]:
+    """Run the engine fan-out and scoring for one product; returns a score row per retailer and cited URL rows."""
+    search_query = f"{product.get('name', 'Unknown')} {product.get('brand', '')}".strip()
+    deadline = time.monotonic() + float(deadline_ms) / 1000 if deadline_ms else None
+
+    with trace_span("product", product_id=product.get("skuId", product.get("_id"))):
+        results = search_ai_engines(search_query, engine_keys, cache_mode, deadline)
+    rows = [aeo_score_row(product, domain, results, scored) for domain, scored in score_aeo_results(results, matcher).items()]
+    return rows, aeo_url_rows(rows[0]["product_id"], results)
+
+
+def execute_aeo_visibility_batch(run_id: str, input_data: dict) -> None:
+    """Score many products (a list of IDs or a Trustana filter) in one run into one CSV."""
+    run = RUN_STORE.live(run_id)
+
+    try:
+        product_ids = input_data.get("product_ids")
+        product_filter = input_data.get("product_filter")
+        max_products = input_data.get("max_products")
+        concurrency = max(1, min(int(input_data.get("concurrency", AEO_BATCH_CONCURRENCY)), AEO_BATCH_MAX_CONCURRENCY))
+        cache_mode = input_data.get("cache", "use")
+        # In batch mode the latency budget applies to each product's engine fan-out
+        deadline_ms = input_data.get("deadline_ms")
+
+        matcher = retailer_matcher(input_data)
+        retailer_domain = matcher.domains[0]
+
+        trustana_key = os.environ.get("TRUSTANA_API_KEY")
+        if not trustana_key:
+            raise Exception("TRUSTANA_API_KEY not set")
+        engine_keys = get_aeo_engine_keys()
+
+        run["status"] = "running"
+        run["current_step"] = "score_products"
+        progress = {
+            "total": len(product_ids) if product_ids else max_products,
+            "processed": 0,
+            "succeeded": 0,
+            "failed": 0,
+        }
+        run["progress"] = progress
+
+        products = iter_trustana_products(
+            trustana_key,
+            filters=product_filter,
+            product_ids=product_ids,
+            max_records=max_products,
+        )
+
+        timestamp = int(datetime.now().timestamp())
+        filepath = OUTPUT_DIR / f"aeo-batch-{run_id}-{timestamp}.csv"
+        score_totals = dict.fromkeys(matcher.domains, 0.0)
+
+        with open(filepath, "w", newline="", encoding="utf-8") as f, \
+                ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"aeo-batch-{run_id}") as executor:
+            writer = csv.DictWriter(f, fieldnames=AEO_BATCH_COLUMNS)
+            writer.writeheader()
+
+            def record(future, product: dict) -> None:
+                url_rows = []
+                try:
+                    rows, url_rows = future.result()
+                    progress["succeeded"] += 1
+                    for row in rows:
+                        score_totals[row["retailer_domain"]] += row["overall_aeo_score"]
+                except Exception as e:
+                    logger.error(f"AEO batch {run_id} product {product.get('skuId')} failed: {e}")
+                    rows = [{
+                        "product_id": product.get("skuId", product.get("_id", "")),
+                        "product_name": product.get("name", "Unknown"),
+                        "brand": product.get("brand", ""),
+                        "retailer_domain": domain,
+                        "error": str(e),
+                    } for domain in matcher.domains]
+                    progress["failed"] += 1
+                progress["processed"] += 1
+                writer.writerows(rows)
+                for row in rows:
+                    EVENT_BUS.publish(run, "product_result", {"row": row})
+                EVENT_BUS.publish(run, "progress", dict(progress))
+                sink_records("aeo_scores", "aeo-visibility-score", run_id, rows)
+                sink_records("aeo_urls", "aeo-visibility-score", run_id, url_rows)
+
+            # Keep at most 2x concurrency products in flight so memory stays flat for any catalog size
+            in_flight: dict = {}
+            for product in products:
+                future = executor.submit(
+                    in_context(score_product_visibility), product, matcher, engine_keys, cache_mode, deadline_ms
+                )
+                in_flight[future] = product
+                if len(in_flight) >= concurrency * 2:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for finished in done:
+                        record(finished, in_flight.pop(finished))
+
+            for finished in as_completed(list(in_flight)):
+                record(finished, in_flight.pop(finished))
+
+        if product_ids:
+            progress["not_found"] = progress["total"] - progress["processed"]
+        else:
+            progress["total"] = progress["processed"]
+
+        run["status"] = "completed"
+        run["current_step"] = None
+        run["completed_at"] = datetime.utcnow().isoformat()
+        averages = {
+            domain: round(total / progress["succeeded"], 1) if progress["succeeded"] else 0
+            for domain, total in score_totals.items()
+        }
+        run["result"] = {
+            "retailer_domain": retailer_domain,
+            "products_scored": progress["succeeded"],
+            "products_failed": progress["failed"],
+            "average_aeo_score": averages[retailer_domain],
+            "retailers": {domain: {"average_aeo_score": average} for domain, average in averages.items()},
+            "csv_path": str(filepath),
+        }
+
+        logger.info(f"AEO batch {run_id} completed - {progress['succeeded']} scored, {progress['failed']} failed - CSV: {filepath}")
+
+    except Exception as e:
+        logger.error(f"AEO batch workflow error: {e}")
+        run["status"] = "failed"
+        run["error"] = str(e)
+
+
+def execute_trustana_serpapi_csv(run_id: str, input_data: dict | None = None) -> None:
     """Execute the trustana-serpapi-csv workflow."""
-    run = RUNS[run_id]
+    run = RUN_STORE.live(run_id)
+    input_data = input_data or {}
 
     try:
         # Get API keys from environment
@@ -598,13 +3049,30 @@ def execute_trustana_serpapi_csv(run_id: str) -> None:
 
         # Step 3: Search Google via SerpAPI
         run["current_step"] = "search_google"
-        search_results = search_serpapi(serpapi_key, search_query, num_results=10)
+        search_results = cached_call(
+            "serpapi", "google:10", search_query,
+            search_serpapi, serpapi_key, search_query, num_results=10,
+            cache_mode=input_data.get("cache", "use"),
+        )
 
         # Step 4: Export to CSV
         run["current_step"] = "export_to_csv"
         sku = product.get("skuId", "unknown")
         filename = f"product-search-{sku}-{int(datetime.now().timestamp())}.csv"
         csv_path = export_to_csv(product, search_results, filename)
+        sink_records("serp_results", "trustana-serpapi-csv", run_id, [
+            {
+                "product_name": product.get("name"),
+                "brand": product.get("brand"),
+                "sku": product.get("skuId"),
+                "search_query": search_query,
+                "position": result.get("position"),
+                "title": result.get("title"),
+                "link": result.get("link"),
+                "snippet": result.get("snippet"),
+            }
+            for result in search_results
+        ])
 
         # Complete
         run["status"] = "completed"
@@ -632,15 +3100,9 @@ def translate_with_gpt51(api_key: str, system_prompt: str, user_prompt: str, rea
     """Translate text using OpenAI GPT-5.1 Responses API."""
     logger.info(f"Translating with OpenAI GPT-5.1 (reasoning: {reasoning_effort})...")
 
-    url = "https://api.openai.com/v1/responses"
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
-
     # GPT-5.1 Responses API format
     body = {
-        "model": "gpt-5.1",
+        "model": TRANSLATION_MODEL,
         "input": [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt}
@@ -659,14 +3121,31 @@ def translate_with_gpt51(api_key: str, system_prompt: str, user_prompt: str, rea
         "store": True
     }
 
-    with httpx.Client(timeout=180) as client:
-        response = client.post(url, headers=headers, json=body)
+    ai_response = call_openai_responses(api_key, body)
+    if not ai_response.get("error"):
+        logger.info(f"Translation completed with GPT-5.1, length: {len(ai_response['content'])} chars")
+    return ai_response
+
+
+def call_openai_responses(api_key: str, body: dict, timeout: float | None = None) -> dict:
+    """POST a request body to the OpenAI Responses API; returns {"content", "usage"} or {"error"}.
+
+    timeout defaults to the host's HTTP_HOST_TIMEOUTS entry.
+    """
+    url = f"{PROVIDER_BASE_URLS['openai']}/v1/responses"
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+    }
+
+    response = HTTP_POOL.request("POST", url, headers=headers, json=body, timeout=timeout)
 
     if response.status_code != 200:
-        logger.error(f"OpenAI GPT-5.1 error: {response.status_code} - {response.text[:500]}")
+        logger.error(f"OpenAI {body.get('model')} error: {response.status_code} - {response.text[:500]}")
         return {"content": "", "error": response.text[:500]}
 
     data = response.json()
+    record_llm_usage("openai", body.get("model", ""), data)
 
     # Extract content from GPT-5.1 response format
     output = data.get("output", [])
@@ -680,28 +3159,196 @@ def translate_with_gpt51(api_key: str, system_prompt: str, user_prompt: str, rea
     if not content:
         content = data.get("output_text", "") or data.get("text", "")
 
-    logger.info(f"Translation completed with GPT-5.1, length: {len(content)} chars")
-    return {"content": content}
+    return {"content": content, "usage": data.get("usage", {})}
 
 
-def execute_localization(run_id: str, input_data: dict) -> None:
-    """Execute the localization workflow."""
-    run = RUNS[run_id]
+TRANSLATION_MEMORY_PATH = Path(os.environ.get("TRANSLATION_MEMORY_PATH", str(DATA_DIR / "translation-memory.db")))
 
-    try:
-        # Get inputs
-        target_language = input_data.get("target_language", "Modern Standard Arabic")
-        fields_to_translate = input_data.get("fields_to_translate", [])
-        transliterate_brand = input_data.get("transliterate_brand", True)
-        preserve_html = input_data.get("preserve_html", True)
-        glossary = input_data.get("glossary", "")
-        reasoning_effort = input_data.get("reasoning_effort", "low")
 
-        # Validate required inputs
-        if not fields_to_translate:
+class TranslationMemory:
+    """SQLite-backed store of translated segments keyed by source text, language, glossary and model."""
+
+    def __init__(self, db_path: Path):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = Lock()
+        self._db = sqlite3.connect(str(db_path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS segments ("
+            " key TEXT PRIMARY KEY, target_language TEXT NOT NULL, translation TEXT NOT NULL,"
+            " tokens INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def make_key(source: str, target_language: str, glossary: str, model: str) -> str:
+        return hashlib.sha256("\x00".join([source, target_language, glossary, model]).encode("utf-8")).hexdigest()
+
+    def lookup(self, keys: list[str]) -> dict[str, tuple[str, int]]:
+        """Return {key: (translation, tokens)} for the keys present in memory."""
+        if not keys:
+            return {}
+        placeholders = ",".join("?" * len(keys))
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT key, translation, tokens FROM segments WHERE key IN ({placeholders})", keys
+            ).fetchall()
+            if rows:
+                self._db.executemany("UPDATE segments SET hits = hits + 1 WHERE key = ?", [(r[0],) for r in rows])
+                self._db.commit()
+        return {key: (translation, tokens) for key, translation, tokens in rows}
+
+    def store(self, entries: list[tuple[str, str, str, int]]) -> None:
+        """Store (key, target_language, translation, tokens) entries."""
+        if not entries:
+            return
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO segments (key, target_language, translation, tokens, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(key, lang, translation, tokens, now) for key, lang, translation, tokens in entries],
+            )
+            self._db.commit()
+
+
+TRANSLATION_MEMORY = TranslationMemory(TRANSLATION_MEMORY_PATH)
+
+# Localization chunking: fields are packed into calls of at most this many (estimated) source tokens
+LOCALIZATION_CHUNK_TOKENS = int(os.environ.get("LOCALIZATION_CHUNK_TOKENS", "2000"))
+# Chunk translations in flight per run, and across all runs
+LOCALIZATION_CONCURRENCY = int(os.environ.get("LOCALIZATION_CONCURRENCY", "8"))
+TRANSLATION_WORKERS = int(os.environ.get("TRANSLATION_WORKERS", "16"))
+
+# Shared pool for translation calls, so multi-language runs don't each spin up threads
+TRANSLATION_EXECUTOR = ThreadPoolExecutor(max_workers=TRANSLATION_WORKERS, thread_name_prefix="translate")
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 UTF-8 bytes per token), close enough for chunk budgeting."""
+    return len(text.encode("utf-8")) // 4 + 1
+
+
+def chunk_fields(fields_data: dict[str, str], token_budget: int) -> list[dict[str, str]]:
+    """Pack fields, in order, into chunks within the token budget; a larger field gets a chunk of its own."""
+    chunks: list[dict[str, str]] = []
+    current: dict[str, str] = {}
+    current_tokens = 0
+    for field, value in fields_data.items():
+        tokens = estimate_tokens(value)
+        if current and current_tokens + tokens > token_budget:
+            chunks.append(current)
+            current, current_tokens = {}, 0
+        current[field] = value
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def translate_fields(api_key: str, fields_data: dict[str, str], product_name: str, brand: str,
+                     target_language: str, glossary: str, reasoning_effort: str) -> tuple[dict[str, str], dict, bool]:
+    """Translate fields in one GPT-5.1 call; returns (translations, usage, reusable).
+
+    reusable is False when the per-field markers could not be parsed and the
+    whole response was assigned to the first field.
+    """
+    if "arabic" in target_language.lower():
+        script_rules = """5. Transliterate brand names to Arabic script letter-by-letter (e.g., Oppo → أوبو, Samsung → سامسونج, Apple → أبل)
+6. Apply unit/abbreviation replacements from the glossary provided
+7. For Arabic translations: No English letters in translated text (except in HTML attributes and E-XXX codes)
+8. Preserve all numbers exactly as they appear
+9. For acronyms not in glossary, transliterate them letter-by-letter to Arabic script"""
+    else:
+        script_rules = f"""5. Transliterate brand names into the {target_language} script if it is not Latin; otherwise keep them unchanged
+6. Apply unit/abbreviation replacements from the glossary provided
+7. Keep HTML attributes and E-XXX codes unchanged
+8. Preserve all numbers exactly as they appear
+9. Keep acronyms that are not in the glossary unchanged"""
+
+    system_prompt = f"""You are an expert translator and localization specialist for {target_language}.
+
+Key principles:
+1. Maintain exact meaning and intent of the original text
+2. Use natural, fluent {target_language} that reads well to native speakers
+3. Handle technical terminology appropriately
+4. Preserve all HTML tags and structure - translate only text content between tags
+{script_rules}
+
+{f"=== GLOSSARY ==={chr(10)}{glossary}{chr(10)}===" if glossary else ""}
+
+Return the translated text for each field, clearly labeled."""
+
+    user_prompt = f"Product: {product_name}\nBrand: {brand}\n\nTranslate the following to {target_language}:\n\n"
+    for field, value in fields_data.items():
+        user_prompt += f"=== {field} ===\n{value}\n\n"
+
+    # Translate with GPT-5.1
+    logger.info(f"Calling GPT-5.1 for {len(fields_data)} fields ({target_language}), reasoning effort: {reasoning_effort}")
+    ai_response = translate_with_gpt51(api_key, system_prompt, user_prompt, reasoning_effort)
+
+    if ai_response.get("error"):
+        raise Exception(f"Translation error: {ai_response['error']}")
+
+    response_text = ai_response.get("content", "")
+
+    # Parse results
+    translations = {}
+
+    # Simple parsing - assign full response if single field
+    if len(fields_data) == 1:
+        translations[list(fields_data.keys())[0]] = response_text.strip()
+    else:
+        # Try to parse by field markers
+        current_field = None
+        current_text = []
+        for line in response_text.split('\n'):
+            if line.startswith('===') and line.endswith('==='):
+                if current_field and current_text:
+                    translations[current_field] = '\n'.join(current_text).strip()
+                current_field = line.strip('= ').strip()
+                current_text = []
+            elif current_field:
+                current_text.append(line)
+        if current_field and current_text:
+            translations[current_field] = '\n'.join(current_text).strip()
+
+        # Fallback if parsing failed
+        if not translations:
+            return {list(fields_data.keys())[0]: response_text.strip()}, {}, False
+
+    return translations, ai_response.get("usage", {}), True
+
+
+def execute_localization(run_id: str, input_data: dict) -> None:
+    """Execute the localization workflow."""
+    run = RUN_STORE.live(run_id)
+
+    try:
+        # Get inputs; target_language may be a list to translate into several languages in one run
+        target_language = input_data.get("target_language", "Modern Standard Arabic")
+        languages = list(dict.fromkeys([target_language] if isinstance(target_language, str) else target_language))
+        fields_to_translate = input_data.get("fields_to_translate", [])
+        transliterate_brand = input_data.get("transliterate_brand", True)
+        preserve_html = input_data.get("preserve_html", True)
+        glossary = input_data.get("glossary", "")
+        reasoning_effort = input_data.get("reasoning_effort", "low")
+        cache_mode = input_data.get("cache", "use")
+
+        # Validate required inputs
+        if not fields_to_translate:
             raise Exception("fields_to_translate is required")
+        if not languages:
+            raise Exception("target_language must name at least one language")
         if not glossary:
             raise Exception("glossary is required - please provide unit/abbreviation replacements (e.g., 'V → فولت\\nW → واط')")
+        # A glossary may be shared by all languages, or an object keyed by target language
+        def glossary_text(value: Any) -> str:
+            return value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+
+        if isinstance(glossary, dict) and any(language in glossary for language in languages):
+            glossaries = {language: glossary_text(glossary.get(language, "")) for language in languages}
+        else:
+            glossaries = {language: glossary_text(glossary) for language in languages}
 
         # Get API keys
         trustana_key = os.environ.get("TRUSTANA_API_KEY")
@@ -754,112 +3401,2514 @@ def execute_localization(run_id: str, input_data: dict) -> None:
 
         logger.info(f"Found {len(fields_data)} fields to translate")
 
-        # Step 3: Build translation prompt
-        run["current_step"] = "build_prompt"
+        # Step 3: Look up segments in translation memory, per target language
+        run["current_step"] = "translation_memory"
+        segment_keys = {
+            (language, field): TranslationMemory.make_key(value, language, glossaries[language], TRANSLATION_MODEL)
+            for language in languages
+            for field, value in fields_data.items()
+        }
+        remembered = TRANSLATION_MEMORY.lookup(list(segment_keys.values())) if cache_mode == "use" else {}
+
+        translations: dict[str, dict[str, str]] = {language: {} for language in languages}
+        failed: dict[str, dict[str, str]] = {language: {} for language in languages}
+        tokens_saved = {language: 0 for language in languages}
+        for (language, field), key in segment_keys.items():
+            if key in remembered:
+                translations[language][field], tokens = remembered[key]
+                tokens_saved[language] += tokens
+        pending = {
+            language: {field: value for field, value in fields_data.items() if field not in translations[language]}
+            for language in languages
+        }
+        logger.info(
+            f"Translation memory: {sum(map(len, translations.values()))} hits, {sum(map(len, pending.values()))} misses"
+        )
 
-        system_prompt = f"""You are an expert translator and localization specialist for {target_language}.
+        # Step 4: Translate the misses as token-budgeted chunks, all languages concurrently
+        run["current_step"] = "translate"
+        jobs = [(language, chunk) for language in languages for chunk in chunk_fields(pending[language], LOCALIZATION_CHUNK_TOKENS)]
+        progress = {"total": len(jobs), "processed": 0, "succeeded": 0, "failed": 0}
+        run["progress"] = progress
+        tokens_used = 0
+
+        def record(future, language: str, chunk: dict[str, str]) -> None:
+            nonlocal tokens_used
+            progress["processed"] += 1
+            try:
+                translated, usage, reusable = future.result()
+            except Exception as e:
+                logger.error(f"Localization {run_id} chunk ({language}, {len(chunk)} fields) failed: {e}")
+                failed[language].update({field: str(e) for field in chunk})
+                progress["failed"] += 1
+                EVENT_BUS.publish(run, "chunk_translated", {"language": language, "fields": list(chunk), "error": str(e)})
+                return
+
+            translated = {field: text for field, text in translated.items() if field in chunk}
+            translations[language].update(translated)
+            failed[language].update({field: "Missing from model response" for field in chunk if field not in translated})
+            progress["succeeded"] += 1
+            tokens_used += usage.get("total_tokens", 0)
+            EVENT_BUS.publish(run, "chunk_translated", {"language": language, "fields": list(translated)})
+
+            # Remember cleanly parsed segments, attributing the call's tokens by source length
+            if reusable and cache_mode != "off" and translated:
+                total_tokens = usage.get("total_tokens", 0)
+                total_chars = sum(len(chunk[field]) for field in translated) or 1
+                TRANSLATION_MEMORY.store([
+                    (segment_keys[(language, field)], language, text, round(total_tokens * len(chunk[field]) / total_chars))
+                    for field, text in translated.items()
+                ])
 
-Key principles:
-1. Maintain exact meaning and intent of the original text
-2. Use natural, fluent {target_language} that reads well to native speakers
-3. Handle technical terminology appropriately
-4. Preserve all HTML tags and structure - translate only text content between tags
-5. Transliterate brand names to Arabic script letter-by-letter (e.g., Oppo → أوبو, Samsung → سامسونج, Apple → أبل)
-6. Apply unit/abbreviation replacements from the glossary provided
-7. For Arabic translations: No English letters in translated text (except in HTML attributes and E-XXX codes)
-8. Preserve all numbers exactly as they appear
-9. For acronyms not in glossary, transliterate them letter-by-letter to Arabic script
+        in_flight: dict = {}
+        for language, chunk in jobs:
+            future = TRANSLATION_EXECUTOR.submit(
+                in_context(translate_fields), openai_key, chunk, product_name, brand, language, glossaries[language], reasoning_effort
+            )
+            in_flight[future] = (language, chunk)
+            if len(in_flight) >= LOCALIZATION_CONCURRENCY:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for finished in done:
+                    record(finished, *in_flight.pop(finished))
+        for finished in as_completed(list(in_flight)):
+            record(finished, *in_flight.pop(finished))
+
+        if jobs and progress["succeeded"] == 0:
+            first_error = next(error for errors in failed.values() for error in errors.values())
+            raise Exception(f"Translation failed for every chunk: {first_error}")
+
+        sink_records("translations", "localization", run_id, [
+            {
+                "product_id": product.get("skuId", "unknown"),
+                "field": field,
+                "target_language": language,
+                "original": fields_data.get(field),
+                "translated": text,
+                "from_memory": field not in pending[language],
+            }
+            for language in languages
+            for field, text in translations[language].items()
+        ])
+
+        def memory_stats(language: str) -> dict:
+            hits = len(fields_data) - len(pending[language])
+            return {
+                "hits": hits,
+                "misses": len(pending[language]),
+                "hit_rate": round(hits / len(fields_data), 3),
+                "tokens_saved": tokens_saved[language],
+            }
 
-{f"=== GLOSSARY ==={chr(10)}{glossary}{chr(10)}===" if glossary else ""}
+        # Complete
+        run["status"] = "completed"
+        run["current_step"] = None
+        run["completed_at"] = datetime.utcnow().isoformat()
+        result = {
+            "product_id": product.get("skuId", "unknown"),
+            "product_name": product_name,
+            "brand": brand,
+            "original_fields": fields_data,
+            "target_languages": languages,
+            "languages": {
+                language: {
+                    "translated_fields": translations[language],
+                    "failed_fields": failed[language],
+                    "translation_memory": memory_stats(language),
+                }
+                for language in languages
+            },
+            "field_count": sum(map(len, translations.values())),
+            "chunks": len(jobs),
+            "tokens_used": tokens_used,
+        }
+        if len(languages) == 1:
+            # Single-language runs keep the original flat result shape
+            language = languages[0]
+            result.update({
+                "target_language": language,
+                "translated_fields": translations[language],
+                "failed_fields": failed[language],
+                "translation_memory": memory_stats(language),
+            })
+        run["result"] = result
 
-Return the translated text for each field, clearly labeled."""
+        logger.info(f"Localization workflow {run_id} completed - {result['field_count']} fields translated into {len(languages)} languages")
 
-        user_prompt = f"Product: {product_name}\nBrand: {brand}\n\nTranslate the following to {target_language}:\n\n"
-        for field, value in fields_data.items():
-            user_prompt += f"=== {field} ===\n{value}\n\n"
+    except Exception as e:
+        logger.error(f"Localization workflow error: {e}")
+        run["status"] = "failed"
+        run["error"] = str(e)
+
+
+# jq-style expression engine for `${ ... }` values in workflow specs.
+#
+# Supports the subset the specs use: paths (.a.b[0], .[]), literals, arrays and
+# objects, | , // + - * / % == != < <= > >= and or, if/elif/else/end, `?`,
+# try/catch and common builtins (map, select, to_entries, join, length, ...).
+# Expressions produce streams of values like jq; field access on null yields null.
+
+
+class ExpressionError(Exception):
+    """Raised when a spec expression cannot be parsed or evaluated."""
+
+
+_TOKEN_RE = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<number>\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+  | (?P<field>\.[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<ident>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<op>//|==|!=|<=|>=|\.\.|[.\[\](){}|,:;<>+\-*/%?])
+""", re.VERBOSE)
+
+_KEYWORDS = {"if", "then", "elif", "else", "end", "and", "or", "try", "catch"}
+
+
+def _tokenize(text: str) -> list[tuple[str, str]]:
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = _TOKEN_RE.match(text, pos)
+        if not match:
+            raise ExpressionError(f"Unexpected character {text[pos]!r} at {pos} in: {text}")
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == "ws":
+            continue
+        value = match.group(kind)
+        if kind == "string" and "\\(" in value:
+            raise ExpressionError(f"String interpolation is not supported: {value}")
+        if kind == "ident" and value in _KEYWORDS:
+            kind = "keyword"
+        tokens.append((kind, value))
+    tokens.append(("eof", ""))
+    return tokens
+
+
+class _Parser:
+    """Recursive-descent parser producing a tuple-based AST."""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def peek(self, offset: int = 0) -> tuple[str, str]:
+        return self.tokens[self.pos + offset]
+
+    def next(self) -> tuple[str, str]:
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def accept(self, value: str) -> bool:
+        if self.peek()[1] == value and self.peek()[0] in ("op", "keyword"):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, value: str) -> None:
+        if not self.accept(value):
+            raise ExpressionError(f"Expected {value!r} but found {self.peek()[1]!r} in: {self.text}")
+
+    def parse(self):
+        node = self.pipe()
+        if self.peek()[0] != "eof":
+            raise ExpressionError(f"Unexpected {self.peek()[1]!r} in: {self.text}")
+        return node
+
+    def pipe(self):
+        left = self.comma()
+        if self.accept("|"):
+            return ("pipe", left, self.pipe())
+        return left
+
+    def comma(self):
+        left = self.alternative()
+        while self.accept(","):
+            left = ("comma", left, self.alternative())
+        return left
+
+    def alternative(self):
+        left = self.logical_or()
+        if self.accept("//"):
+            return ("alt", left, self.alternative())
+        return left
+
+    def logical_or(self):
+        left = self.logical_and()
+        while self.accept("or"):
+            left = ("or", left, self.logical_and())
+        return left
+
+    def logical_and(self):
+        left = self.comparison()
+        while self.accept("and"):
+            left = ("and", left, self.comparison())
+        return left
+
+    def comparison(self):
+        left = self.additive()
+        kind, value = self.peek()
+        if kind == "op" and value in ("==", "!=", "<", "<=", ">", ">="):
+            self.next()
+            return ("binop", value, left, self.additive())
+        return left
+
+    def additive(self):
+        left = self.multiplicative()
+        while self.peek() in (("op", "+"), ("op", "-")):
+            left = ("binop", self.next()[1], left, self.multiplicative())
+        return left
+
+    def multiplicative(self):
+        left = self.unary()
+        while self.peek() in (("op", "*"), ("op", "/"), ("op", "%")):
+            left = ("binop", self.next()[1], left, self.unary())
+        return left
+
+    def unary(self):
+        if self.accept("-"):
+            return ("neg", self.unary())
+        return self.postfix()
+
+    def postfix(self):
+        node = self.primary()
+        while True:
+            kind, value = self.peek()
+            if kind == "field":
+                self.next()
+                node = ("field", node, value[1:])
+            elif kind == "op" and value == "." and self.peek(1) == ("op", "["):
+                self.next()
+            elif kind == "op" and value == "." and self.peek(1)[0] == "string":
+                self.next()
+                node = ("field", node, json.loads(self.next()[1]))
+            elif kind == "op" and value == "[":
+                node = self.bracket(node)
+            elif kind == "op" and value == "?":
+                self.next()
+                node = ("try", node)
+            else:
+                return node
+
+    def bracket(self, target):
+        self.expect("[")
+        if self.accept("]"):
+            return ("iterate", target)
+        start = None if self.peek() == ("op", ":") else self.pipe()
+        if self.accept(":"):
+            end = None if self.peek() == ("op", "]") else self.pipe()
+            self.expect("]")
+            return ("slice", target, start, end)
+        self.expect("]")
+        return ("index", target, start)
+
+    def primary(self):
+        kind, value = self.next()
+        if kind == "field":
+            return ("field", ("identity",), value[1:])
+        if kind == "op" and value == ".":
+            if self.peek()[0] == "string":
+                return ("field", ("identity",), json.loads(self.next()[1]))
+            return ("identity",)
+        if kind == "op" and value == "..":
+            return ("recurse",)
+        if kind == "string":
+            return ("literal", json.loads(value))
+        if kind == "number":
+            number = float(value)
+            return ("literal", int(number) if number.is_integer() and "." not in value and "e" not in value.lower() else number)
+        if kind == "op" and value == "(":
+            node = self.pipe()
+            self.expect(")")
+            return node
+        if kind == "op" and value == "[":
+            if self.accept("]"):
+                return ("array", None)
+            node = self.pipe()
+            self.expect("]")
+            return ("array", node)
+        if kind == "op" and value == "{":
+            return self.object()
+        if kind == "keyword" and value == "if":
+            return self.conditional()
+        if kind == "keyword" and value == "try":
+            # try E (same as E?) or try E catch F, where F receives the error message
+            body = self.postfix()
+            return ("try", body, self.postfix()) if self.accept("catch") else ("try", body)
+        if kind == "ident":
+            if value in ("true", "false", "null"):
+                return ("literal", {"true": True, "false": False, "null": None}[value])
+            args = []
+            if self.accept("("):
+                args.append(self.pipe())
+                while self.accept(";"):
+                    args.append(self.pipe())
+                self.expect(")")
+            return ("call", value, tuple(args))
+        raise ExpressionError(f"Unexpected {value!r} in: {self.text}")
+
+    def object(self):
+        entries = []
+        if self.accept("}"):
+            return ("object", tuple(entries))
+        while True:
+            kind, value = self.next()
+            if kind in ("ident", "keyword"):
+                key = ("literal", value)
+            elif kind == "string":
+                key = ("literal", json.loads(value))
+            elif kind == "op" and value == "(":
+                key = self.pipe()
+                self.expect(")")
+            else:
+                raise ExpressionError(f"Invalid object key {value!r} in: {self.text}")
+            if self.accept(":"):
+                entry_value = self.alternative()
+            else:
+                entry_value = ("field", ("identity",), key[1])
+            entries.append((key, entry_value))
+            if self.accept("}"):
+                return ("object", tuple(entries))
+            self.expect(",")
+
+    def conditional(self):
+        branches = []
+        condition = self.pipe()
+        self.expect("then")
+        branches.append((condition, self.pipe()))
+        otherwise = ("identity",)
+        while True:
+            if self.accept("elif"):
+                condition = self.pipe()
+                self.expect("then")
+                branches.append((condition, self.pipe()))
+            elif self.accept("else"):
+                otherwise = self.pipe()
+                self.expect("end")
+                break
+            else:
+                self.expect("end")
+                break
+        return ("if", tuple(branches), otherwise)
+
+
+def parse_expression(text: str):
+    """Parse a jq-style expression into an AST."""
+    return _Parser(text).parse()
 
-        # Step 4: Translate with GPT-5.1
-        run["current_step"] = "translate"
-        logger.info(f"Calling GPT-5.1 with reasoning effort: {reasoning_effort}")
-        ai_response = translate_with_gpt51(openai_key, system_prompt, user_prompt, reasoning_effort)
 
-        if ai_response.get("error"):
-            raise Exception(f"Translation error: {ai_response['error']}")
+def _truthy(value: Any) -> bool:
+    return value is not None and value is not False
 
-        response_text = ai_response.get("content", "")
 
-        # Step 5: Parse results
-        run["current_step"] = "parse_results"
-        translations = {}
+def _type_name(value: Any) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, list):
+        return "array"
+    return "object"
 
-        # Simple parsing - assign full response if single field
-        if len(fields_data) == 1:
-            translations[list(fields_data.keys())[0]] = response_text.strip()
+
+def _tostring(value: Any) -> str:
+    return value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def _binop(op: str, left: Any, right: Any) -> Any:
+    if op == "==":
+        return left == right
+    if op == "!=":
+        return left != right
+    if op in ("<", "<=", ">", ">="):
+        try:
+            return {"<": left < right, "<=": left <= right, ">": left > right, ">=": left >= right}[op]
+        except TypeError:
+            raise ExpressionError(f"Cannot compare {_type_name(left)} and {_type_name(right)}")
+    if op == "+":
+        if left is None:
+            return right
+        if right is None:
+            return left
+        if isinstance(left, dict) and isinstance(right, dict):
+            return {**left, **right}
+    if op == "-" and isinstance(left, list) and isinstance(right, list):
+        return [item for item in left if item not in right]
+    if op == "/" and isinstance(left, str) and isinstance(right, str):
+        return left.split(right)
+    if op in ("+", "-", "*", "/", "%"):
+        valid = (
+            (isinstance(left, (int, float)) and isinstance(right, (int, float)))
+            or (op == "+" and type(left) is type(right) and isinstance(left, (str, list)))
+        )
+        if not valid:
+            raise ExpressionError(f"Cannot apply {op} to {_type_name(left)} and {_type_name(right)}")
+        if op == "+":
+            return left + right
+        if op == "-":
+            return left - right
+        if op == "*":
+            return left * right
+        if right == 0:
+            raise ExpressionError("Division by zero")
+        return left / right if op == "/" else left % right
+    raise ExpressionError(f"Unknown operator {op}")
+
+
+def _index(value: Any, key: Any) -> Any:
+    if value is None:
+        return None
+    if isinstance(key, str):
+        if isinstance(value, dict):
+            return value.get(key)
+        raise ExpressionError(f"Cannot index {_type_name(value)} with {key!r}")
+    if isinstance(key, (int, float)) and not isinstance(key, bool):
+        if isinstance(value, list):
+            i = int(key)
+            return value[i] if -len(value) <= i < len(value) else None
+        raise ExpressionError(f"Cannot index {_type_name(value)} with number")
+    raise ExpressionError(f"Cannot index {_type_name(value)} with {_type_name(key)}")
+
+
+def _recurse(value: Any):
+    yield value
+    if isinstance(value, dict):
+        for item in value.values():
+            yield from _recurse(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _recurse(item)
+
+
+def _iterate(value: Any):
+    if isinstance(value, list):
+        return list(value)
+    if isinstance(value, dict):
+        return list(value.values())
+    raise ExpressionError(f"Cannot iterate over {_type_name(value)}")
+
+
+def _first_value(fn, data: Any) -> Any:
+    for value in fn(data):
+        return value
+    return None
+
+
+# Builtin functions and the argument counts they accept (checked at compile time)
+_BUILTIN_ARITIES = {
+    "empty": {0}, "not": {0}, "map": {1}, "select": {1}, "to_entries": {0}, "from_entries": {0},
+    "join": {1}, "length": {0}, "keys": {0}, "values": {0}, "has": {1}, "add": {0}, "first": {0, 1},
+    "last": {0}, "tostring": {0}, "tonumber": {0}, "tojson": {0}, "fromjson": {0}, "type": {0},
+    "ascii_downcase": {0}, "ascii_upcase": {0}, "split": {1}, "sort": {0}, "unique": {0}, "reverse": {0},
+    "min": {0}, "max": {0}, "any": {0}, "all": {0}, "error": {0, 1},
+}
+
+
+def _call(name: str, args: tuple, data: Any):
+    # Builtins applied to the wrong kind of value fail as expression errors, so //, ? and try handle them
+    try:
+        if name == "empty" and not args:
+            return
+        if name == "not" and not args:
+            yield not _truthy(data)
+        elif name == "map" and len(args) == 1:
+            yield [out for item in _iterate(data) for out in args[0](item)]
+        elif name == "select" and len(args) == 1:
+            for condition in args[0](data):
+                if _truthy(condition):
+                    yield data
+        elif name == "to_entries" and not args:
+            items = data.items() if isinstance(data, dict) else enumerate(_iterate(data))
+            yield [{"key": key, "value": value} for key, value in items]
+        elif name == "from_entries" and not args:
+            result = {}
+            for entry in _iterate(data):
+                key = next((entry.get(k) for k in ("key", "k", "name", "Name", "Key", "K") if entry.get(k) is not None), None)
+                result[_tostring(key)] = entry.get("value", entry.get("v"))
+            yield result
+        elif name == "join" and len(args) == 1:
+            for separator in args[0](data):
+                parts = []
+                for item in _iterate(data):
+                    if isinstance(item, (dict, list)):
+                        raise ExpressionError(f"Cannot join {_type_name(item)}")
+                    parts.append("" if item is None else item if isinstance(item, str) else _tostring(item))
+                yield separator.join(parts)
+        elif name == "length" and not args:
+            if data is None:
+                yield 0
+            elif isinstance(data, bool):
+                raise ExpressionError("boolean has no length")
+            elif isinstance(data, (int, float)):
+                yield abs(data)
+            else:
+                yield len(data)
+        elif name == "keys" and not args:
+            yield sorted(data.keys()) if isinstance(data, dict) else list(range(len(_iterate(data))))
+        elif name == "values" and not args:
+            if data is not None:
+                yield data
+        elif name == "has" and len(args) == 1:
+            for key in args[0](data):
+                yield key in data if isinstance(data, dict) else isinstance(key, int) and 0 <= key < len(data)
+        elif name == "add" and not args:
+            result = None
+            for item in _iterate(data):
+                result = _binop("+", result, item)
+            yield result
+        elif name in ("first", "last") and not args:
+            yield _index(data, 0 if name == "first" else -1)
+        elif name == "first" and len(args) == 1:
+            for value in args[0](data):
+                yield value
+                break
+        elif name == "tostring" and not args:
+            yield _tostring(data)
+        elif name == "tonumber" and not args:
+            try:
+                yield data if isinstance(data, (int, float)) else json.loads(data)
+            except (TypeError, ValueError):
+                raise ExpressionError(f"Cannot parse {data!r} as a number")
+        elif name == "tojson" and not args:
+            yield json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        elif name == "fromjson" and not args:
+            yield json.loads(data)
+        elif name == "type" and not args:
+            yield _type_name(data)
+        elif name in ("ascii_downcase", "ascii_upcase") and not args:
+            if not isinstance(data, str):
+                raise ExpressionError(f"{_type_name(data)} cannot be passed to {name}, a string is required")
+            yield data.lower() if name == "ascii_downcase" else data.upper()
+        elif name == "split" and len(args) == 1:
+            for separator in args[0](data):
+                if not isinstance(data, str) or not isinstance(separator, str):
+                    raise ExpressionError(f"split input and separator must be strings, not {_type_name(data)} and {_type_name(separator)}")
+                yield data.split(separator)
+        elif name in ("sort", "unique", "reverse", "min", "max") and not args:
+            items = _iterate(data)
+            if name == "sort":
+                yield sorted(items, key=json.dumps)
+            elif name == "unique":
+                yield [json.loads(item) for item in sorted({json.dumps(item, sort_keys=True) for item in items})]
+            elif name == "reverse":
+                yield items[::-1]
+            else:
+                yield (min if name == "min" else max)(items) if items else None
+        elif name in ("any", "all") and not args:
+            yield (any if name == "any" else all)(_truthy(item) for item in _iterate(data))
+        elif name == "error":
+            raise ExpressionError(_tostring(_first_value(args[0], data)) if args else _tostring(data))
         else:
-            # Try to parse by field markers
-            current_field = None
-            current_text = []
-            for line in response_text.split('\n'):
-                if line.startswith('===') and line.endswith('==='):
-                    if current_field and current_text:
-                        translations[current_field] = '\n'.join(current_text).strip()
-                    current_field = line.strip('= ').strip()
-                    current_text = []
-                elif current_field:
-                    current_text.append(line)
-            if current_field and current_text:
-                translations[current_field] = '\n'.join(current_text).strip()
-
-            # Fallback if parsing failed
-            if not translations:
-                translations[list(fields_data.keys())[0]] = response_text.strip()
+            raise ExpressionError(f"Unknown function {name}/{len(args)}")
+
+    except (TypeError, ValueError, AttributeError, KeyError) as e:
+        raise ExpressionError(f"{name}: {e}") from e
+
+
+def _field_path(node) -> tuple | None:
+    """Keys of a plain `.a.b[0]` path rooted at the input, or None for anything else."""
+    keys = []
+    while node[0] in ("field", "index"):
+        if node[0] == "field":
+            keys.append(node[2])
+        elif node[2][0] == "literal":
+            keys.append(node[2][1])
+        else:
+            return None
+        node = node[1]
+    return tuple(reversed(keys)) if node[0] == "identity" else None
+
+
+def _compile(node):
+    """Compile an AST node into a function mapping an input value to an iterable of outputs."""
+    kind = node[0]
+    if kind == "identity":
+        return lambda data: (data,)
+    if kind == "literal":
+        value = node[1]
+        return lambda data: (value,)
+    if kind in ("field", "index"):
+        path = _field_path(node)
+        if path is not None:
+            # The common case (.context.step.field[0]): walk the keys without intermediate generators
+            def lookup(data):
+                for key in path:
+                    data = _index(data, key)
+                return (data,)
+            return lookup
+        target, key_fn = _compile(node[1]), _compile(node[2]) if kind == "index" else None
+        if kind == "field":
+            key = node[2]
+            return lambda data: [_index(value, key) for value in target(data)]
+        return lambda data: [_index(value, key) for value in target(data) for key in key_fn(data)]
+    if kind == "slice":
+        target = _compile(node[1])
+        start_fn = _compile(node[2]) if node[2] else None
+        end_fn = _compile(node[3]) if node[3] else None
+
+        def slice_(data):
+            start = _first_value(start_fn, data) if start_fn else None
+            end = _first_value(end_fn, data) if end_fn else None
+            values = []
+            for value in target(data):
+                if value is not None and not isinstance(value, (str, list)):
+                    raise ExpressionError(f"Cannot slice {_type_name(value)}")
+                if not all(bound is None or isinstance(bound, int) for bound in (start, end)):
+                    raise ExpressionError("Slice bounds must be integers")
+                values.append(None if value is None else value[start:end])
+            return values
+        return slice_
+    if kind == "iterate":
+        target = _compile(node[1])
+        return lambda data: [item for value in target(data) for item in _iterate(value)]
+    if kind == "recurse":
+        return _recurse
+    if kind == "pipe":
+        left, right = _compile(node[1]), _compile(node[2])
+        return lambda data: [out for intermediate in left(data) for out in right(intermediate)]
+    if kind == "comma":
+        left, right = _compile(node[1]), _compile(node[2])
+        return lambda data: [*left(data), *right(data)]
+    if kind == "alt":
+        left, right = _compile(node[1]), _compile(node[2])
+
+        def alternative(data):
+            # a // b: the truthy outputs of a (errors suppressed), otherwise b
+            try:
+                values = [value for value in left(data) if _truthy(value)]
+            except ExpressionError:
+                values = []
+            return values or right(data)
+        return alternative
+    if kind in ("and", "or"):
+        left, right = _compile(node[1]), _compile(node[2])
+        short_circuit = kind == "or"
+
+        def boolean(data):
+            for value in left(data):
+                if _truthy(value) == short_circuit:
+                    yield short_circuit
+                else:
+                    for other in right(data):
+                        yield _truthy(other)
+        return boolean
+    if kind == "binop":
+        op, left, right = node[1], _compile(node[2]), _compile(node[3])
+        return lambda data: [_binop(op, lhs, rhs) for rhs in right(data) for lhs in left(data)]
+    if kind == "neg":
+        operand = _compile(node[1])
+        return lambda data: [_binop("-", 0, value) for value in operand(data)]
+    if kind == "array":
+        if node[1] is None:
+            return lambda data: ([],)
+        items = _compile(node[1])
+        return lambda data: (list(items(data)),)
+    if kind == "object":
+        pairs = [(_compile(key), _compile(value)) for key, value in node[1]]
+
+        def build(data):
+            results = [{}]
+            for key_fn, value_fn in pairs:
+                results = [
+                    {**partial, _tostring(key): value}
+                    for partial in results
+                    for key in key_fn(data)
+                    for value in value_fn(data)
+                ]
+            return results
+        return build
+    if kind == "if":
+        return _compile_if(node[1], node[2])
+    if kind == "try":
+        body = _compile(node[1])
+        handler = _compile(node[2]) if len(node) > 2 else None
+
+        def try_(data):
+            try:
+                return list(body(data))
+            except ExpressionError as e:
+                return handler(str(e)) if handler else ()
+        return try_
+    if kind == "call":
+        name, args = node[1], tuple(_compile(arg) for arg in node[2])
+        if len(args) not in _BUILTIN_ARITIES.get(name, ()):
+            raise ExpressionError(f"Unknown function {name}/{len(args)}")
+        return lambda data: _call(name, args, data)
+    raise ExpressionError(f"Unknown expression node {kind}")
+
+
+def _compile_if(branches: tuple, otherwise):
+    condition, then = _compile(branches[0][0]), _compile(branches[0][1])
+    rest = _compile_if(branches[1:], otherwise) if len(branches) > 1 else _compile(otherwise)
+
+    def conditional(data):
+        for value in condition(data):
+            yield from (then if _truthy(value) else rest)(data)
+    return conditional
+
+
+class CompiledExpression:
+    """A `${ ... }` expression parsed and compiled once, with evaluation timings."""
+
+    def __init__(self, text: str):
+        self.text = text
+        self._fn = _compile(parse_expression(text))
+        self._lock = Lock()
+        self.evaluations = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def evaluate(self, data: Any) -> Any:
+        """Return the first output of the expression (None if it yields nothing)."""
+        started = time.perf_counter()
+        failed = False
+        try:
+            return _first_value(self._fn, data)
+        except ExpressionError:
+            failed = True
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self.evaluations += 1
+                self.errors += failed
+                self.total_ms += elapsed_ms
+                self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "expression": " ".join(self.text.split())[:200],
+                "evaluations": self.evaluations,
+                "errors": self.errors,
+                "total_ms": round(self.total_ms, 3),
+                "avg_ms": round(self.total_ms / self.evaluations, 4) if self.evaluations else None,
+                "max_ms": round(self.max_ms, 3),
+            }
+
+
+# Compiled expressions used outside of a loaded spec, by expression text
+EXPRESSION_CACHE_SIZE = int(os.environ.get("EXPRESSION_CACHE_SIZE", "1024"))
+_EXPRESSION_CACHE: OrderedDict[str, CompiledExpression] = OrderedDict()
+_EXPRESSION_CACHE_LOCK = Lock()
+
+
+def compile_expression(text: str) -> CompiledExpression:
+    """Compile a jq-style expression, reusing a previously compiled copy of the same text."""
+    with _EXPRESSION_CACHE_LOCK:
+        compiled = _EXPRESSION_CACHE.get(text)
+        if compiled is not None:
+            _EXPRESSION_CACHE.move_to_end(text)
+            return compiled
+    compiled = CompiledExpression(text)
+    with _EXPRESSION_CACHE_LOCK:
+        compiled = _EXPRESSION_CACHE.setdefault(text, compiled)
+        while len(_EXPRESSION_CACHE) > EXPRESSION_CACHE_SIZE:
+            _EXPRESSION_CACHE.popitem(last=False)
+    return compiled
+
+
+def evaluate_expression(text: str, data: Any) -> Any:
+    """Evaluate a jq-style expression and return its first output (None if it yields nothing)."""
+    return compile_expression(text).evaluate(data)
+
+
+_TEMPLATE_RE = re.compile(r"^\s*\$\{(.*)\}\s*$", re.DOTALL)
+
+
+def render_template(value: Any, scope: dict, expressions: dict[str, CompiledExpression] | None = None) -> Any:
+    """Recursively replace `${ expr }` strings in a spec value with their evaluated result.
+
+    `expressions` maps expression text to its precompiled form (see compile_spec).
+    """
+    if isinstance(value, str):
+        match = _TEMPLATE_RE.match(value)
+        if not match:
+            return value
+        compiled = expressions.get(match.group(1)) if expressions else None
+        return (compiled or compile_expression(match.group(1))).evaluate(scope)
+    if isinstance(value, dict):
+        return {key: render_template(item, scope, expressions) for key, item in value.items()}
+    if isinstance(value, list):
+        return [render_template(item, scope, expressions) for item in value]
+    return value
+
+
+# SW 1.0.2 spec interpreter settings
+SPEC_STEP_WORKERS = int(os.environ.get("SPEC_STEP_WORKERS", "16"))
+
+# Shared pool for spec steps; only the run's own thread waits on it, so steps never deadlock
+SPEC_STEP_EXECUTOR = ThreadPoolExecutor(max_workers=SPEC_STEP_WORKERS, thread_name_prefix="spec-step")
+
+# Callback steps (e.g. approvals): default wait before the run expires (a step can set callback_timeout_sec),
+# and the base URL delivered to the external system for POST /runs/<id>/callback
+CALLBACK_TIMEOUT_SECONDS = float(os.environ.get("CALLBACK_TIMEOUT_SECONDS", "86400"))
+RUNNER_PUBLIC_URL = os.environ.get("RUNNER_PUBLIC_URL", "http://localhost:8015").rstrip("/")
+
+# secret_ref values look like "<tenant>.secrets.<name>"; names map to environment variables
+SECRET_ENV_VARS = {
+    "trustana-api": "TRUSTANA_API_KEY",
+    "openai": "OPENAI_API_KEY",
+    "slack": "SLACK_BOT_TOKEN",
+    "gemini": "GEMINI_API_KEY",
+    "perplexity": "PERPLEXITY_API_KEY",
+    "serpapi": "SERPAPI_API_KEY",
+}
+
+
+class SpecError(Exception):
+    """Raised when a workflow spec is invalid or one of its steps fails."""
+
+
+def resolve_secret(secret_ref: str | None, default_name: str) -> str:
+    """Resolve a spec secret_ref to its value from the environment."""
+    name = (secret_ref or default_name).rsplit(".", 1)[-1]
+    env_var = SECRET_ENV_VARS.get(name, "SECRET_" + re.sub(r"[^A-Za-z0-9]", "_", name).upper())
+    value = os.environ.get(env_var)
+    if not value:
+        raise SpecError(f"{env_var} not set (secret_ref: {secret_ref or default_name})")
+    return value
+
+
+_CONTEXT_REF_RE = re.compile(r"\.context\.([A-Za-z_][A-Za-z0-9_]*)")
+_VARIABLE_REF_RE = re.compile(r"\.variables(\.[A-Za-z_][A-Za-z0-9_]*)?")
+
+
+def _spec_expressions(value: Any) -> list[str]:
+    """All `${ ... }` expression bodies found in a spec value."""
+    if isinstance(value, str):
+        match = _TEMPLATE_RE.match(value)
+        return [match.group(1)] if match else []
+    if isinstance(value, dict):
+        return [expr for item in value.values() for expr in _spec_expressions(item)]
+    if isinstance(value, list):
+        return [expr for item in value for expr in _spec_expressions(item)]
+    return []
+
+
+def awaits_callback(body: dict) -> bool:
+    """Whether a step suspends its run until POST /runs/<id>/callback: an external action with
+    await_callback, or one whose payload asks for approval."""
+    args = body.get("with")
+    if body.get("call") != "external_actions_bridge" or not isinstance(args, dict):
+        return False
+    payload = args.get("payload")
+    return args.get("await_callback") is True or (isinstance(payload, dict) and payload.get("approval_required") is True)
+
+
+def plan_spec_steps(sw_spec: dict) -> list[dict]:
+    """Parse sw_spec.do into steps with data/control dependencies.
+
+    A step depends on earlier steps it reads via .context.<step>, on earlier
+    set steps that write the .variables it reads (or all of them for a bare
+    .variables reference), and on the nearest preceding switch. Set steps also
+    wait for earlier readers/writers of the variables they overwrite.
+    """
+    entries = sw_spec.get("do")
+    if not isinstance(entries, list) or not entries:
+        raise SpecError("sw_spec.do must be a non-empty list of steps")
+
+    steps = []
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict) or len(entry) != 1:
+            raise SpecError(f"Step #{index} must be an object with exactly one step name")
+        name, body = next(iter(entry.items()))
+        kinds = [kind for kind in ("call", "set", "switch") if kind in body]
+        if len(kinds) != 1:
+            raise SpecError(f"Step {name}: expected exactly one of call, set or switch")
+        if any(step["name"] == name for step in steps):
+            raise SpecError(f"Duplicate step name: {name}")
+
+        expressions = _spec_expressions(body)
+        variable_refs = [m for expr in expressions for m in _VARIABLE_REF_RE.findall(expr)]
+        steps.append({
+            "name": name,
+            "index": index,
+            "kind": kinds[0],
+            "body": body,
+            "context_refs": {m for expr in expressions for m in _CONTEXT_REF_RE.findall(expr)},
+            # None means "reads all variables"
+            "variable_refs": None if "" in variable_refs else {ref[1:] for ref in variable_refs},
+            "writes": set(body["set"]) if kinds[0] == "set" and isinstance(body["set"], dict) else set(),
+            "awaits_callback": awaits_callback(body),
+            "deps": set(),
+        })
+
+    for step in steps:
+        earlier = steps[:step["index"]]
+        earlier_names = {dep["name"] for dep in earlier}
+        unknown = step["context_refs"] - earlier_names
+        if unknown:
+            raise SpecError(f"Step {step['name']} references .context.{sorted(unknown)[0]}, which is not an earlier step")
+
+        for dep in earlier:
+            reads_dep_context = dep["name"] in step["context_refs"]
+            reads_dep_variables = dep["writes"] and (step["variable_refs"] is None or dep["writes"] & step["variable_refs"])
+            overwrites_dep_variables = step["writes"] and (
+                dep["writes"] & step["writes"]
+                or dep["variable_refs"] is None
+                or dep["variable_refs"] & step["writes"]
+            )
+            if reads_dep_context or reads_dep_variables or overwrites_dep_variables:
+                step["deps"].add(dep["name"])
+
+        switches = [dep for dep in earlier if dep["kind"] == "switch"]
+        if switches:
+            step["deps"].add(switches[-1]["name"])
+
+    return steps
+
+
+# Compiled spec versions kept in memory
+SPEC_CACHE_SIZE = int(os.environ.get("SPEC_CACHE_SIZE", "64"))
+
+
+def spec_version(workflow: dict) -> str:
+    """Content hash identifying one version of a workflow spec."""
+    canonical = json.dumps(workflow, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()[:12]
+
+
+class CompiledSpec:
+    """One workflow spec version with its step plan and every `${ ... }` expression compiled."""
+
+    def __init__(self, flow_id: str, version: str, sw_spec: dict):
+        self.flow_id = flow_id
+        self.version = version
+        self.compiled_at = datetime.utcnow().isoformat()
+        self.steps = plan_spec_steps(sw_spec)
+        self.expressions: dict[str, CompiledExpression] = {}
+        for text in _spec_expressions(sw_spec):
+            if text not in self.expressions:
+                try:
+                    self.expressions[text] = CompiledExpression(text)
+                except ExpressionError as e:
+                    raise SpecError(f"Invalid expression ${{{' '.join(text.split())[:80]}}}: {e}") from e
+
+    def render(self, value: Any, scope: dict) -> Any:
+        return render_template(value, scope, self.expressions)
+
+    def stats(self) -> dict:
+        expressions = sorted((e.stats() for e in self.expressions.values()), key=lambda e: e["total_ms"], reverse=True)
+        return {
+            "flow_id": self.flow_id,
+            "version": self.version,
+            "compiled_at": self.compiled_at,
+            "evaluations": sum(e["evaluations"] for e in expressions),
+            "total_ms": round(sum(e["total_ms"] for e in expressions), 3),
+            "expressions": expressions,
+        }
+
+
+_COMPILED_SPECS: OrderedDict[tuple[str, str], CompiledSpec] = OrderedDict()
+_COMPILED_SPECS_LOCK = Lock()
+
+
+def compile_spec(workflow: dict, version: str | None = None) -> CompiledSpec:
+    """Compile a workflow's sw_spec once per spec version (pass a known version to skip hashing)."""
+    flow_id = workflow.get("flow_id") or workflow.get("workflow_id", "")
+    key = (flow_id, version or spec_version(workflow))
+    with _COMPILED_SPECS_LOCK:
+        compiled = _COMPILED_SPECS.get(key)
+        if compiled is not None:
+            _COMPILED_SPECS.move_to_end(key)
+            return compiled
+
+    started = time.perf_counter()
+    compiled = CompiledSpec(flow_id, key[1], workflow.get("sw_spec") or {})
+    logger.info(
+        f"Compiled spec {flow_id}@{key[1]}: {len(compiled.steps)} steps, {len(compiled.expressions)} expressions "
+        f"in {(time.perf_counter() - started) * 1000:.1f}ms"
+    )
+    with _COMPILED_SPECS_LOCK:
+        compiled = _COMPILED_SPECS.setdefault(key, compiled)
+        while len(_COMPILED_SPECS) > SPEC_CACHE_SIZE:
+            _COMPILED_SPECS.popitem(last=False)
+    return compiled
+
+
+def call_data_gateway(args: dict) -> dict:
+    """data_gateway: read records from a connector stream."""
+    connector_id = args.get("connector_id")
+    stream_id = args.get("stream_id", "products")
+    if connector_id != "trustana-api" or stream_id != "products":
+        raise SpecError(f"Unsupported data_gateway stream: {connector_id}/{stream_id}")
+
+    api_key = resolve_secret(args.get("secret_ref"), "trustana-api")
+    params = args.get("params") or {}
+    products = list(iter_trustana_products(
+        api_key,
+        filters=params.get("filter"),
+        product_ids=params.get("product_ids"),
+        max_records=params.get("max_records", 1),
+        prefetch_pages=0,
+    ))
+    logger.info(f"data_gateway fetched {len(products)} products")
+    return {"records": {"products": products}, "count": len(products)}
+
+
+def _parse_json_response(text: str) -> Any:
+    """Parse a JSON object from an LLM reply, tolerating code fences and surrounding prose."""
+    cleaned = re.sub(r"^```(?:json)?\s*|\s*```$", "", text.strip())
+    try:
+        return json.loads(cleaned)
+    except ValueError:
+        start, end = cleaned.find("{"), cleaned.rfind("}")
+        if start != -1 and end > start:
+            try:
+                return json.loads(cleaned[start:end + 1])
+            except ValueError:
+                pass
+    raise SpecError(f"Agent response is not valid JSON: {text[:200]}")
+
+
+def call_agent_adapter(args: dict) -> dict:
+    """agent_adapter: run an LLM call (OpenAI Responses API) and parse its composite_schema output."""
+    llm_config = args.get("llm_config") or {}
+    provider, _, model = llm_config.get("model", "openai/" + TRANSLATION_MODEL).rpartition("/")
+    if (provider or "openai") != "openai" or llm_config.get("api_type", "responses") != "responses":
+        raise SpecError(f"Unsupported agent_adapter model/api_type: {llm_config.get('model')}/{llm_config.get('api_type')}")
+
+    api_key = resolve_secret(llm_config.get("secret_ref"), "openai")
+    messages = [{"role": m.get("role", "user"), "content": m.get("content") or ""} for m in args.get("messages", [])]
+    schema = args.get("composite_schema")
+    if schema:
+        messages.append({
+            "role": "system",
+            "content": "Respond with only a JSON object that matches this JSON schema:\n" + json.dumps(schema),
+        })
+
+    limits = args.get("limits") or {}
+    body = {
+        "model": model,
+        "input": messages,
+        "text": llm_config.get("text") or {"format": {"type": "text"}},
+        "tools": [],
+        "store": True,
+    }
+    reasoning = {key: value for key, value in (llm_config.get("reasoning") or {}).items() if value is not None}
+    if reasoning:
+        body["reasoning"] = reasoning
+    if limits.get("max_output_tokens"):
+        body["max_output_tokens"] = limits["max_output_tokens"]
+
+    logger.info(f"agent_adapter calling {model} for agent {args.get('agent_id')}")
+    ai_response = call_openai_responses(api_key, body, timeout=limits.get("timeout_sec"))
+    if ai_response.get("error"):
+        raise SpecError(f"Agent error: {ai_response['error']}")
+
+    content = ai_response.get("content", "")
+    response = _parse_json_response(content) if schema else content
+    return {"output": {"response": response, "text": content}, "usage": ai_response.get("usage", {})}
+
+
+def call_external_actions_bridge(args: dict) -> dict:
+    """external_actions_bridge: deliver a payload to Slack or an HTTP endpoint."""
+    channel = args.get("channel")
+    payload = args.get("payload") or {}
+
+    if channel == "slack":
+        token = resolve_secret(args.get("secret_ref"), "slack")
+        slack_channel = payload.get("channel") or os.environ.get("SLACK_CHANNEL", "C09M1SAG22E")
+        result = send_to_slack(token, slack_channel, payload.get("text", ""), blocks=payload.get("blocks"))
+        if result.get("error"):
+            raise SpecError(f"Slack error: {result['error']}")
+        return {"channel": "slack", "payload": result}
+
+    if channel == "api":
+        config = args.get("channel_config") or {}
+        if not config.get("url"):
+            raise SpecError("external_actions_bridge api channel requires channel_config.url")
+        if args.get("callback"):
+            payload = {**payload, "callback_url": args["callback"]["url"]}
+        response = HTTP_POOL.request(
+            config.get("method", "POST"), config["url"],
+            json=payload, headers=config.get("headers"), timeout=config.get("timeout_sec"),
+        )
+        if response.status_code >= 400:
+            raise SpecError(f"External action error: {response.status_code} - {response.text[:500]}")
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        return {"channel": "api", "status_code": response.status_code, "payload": data if isinstance(data, dict) else {"response": data}}
+
+    raise SpecError(f"Unsupported external_actions_bridge channel: {channel}")
+
+
+SPEC_CALL_HANDLERS = {
+    "data_gateway": call_data_gateway,
+    "agent_adapter": call_agent_adapter,
+    "external_actions_bridge": call_external_actions_bridge,
+}
+
+
+def run_spec_step(step: dict, scope: dict, spec: CompiledSpec, callback: dict | None = None) -> Any:
+    """Execute one spec step against a snapshot of the run scope (callback: where a callback step's
+    external system reports back)."""
+    activate_step(step["name"])
+    body = step["body"]
+    try:
+        if step["kind"] == "set":
+            return spec.render(body["set"], scope)
+
+        if step["kind"] == "switch":
+            for case in body["switch"]:
+                case_name, case_body = next(iter(case.items()))
+                when = case_body.get("when")
+                if when is None or _truthy(spec.render(when, scope)):
+                    return {"case": case_name, "then": case_body.get("then", "continue")}
+            return {"case": None, "then": "continue"}
+
+        handler = SPEC_CALL_HANDLERS.get(body["call"])
+        if handler is None:
+            raise SpecError(f"Unsupported call: {body['call']}")
+        args = spec.render(body.get("with") or {}, scope)
+        if callback:
+            args["callback"] = callback
+        return handler(args)
+    except (SpecError, ExpressionError) as e:
+        raise SpecError(f"Step {step['name']} failed: {e}") from e
+
+
+def execute_spec_workflow(run_id: str, workflow: dict, input_data: dict) -> None:
+    """Interpret a workflow's sw_spec, running independent steps concurrently.
+
+    A callback step (see awaits_callback) is marked waiting once delivered. When
+    nothing else can proceed, the interpreter state is persisted on the run, which
+    is left waiting without holding a thread; the run resumes from that state
+    with each callback body as its step's payload.
+    """
+    run = RUN_STORE.live(run_id)
+
+    try:
+        spec = compile_spec(workflow, run.get("spec_version"))
+        steps = spec.steps
+        by_name = {step["name"]: step for step in steps}
+        spec_input = {**(workflow.get("input") or {}), **input_data}
+        suspended = run.get("suspended")
+        if suspended:
+            context, variables = suspended["context"], suspended["variables"]
+            states, ended_by, token = suspended["states"], suspended["ended_by"], suspended["token"]
+            waiting = suspended["waiting"]
+            for name in [name for name, wait in waiting.items() if wait.get("callback") is not None]:
+                delivered = context.get(name) or {}
+                context[name] = {**delivered, "payload": waiting.pop(name)["callback"], "delivery": delivered.get("payload")}
+                states[name] = "completed"
+            for key in ("suspended", "waiting_for", "expires_at"):
+                run.pop(key, None)
+            logger.info(f"Run {run_id} resumed ({len(waiting)} callback steps still waiting)")
+        else:
+            context: dict[str, Any] = {}
+            variables: dict[str, Any] = {}
+            states = {step["name"]: "pending" for step in steps}
+            ended_by = None
+            waiting: dict[str, dict] = {}
+            token = secrets.token_urlsafe(16) if any(step["awaits_callback"] for step in steps) else None
+        running: dict = {}
+
+        run["status"] = "running"
+        run["steps"] = states
+
+        def skip_pending(after: int, before: int | None = None) -> None:
+            for step in steps:
+                if states[step["name"]] == "pending" and step["index"] > after and (before is None or step["index"] < before):
+                    states[step["name"]] = "skipped"
+
+        try:
+            while True:
+                if run.detached:
+                    raise SpecError("Job lease lost to another worker")
+                for step in steps:
+                    if states[step["name"]] != "pending":
+                        continue
+                    if all(states[dep] in ("completed", "skipped") for dep in step["deps"]):
+                        scope = {"input": spec_input, "context": dict(context), "variables": dict(variables)}
+                        callback = {
+                            "url": f"{RUNNER_PUBLIC_URL}/runs/{run_id}/callback?step={step['name']}&token={token}",
+                        } if step["awaits_callback"] else None
+                        running[SPEC_STEP_EXECUTOR.submit(in_context(run_spec_step), step, scope, spec, callback)] = step
+                        states[step["name"]] = "running"
+
+                run["current_step"] = ", ".join(step["name"] for step in running.values()) or None
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    if future.exception() is not None:
+                        states[step["name"]] = "failed"
+                    output = future.result()
+                    context[step["name"]] = output
+                    states[step["name"]] = "completed"
+
+                    if step["awaits_callback"]:
+                        # Delivered; the step completes when its callback arrives
+                        args = step["body"]["with"]
+                        timeout = float(args.get("callback_timeout_sec") or CALLBACK_TIMEOUT_SECONDS)
+                        waiting[step["name"]] = {
+                            "expires_at": (datetime.utcnow() + timedelta(seconds=timeout)).isoformat(),
+                            "on_timeout": args.get("on_timeout", "fail"),
+                            "callback": None,
+                        }
+                        states[step["name"]] = WAITING_STATUS
+
+                    if step["kind"] == "set":
+                        variables.update(output)
+                    elif step["kind"] == "switch":
+                        target = output["then"]
+                        logger.info(f"Run {run_id} switch {step['name']} -> {output['case']} ({target})")
+                        if target in ("end", "exit"):
+                            ended_by = step["name"]
+                            skip_pending(step["index"])
+                        elif target != "continue":
+                            if target not in by_name or by_name[target]["index"] <= step["index"]:
+                                raise SpecError(f"Switch {step['name']} jumps to unknown or earlier step {target!r}")
+                            skip_pending(step["index"], by_name[target]["index"])
+        except BaseException:
+            # A failed step fails the run: cancel steps not yet started and wait for the rest
+            for future, step in running.items():
+                if future.cancel():
+                    states[step["name"]] = "cancelled"
+            # A cancelled future only counts as done once a pool worker dequeues it, so don't wait on those
+            wait([future for future in running if not future.cancelled()])
+            for future, step in running.items():
+                if not future.cancelled():
+                    states[step["name"]] = "failed" if future.exception() is not None else "completed"
+            raise
+
+        if waiting:
+            run["suspended"] = {
+                "workflow": workflow,
+                "context": context,
+                "variables": variables,
+                "states": states,
+                "ended_by": ended_by,
+                "token": token,
+                "waiting": waiting,
+            }
+            run["waiting_for"] = sorted(waiting)
+            run["expires_at"] = min(wait["expires_at"] for wait in waiting.values())
+            # Still "running": the executor parks it as waiting once it has let go of it (park_run)
+            run["current_step"] = None
+            logger.info(f"Spec workflow {run_id} waiting for callbacks on {', '.join(sorted(waiting))} until {run['expires_at']}")
+            return
 
-        # Complete
         run["status"] = "completed"
         run["current_step"] = None
         run["completed_at"] = datetime.utcnow().isoformat()
-        run["result"] = {
-            "product_id": product.get("skuId", "unknown"),
-            "product_name": product_name,
-            "brand": brand,
-            "target_language": target_language,
-            "original_fields": fields_data,
-            "translated_fields": translations,
-            "field_count": len(translations),
-        }
+        run["result"] = variables.get("workflow_result") or {"variables": variables, "ended_by": ended_by}
 
-        logger.info(f"Localization workflow {run_id} completed - {len(translations)} fields translated")
+        logger.info(f"Spec workflow {run_id} completed ({sum(s == 'completed' for s in states.values())} steps run)")
 
     except Exception as e:
-        logger.error(f"Localization workflow error: {e}")
+        logger.error(f"Spec workflow error: {e}")
         run["status"] = "failed"
+        run["current_step"] = None
         run["error"] = str(e)
 
 
+# Flows executed by dedicated handlers rather than by interpreting their sw_spec. A
+# built-in flow's sw_spec is still validated, but not executed: the localization handler
+# translates into several languages per run and reuses cached translations, which
+# localization.json's single-language sw_spec does not express.
+BUILTIN_FLOWS = ("trustana-serpapi-csv", "aeo-visibility-score", "localization")
+
+
 def execute_workflow(run_id: str, workflow: dict, input_data: dict = None, flow_id: str = None) -> None:
-    """Execute a workflow based on flow_id."""
+    """Execute a workflow: built-in handlers by flow_id, otherwise interpret its sw_spec."""
     # Support both workflow_id (from spec) and flow_id (from request)
     flow_id = flow_id or workflow.get("workflow_id", "") or workflow.get("flow_id", "")
     input_data = input_data or {}
 
     if flow_id == "trustana-serpapi-csv":
-        execute_trustana_serpapi_csv(run_id)
+        execute_trustana_serpapi_csv(run_id, input_data)
     elif flow_id == "aeo-visibility-score":
         execute_aeo_visibility(run_id, input_data)
     elif flow_id == "localization":
         execute_localization(run_id, input_data)
+    elif workflow.get("sw_spec"):
+        execute_spec_workflow(run_id, workflow, input_data)
     else:
-        run = RUNS[run_id]
+        run = RUN_STORE.live(run_id)
         run["status"] = "failed"
         run["error"] = f"Unsupported workflow: {flow_id}"
 
 
+# Workflow registry settings
+# Seconds between checks of WORKFLOW_DIR for added, changed or removed specs (0 disables reloading)
+WORKFLOW_RELOAD_INTERVAL = float(os.environ.get("WORKFLOW_RELOAD_INTERVAL", "5"))
+# Refuse to start when any spec in WORKFLOW_DIR is invalid
+WORKFLOW_STRICT = os.environ.get("WORKFLOW_STRICT", "false").lower() == "true"
+
+_SCHEMA_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "number": (int, float),
+    "integer": int,
+    "boolean": bool,
+    "null": type(None),
+}
+
+
+def _matches_type(value: Any, types: str | list) -> bool:
+    for name in types if isinstance(types, list) else [types]:
+        expected = _SCHEMA_TYPES[name]
+        if isinstance(value, expected) and not (isinstance(value, bool) and name in ("number", "integer")):
+            return True
+    return False
+
+
+def check_input_schema(schema: Any, path: str = "input_schema") -> list[str]:
+    """Structural problems in a (JSON Schema subset) input_schema."""
+    if not isinstance(schema, dict):
+        return [f"{path} must be an object"]
+    errors = []
+    types = schema.get("type")
+    if types is not None:
+        unknown = [t for t in (types if isinstance(types, list) else [types]) if t not in _SCHEMA_TYPES]
+        if unknown:
+            return [f"{path}.type: unknown type {unknown[0]!r}"]
+    if "enum" in schema and not isinstance(schema["enum"], list):
+        errors.append(f"{path}.enum must be a list")
+    if "default" in schema:
+        errors += [f"{path}.default: {error}" for error in validate_input(schema["default"], schema)]
+
+    properties = schema.get("properties", {})
+    if not isinstance(properties, dict):
+        errors.append(f"{path}.properties must be an object")
+        properties = {}
+    for name, prop in properties.items():
+        errors += check_input_schema(prop, f"{path}.properties.{name}")
+    required = schema.get("required", [])
+    if not isinstance(required, list):
+        errors.append(f"{path}.required must be a list")
+    else:
+        errors += [f"{path}.required: {name!r} is not a declared property" for name in required if name not in properties]
+    if "items" in schema:
+        errors += check_input_schema(schema["items"], f"{path}.items")
+    return errors
+
+
+def validate_input(value: Any, schema: dict, path: str = "input", partial: bool = False) -> list[str]:
+    """Problems with a value against a (JSON Schema subset) schema; `partial` skips required checks."""
+    if "type" in schema and not _matches_type(value, schema["type"]):
+        return [f"{path}: expected {schema['type']}, got {_type_name(value)}"]
+    errors = []
+    if isinstance(schema.get("enum"), list) and value not in schema["enum"]:
+        errors.append(f"{path}: {value!r} is not one of {schema['enum']}")
+    if isinstance(value, dict):
+        if not partial:
+            errors += [f"{path}.{name} is required" for name in schema.get("required", []) if name not in value]
+        for name, prop in (schema.get("properties") or {}).items():
+            if name in value and isinstance(prop, dict):
+                errors += validate_input(value[name], prop, f"{path}.{name}", partial)
+    if isinstance(value, list) and isinstance(schema.get("items"), dict):
+        for i, item in enumerate(value):
+            errors += validate_input(item, schema["items"], f"{path}[{i}]", partial)
+    return errors
+
+
+def validate_workflow(flow_id: str, spec: Any) -> list[str]:
+    """Problems that make a workflow spec unusable; compiles its sw_spec as a side effect."""
+    if not isinstance(spec, dict):
+        return ["spec must be a JSON object"]
+    errors = []
+    if spec.get("flow_id") and spec["flow_id"] != flow_id:
+        errors.append(f"flow_id {spec['flow_id']!r} does not match file name {flow_id!r}")
+    if not isinstance(spec.get("input", {}), dict):
+        errors.append("input must be an object")
+    if "input_schema" in spec:
+        schema_errors = check_input_schema(spec["input_schema"])
+        errors += schema_errors
+        if not schema_errors and isinstance(spec.get("input", {}), dict):
+            errors += [f"input defaults: {error}" for error in validate_input(spec.get("input", {}), spec["input_schema"], partial=True)]
+    if spec.get("sw_spec"):
+        try:
+            compile_spec(spec)
+        except SpecError as e:
+            errors.append(f"sw_spec: {e}")
+    elif flow_id not in BUILTIN_FLOWS:
+        errors.append("sw_spec is required for workflows without a built-in handler")
+    return errors
+
+
+class WorkflowRegistry:
+    """Validated workflow specs from WORKFLOW_DIR, held in memory and reloaded when files change.
+
+    Specs are shared between runs and must be treated as read-only. When a
+    changed file fails validation the previously loaded version keeps serving
+    and the errors are reported through invalid().
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self._entries: dict[str, dict] = {}
+        self._invalid: dict[str, dict] = {}
+        self._mtimes: dict[str, float] = {}
+        self._lock = Lock()
+        self._checked_at = 0.0
+
+    def refresh(self) -> list[str]:
+        """Load new or modified spec files and drop removed ones; returns flow_ids that failed validation."""
+        with self._lock:
+            self._checked_at = time.monotonic()
+            files = {path.stem: path for path in self.directory.glob("*.json")} if self.directory.is_dir() else {}
+            for flow_id in set(self._mtimes) - set(files):
+                self._mtimes.pop(flow_id)
+                self._invalid.pop(flow_id, None)
+                if self._entries.pop(flow_id, None):
+                    logger.info(f"Workflow {flow_id} removed")
+
+            failed = []
+            for flow_id, path in files.items():
+                try:
+                    mtime = path.stat().st_mtime
+                except OSError:
+                    continue
+                if self._mtimes.get(flow_id) == mtime:
+                    continue
+                self._mtimes[flow_id] = mtime
+                if not self._load(flow_id, path, mtime):
+                    failed.append(flow_id)
+            return failed
+
+    def _load(self, flow_id: str, path: Path, mtime: float) -> bool:
+        try:
+            with open(path) as f:
+                spec = json.load(f)
+            errors = validate_workflow(flow_id, spec)
+        except (OSError, ValueError) as e:
+            errors = [f"unreadable spec: {e}"]
+        if errors:
+            self._invalid[flow_id] = {"flow_id": flow_id, "path": str(path), "errors": errors}
+            kept = " (previous version still active)" if flow_id in self._entries else ""
+            logger.error(f"Invalid workflow spec {path}{kept}: " + "; ".join(errors))
+            return False
+
+        self._invalid.pop(flow_id, None)
+        version = spec_version(spec)
+        previous = self._entries.get(flow_id)
+        self._entries[flow_id] = {
+            "flow_id": flow_id,
+            "spec": spec,
+            "version": version,
+            "name": spec.get("name", flow_id),
+            "description": (spec.get("metadata") or {}).get("description", ""),
+            "loaded_at": datetime.utcnow().isoformat(),
+            "modified_at": datetime.utcfromtimestamp(mtime).isoformat(),
+        }
+        if previous is None:
+            logger.info(f"Loaded workflow {flow_id}@{version}")
+        elif previous["version"] != version:
+            logger.info(f"Reloaded workflow {flow_id}: {previous['version']} -> {version}")
+        return True
+
+    def _maybe_refresh(self) -> None:
+        if WORKFLOW_RELOAD_INTERVAL > 0 and time.monotonic() - self._checked_at >= WORKFLOW_RELOAD_INTERVAL:
+            self.refresh()
+
+    def get(self, flow_id: str) -> dict | None:
+        """The registry entry (spec, version, ...) for a workflow."""
+        self._maybe_refresh()
+        return self._entries.get(flow_id)
+
+    def invalid(self, flow_id: str | None = None) -> Any:
+        """Validation errors of a workflow, or of all invalid workflows."""
+        self._maybe_refresh()
+        if flow_id is not None:
+            return self._invalid.get(flow_id)
+        return sorted(self._invalid.values(), key=lambda entry: entry["flow_id"])
+
+    def list(self) -> list[dict]:
+        self._maybe_refresh()
+        return sorted(self._entries.values(), key=lambda entry: entry["flow_id"])
+
+
+WORKFLOWS = WorkflowRegistry(Path(WORKFLOW_DIR))
+_invalid_workflows = WORKFLOWS.refresh()
+if _invalid_workflows and WORKFLOW_STRICT:
+    raise SystemExit(f"Invalid workflow specs in {WORKFLOW_DIR}: {', '.join(sorted(_invalid_workflows))}")
+logger.info(f"Workflow registry: {len(WORKFLOWS.list())} workflows loaded from {WORKFLOW_DIR}")
+
+
+# Run scheduler settings
+RUNNER_WORKERS = int(os.environ.get("RUNNER_WORKERS", "8"))
+RUNNER_QUEUE_SIZE = int(os.environ.get("RUNNER_QUEUE_SIZE", "100"))
+# Assumed run duration (seconds) for start-time estimates until real runs have finished
+RUNNER_DEFAULT_RUN_SECONDS = float(os.environ.get("RUNNER_DEFAULT_RUN_SECONDS", "30"))
+
+
+class SchedulerFull(Exception):
+    """Raised when the pending run queue is at capacity."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Run queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class RunScheduler:
+    """Fixed pool of worker threads draining a bounded FIFO of pending runs."""
+
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._pending: deque[tuple[str, Any, tuple]] = deque()
+        self._tickets: dict[str, int] = {}
+        self._enqueued = 0
+        self._dequeued = 0
+        self._active = 0
+        self._avg_duration = RUNNER_DEFAULT_RUN_SECONDS
+        self._cond = Condition()
+        self._threads: list[Thread] = []
+
+    def _start_workers(self) -> None:
+        # Started lazily so importing the module (or the Flask reloader parent) spawns no threads
+        for i in range(self.workers):
+            thread = Thread(target=self._worker, name=f"run-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Run scheduler started: {self.workers} workers, queue size {self.queue_size}")
+
+    def submit(self, run_id: str, fn, *args) -> int:
+        """Queue fn(*args) for execution; returns the 1-based queue position."""
+        with self._cond:
+            if len(self._pending) >= self.queue_size:
+                raise SchedulerFull(self._retry_after())
+            if not self._threads:
+                self._start_workers()
+            self._enqueued += 1
+            self._tickets[run_id] = self._enqueued
+            self._pending.append((run_id, fn, args))
+            self._cond.notify()
+            return self._enqueued - self._dequeued
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                run_id, fn, args = self._pending.popleft()
+                self._tickets.pop(run_id, None)
+                self._dequeued += 1
+                self._active += 1
+
+            started = time.monotonic()
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error(f"Run {run_id} crashed in scheduler worker: {e}")
+            finally:
+                duration = time.monotonic() - started
+                with self._cond:
+                    self._active -= 1
+                    # Exponential moving average feeds queue start-time estimates
+                    self._avg_duration = 0.8 * self._avg_duration + 0.2 * duration
+
+    def position(self, run_id: str) -> int | None:
+        """1-based position of a pending run, or None if it is not queued."""
+        with self._cond:
+            ticket = self._tickets.get(run_id)
+            return ticket - self._dequeued if ticket is not None else None
+
+    def estimated_wait(self, position: int) -> float:
+        """Estimated seconds until the run at the given queue position starts."""
+        with self._cond:
+            free = self.workers - self._active
+            if position <= free:
+                return 0.0
+            rounds = -(-(position - free) // self.workers)
+            return rounds * self._avg_duration
+
+    def _retry_after(self) -> int:
+        # Time for roughly one worker slot to free up
+        return max(1, round(self._avg_duration / self.workers))
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "workers": self.workers,
+                "active": self._active,
+                "queued": len(self._pending),
+                "queue_size": self.queue_size,
+                "avg_run_seconds": round(self._avg_duration, 2),
+            }
+
+
+SCHEDULER = RunScheduler(RUNNER_WORKERS, RUNNER_QUEUE_SIZE)
+
+
+@METRICS.collector
+def collect_scheduler_metrics() -> None:
+    RUNS_WAITING.set(RUN_STORE.count(status=WAITING_STATUS))
+    if RUNNER_MODE == "queue":
+        stats = JOB_QUEUE.stats()
+        RUNS_ACTIVE.set(stats["leased"])
+        RUNS_QUEUED.set(stats["queued"])
+        RUN_QUEUE_CAPACITY.set(stats["max_pending"])
+        return
+    stats = SCHEDULER.stats()
+    RUNS_ACTIVE.set(stats["active"])
+    RUNS_QUEUED.set(stats["queued"])
+    RUN_QUEUE_CAPACITY.set(stats["queue_size"])
+
+
+def run_scheduled(run_id: str, workflow: dict, input_data: dict, flow_id: str) -> None:
+    """Scheduler entry point: mark the run as started and dispatch it."""
+    run = RUN_STORE.live(run_id)
+    # A run resumed from waiting keeps its start time and continues its trace
+    resumed = bool(run.get("suspended"))
+    run.trace = RunTrace(run_id, flow_id, RUN_STORE.get_trace(run_id) if resumed else None)
+    if not (resumed and run.get("started_at")):
+        run["started_at"] = datetime.utcnow().isoformat()
+    run["status"] = "starting"
+    token = _CURRENT_SPAN.set(run.trace.root)
+    try:
+        execute_workflow(run_id, workflow, input_data, flow_id)
+    finally:
+        _CURRENT_SPAN.reset(token)
+        if run.detached:
+            # Its lease passed to another worker, which now reports the run's state, trace and metrics
+            logger.warning(f"Discarding the outcome of run {run_id}: its job lease was lost")
+        else:
+            finish_run(run_id, run)
+
+
+def finish_run(run_id: str, run: LiveRun) -> None:
+    """Persist an executed run's outcome and trace, and release it (or park it, if suspended)."""
+    # A run suspended at callback steps has not finished; its resumed execution reports the outcome
+    suspended = bool(run.get("suspended")) and run.get("status") not in FINISHED_STATUSES
+    if run.get("status") in FINISHED_STATUSES and not run.get("completed_at"):
+        # Executors only stamp successful runs
+        run["completed_at"] = datetime.utcnow().isoformat()
+    run.trace.finish(WAITING_STATUS if suspended else run.get("status"), run.get("error"))
+    trace = run.trace.export()
+    RUN_STORE.put_trace(run_id, trace)
+    export_trace_file(trace)
+    if not suspended:
+        record_run_metrics(run)
+        publish_run_finished(run)
+    RUN_STORE.release(run_id)
+    if not suspended:
+        RUN_COALESCER.settle(run)
+    elif RUNNER_MODE != "queue":
+        # Queue workers park it after completing the job, which a resumed run re-enqueues
+        park_run(run_id)
+
+
+def park_run(run_id: str) -> None:
+    """Make a suspended run claimable by its callbacks and the expiry sweep.
+
+    Only called once the executor no longer touches the run, so a callback cannot race its last writes.
+    """
+    RUN_STORE.transition(run_id, "running", WAITING_STATUS)
+
+
+# Distributed job queue settings (RUNNER_MODE=queue)
+JOB_QUEUE_PATH = Path(os.environ.get("JOB_QUEUE_PATH", str(DATA_DIR / "jobs.db")))
+JOB_QUEUE_MAX_PENDING = int(os.environ.get("JOB_QUEUE_MAX_PENDING", "10000"))
+# A worker that stops renewing its lease for this long is presumed dead and its job is handed out again
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "60"))
+JOB_HEARTBEAT_SECONDS = float(os.environ.get("JOB_HEARTBEAT_SECONDS", "10"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_SECONDS = float(os.environ.get("JOB_POLL_SECONDS", "0.5"))
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", str(RUNNER_WORKERS)))
+# Port on which each worker serves its own /metrics (step, upstream and token metrics are recorded
+# where runs execute); 0 disables it
+WORKER_METRICS_PORT = int(os.environ.get("WORKER_METRICS_PORT", "9015"))
+
+
+class JobQueue:
+    """Durable FIFO of pending runs on SQLite (WAL), shared by API processes and workers.
+
+    A worker claims a job under a lease and renews it with heartbeats while the
+    run executes. A lease that expires (its worker died) makes the job claimable
+    again, up to JOB_MAX_ATTEMPTS claims; finished jobs are deleted, their run
+    lives on in the run store.
+
+    Batch items are enqueued all at once and paced at claim time: single runs are
+    handed out first, then batch items round-robin across batches (by item index).
+    """
+
+    def __init__(self, db_path: Path):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        # Autocommit; claims take the write lock up front with BEGIN IMMEDIATE
+        self._db = sqlite3.connect(str(db_path), check_same_thread=False, timeout=30, isolation_level=None)
+        self._lock = Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT, run_id TEXT UNIQUE NOT NULL, flow_id TEXT NOT NULL,"
+            " workflow TEXT NOT NULL, input TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,"
+            " lease_owner TEXT, lease_expires_at REAL, enqueued_at REAL NOT NULL, batch_id TEXT, batch_index INTEGER);"
+            "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, seq);"
+        )
+        # Queues created before batch items were enqueued directly
+        if "batch_id" not in {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}:
+            self._db.execute("ALTER TABLE jobs ADD COLUMN batch_id TEXT")
+            self._db.execute("ALTER TABLE jobs ADD COLUMN batch_index INTEGER")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, batch_id IS NOT NULL, batch_index, seq)")
+
+    def enqueue(self, run_id: str, flow_id: str, workflow: dict, input_data: dict) -> int:
+        """Persist a job with the workflow spec it was validated against; returns the 1-based queue position.
+
+        Only single runs count towards JOB_QUEUE_MAX_PENDING (batch items wait behind them anyway).
+        """
+        with self._lock:
+            pending = self._db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND batch_id IS NULL"
+            ).fetchone()[0]
+            if pending >= JOB_QUEUE_MAX_PENDING:
+                raise SchedulerFull(max(1, round(JOB_POLL_SECONDS * 2)))
+            self._db.execute(
+                "INSERT INTO jobs (run_id, flow_id, workflow, input, status, enqueued_at) VALUES (?, ?, ?, ?, 'queued', ?)",
+                (run_id, flow_id, json.dumps(workflow, default=str), json.dumps(input_data, default=str), time.time()),
+            )
+        return pending + 1
+
+    def enqueue_batch(self, batch_id: str, flow_id: str, workflow: dict, items: list[tuple[int, str, dict]]) -> None:
+        """Persist the (index, run_id, input) items of a batch as jobs in one transaction."""
+        spec, now = json.dumps(workflow, default=str), time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany(
+                    "INSERT INTO jobs (run_id, flow_id, workflow, input, status, enqueued_at, batch_id, batch_index)"
+                    " VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+                    [(run_id, flow_id, spec, json.dumps(input_data, default=str), now, batch_id, index)
+                     for index, run_id, input_data in items],
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def claim(self, owner: str) -> dict | None:
+        """Lease the oldest claimable job (queued, or leased by a worker that stopped heartbeating)."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                abandoned = [row[0] for row in self._db.execute(
+                    "SELECT run_id FROM jobs WHERE status = 'leased' AND lease_expires_at < ? AND attempts >= ?",
+                    (now, JOB_MAX_ATTEMPTS),
+                )]
+                self._db.executemany("DELETE FROM jobs WHERE run_id = ?", [(run_id,) for run_id in abandoned])
+                row = self._db.execute(
+                    "SELECT run_id, flow_id, workflow, input, attempts, lease_owner FROM jobs"
+                    " WHERE status = 'leased' AND lease_expires_at < ? ORDER BY seq LIMIT 1",
+                    (now,),
+                ).fetchone() or self._db.execute(
+                    "SELECT run_id, flow_id, workflow, input, attempts, lease_owner FROM jobs"
+                    " WHERE status = 'queued' ORDER BY batch_id IS NOT NULL, batch_index, seq LIMIT 1"
+                ).fetchone()
+                if row:
+                    self._db.execute(
+                        "UPDATE jobs SET status = 'leased', lease_owner = ?, lease_expires_at = ?, attempts = attempts + 1"
+                        " WHERE run_id = ?",
+                        (owner, now + JOB_LEASE_SECONDS, row[0]),
+                    )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        for run_id in abandoned:
+            logger.error(f"Run {run_id} abandoned after {JOB_MAX_ATTEMPTS} expired worker leases")
+            RUN_STORE.amend(run_id, {
+                "status": "failed",
+                "current_step": None,
+                "completed_at": datetime.utcnow().isoformat(),
+                "error": f"Worker lease expired {JOB_MAX_ATTEMPTS} times",
+                # Fences off the last worker, should it still be executing the run
+                "worker": None,
+            })
+        if not row:
+            return None
+        run_id, flow_id, workflow, input_data, attempts, previous_owner = row
+        if attempts:
+            logger.warning(f"Reclaimed run {run_id} from worker {previous_owner} (attempt {attempts + 1})")
+        return {
+            "run_id": run_id,
+            "flow_id": flow_id,
+            "workflow": json.loads(workflow),
+            "input": json.loads(input_data),
+            "attempt": attempts + 1,
+        }
+
+    def heartbeat(self, run_ids: list[str], owner: str) -> list[str]:
+        """Extend the leases held by owner; returns the run_ids whose lease was lost."""
+        expires = time.time() + JOB_LEASE_SECONDS
+        lost = []
+        with self._lock:
+            for run_id in run_ids:
+                renewed = self._db.execute(
+                    "UPDATE jobs SET lease_expires_at = ? WHERE run_id = ? AND lease_owner = ? AND status = 'leased'",
+                    (expires, run_id, owner),
+                ).rowcount
+                if not renewed:
+                    lost.append(run_id)
+        return lost
+
+    def complete(self, run_id: str, owner: str) -> None:
+        """Remove a finished job, unless its lease has since passed to another worker."""
+        with self._lock:
+            self._db.execute("DELETE FROM jobs WHERE run_id = ? AND lease_owner = ?", (run_id, owner))
+
+    def position(self, run_id: str) -> int | None:
+        """1-based position of a queued job in claim order, or None if it is not queued."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT COUNT(*) FROM jobs, (SELECT batch_id IS NOT NULL AS batched, COALESCE(batch_index, 0) AS idx, seq AS at"
+                " FROM jobs WHERE run_id = ? AND status = 'queued') AS job"
+                " WHERE status = 'queued' AND (batch_id IS NOT NULL, COALESCE(batch_index, 0), seq) <= (job.batched, job.idx, job.at)",
+                (run_id,),
+            ).fetchone()
+        return row[0] or None
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            queued, oldest = self._db.execute(
+                "SELECT COUNT(*), MIN(enqueued_at) FROM jobs WHERE status = 'queued'"
+            ).fetchone()
+            leased, expired, workers = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(lease_expires_at < ?), 0), COUNT(DISTINCT lease_owner)"
+                " FROM jobs WHERE status = 'leased'",
+                (now,),
+            ).fetchone()
+        return {
+            "queued": queued,
+            "leased": leased,
+            "expired_leases": expired,
+            "busy_workers": workers,
+            "oldest_queued_seconds": round(now - oldest, 1) if oldest else 0,
+            "max_pending": JOB_QUEUE_MAX_PENDING,
+        }
+
+
+JOB_QUEUE = JobQueue(JOB_QUEUE_PATH) if RUNNER_MODE == "queue" else None
+
+
+class JobWorker:
+    """Worker process: claims runs from JOB_QUEUE and executes them, renewing their leases as they go.
+
+    Every heartbeat also persists the progress of held runs, so any API replica
+    reading the shared run store sees their current step.
+    """
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._held: set[str] = set()
+        self._lock = Lock()
+        self._stop = Event()
+
+    def run(self) -> None:
+        """Claim and execute jobs until SIGTERM/SIGINT, then finish the runs in flight."""
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda *_: self._stop.set())
+        threads = [Thread(target=self._loop, name=f"job-worker-{i}", daemon=True) for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        heartbeat = Thread(target=self._heartbeat, name="job-heartbeat", daemon=True)
+        heartbeat.start()
+        CALLBACK_SWEEPER.start()
+        if WORKER_METRICS_PORT:
+            try:
+                server = make_server("0.0.0.0", WORKER_METRICS_PORT, worker_app, threaded=True)
+            except (OSError, SystemExit):
+                # werkzeug exits when the port is taken: workers sharing a host need a port each
+                logger.warning(f"Worker metrics port {WORKER_METRICS_PORT} is in use; this worker serves no /metrics")
+            else:
+                Thread(target=server.serve_forever, name="worker-metrics", daemon=True).start()
+        logger.info(f"Worker {self.owner} started: {self.concurrency} slots, queue {JOB_QUEUE_PATH}")
+        self._stop.wait()
+        logger.info(f"Worker {self.owner} stopping, draining {len(self._held)} runs in flight")
+        for thread in threads:
+            thread.join()
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                job = JOB_QUEUE.claim(self.owner)
+            except sqlite3.Error as e:
+                logger.warning(f"Job claim failed: {e}")
+                job = None
+            if job is None:
+                self._stop.wait(JOB_POLL_SECONDS)
+                continue
+            self._execute(job)
+
+    def _execute(self, job: dict) -> None:
+        run_id = job["run_id"]
+        stored = RUN_STORE.get(run_id)
+        if stored is None:
+            logger.warning(f"Dropping job for deleted run {run_id}")
+            JOB_QUEUE.complete(run_id, self.owner)
+            return
+        # A reclaimed run restarts from scratch
+        run = LiveRun({key: value for key, value in stored.items() if key not in ("error", "progress", "completed_at")})
+        run["worker"] = self.owner
+        run["attempt"] = job["attempt"]
+        RUN_STORE.put(run)
+        with self._lock:
+            self._held.add(run_id)
+        logger.info(f"Worker {self.owner} running {run_id} ({job['flow_id']}, attempt {job['attempt']})")
+        try:
+            run_scheduled(run_id, job["workflow"], job["input"], job["flow_id"])
+        except Exception as e:
+            logger.error(f"Run {run_id} crashed in job worker: {e}")
+        finally:
+            with self._lock:
+                self._held.discard(run_id)
+            JOB_QUEUE.complete(run_id, self.owner)
+            if run.get("suspended") and run.get("status") == "running" and not run.detached:
+                park_run(run_id)
+
+    def _heartbeat(self) -> None:
+        while True:
+            time.sleep(JOB_HEARTBEAT_SECONDS)
+            with self._lock:
+                held = list(self._held)
+            if not held:
+                continue
+            try:
+                lost = JOB_QUEUE.heartbeat(held, self.owner)
+            except sqlite3.Error as e:
+                logger.warning(f"Lease heartbeat failed: {e}")
+                continue
+            for run_id in lost:
+                # Another worker may be rerunning it: stop writing this execution's state
+                logger.warning(f"Worker {self.owner} lost the lease on run {run_id}; abandoning its execution")
+                RUN_STORE.disown(run_id)
+                with self._lock:
+                    self._held.discard(run_id)
+            for run_id in held:
+                if run_id in lost:
+                    continue
+                try:
+                    RUN_STORE.save(run_id)
+                except Exception as e:
+                    # Progress snapshot of a run mutated mid-serialization; the next heartbeat retries
+                    logger.debug(f"Progress snapshot of {run_id} skipped: {e}")
+
+
+# Served by queue workers (see WORKER_METRICS_PORT); API replicas serve the full API on app
+worker_app = Flask(f"{__name__}.worker")
+
+
+@worker_app.route("/metrics", methods=["GET"])
+def worker_metrics():
+    """Prometheus metrics of a worker process."""
+    return worker_app.response_class(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+
+# Run deduplication settings
+# Opt-in (per request with "dedup": true, or for every run with RUN_DEDUP=true): a run identical to
+# one in flight gets its own run_id aliasing that execution instead of starting another
+RUN_DEDUP = os.environ.get("RUN_DEDUP", "false").lower() == "true"
+# How long after completing a run keeps serving identical requests (0 = only while in flight)
+RUN_DEDUP_REUSE_SECONDS = float(os.environ.get("RUN_DEDUP_REUSE_SECONDS", "0"))
+RUN_DEDUP_PRUNE_EVERY = 256
+# A run registered by this process counts as in flight for this long before it shows up in the store
+RUN_DEDUP_PENDING_SECONDS = 10.0
+
+
+def run_fingerprint(tenant_id: str, flow_id: str, input_data: dict, spec_version: str | None) -> str:
+    """Hash identifying identical runs: same tenant, workflow, spec version and input (key order ignored)."""
+    payload = json.dumps([tenant_id, flow_id, spec_version, input_data], sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RunCoalescer:
+    """Single-flight index of deduplicated runs: fingerprint -> the run executing it and its aliases.
+
+    The index is per process; the run store is the source of truth for whether
+    the indexed run is still in flight or recent enough to reuse. A fingerprint
+    missing from the index is looked up in the store, so API replicas sharing a
+    SQLite store (queue mode) coalesce each other's runs. Two replicas receiving
+    the same request at the same moment may still both execute it. Store reads
+    happen outside the index lock, so a run registered here counts as in flight
+    until create_run has stored it (RUN_DEDUP_PENDING_SECONDS). Runs waiting for
+    callbacks are not reused.
+    """
+
+    def __init__(self):
+        self._entries: dict[str, dict] = {}
+        self._lock = Lock()
+        self._registered = 0
+
+    @staticmethod
+    def _reusable(run: dict | None, entry: dict | None = None) -> bool:
+        if run is None:
+            # Registered here, but create_run has not stored it yet
+            return entry is not None and entry.get("pending_until", 0) > time.monotonic()
+        # A waiting run may sit on a human approval until CALLBACK_TIMEOUT_SECONDS; don't queue new requests behind it
+        if run.get("status") in ("failed", WAITING_STATUS):
+            return False
+        if run.get("status") != "completed":
+            return True
+        completed_at = run.get("completed_at")
+        return bool(completed_at) and (
+            datetime.utcnow() - datetime.fromisoformat(completed_at)
+        ).total_seconds() <= RUN_DEDUP_REUSE_SECONDS
+
+    def attach(self, fingerprint: str, run_id: str) -> str | None:
+        """The run_id executing this fingerprint (recording run_id as its alias), or None after
+        registering run_id as the new execution."""
+        while True:
+            with self._lock:
+                entry = self._entries.get(fingerprint)
+                indexed = entry["run_id"] if entry else None
+            primary = RUN_STORE.get(indexed) if indexed else RUN_STORE.find_by_fingerprint(fingerprint)
+            with self._lock:
+                entry = self._entries.get(fingerprint)
+                if (entry["run_id"] if entry else None) != indexed:
+                    # Registered or replaced while the store was read
+                    continue
+                if self._reusable(primary, entry):
+                    if entry is None:
+                        entry = self._entries[fingerprint] = {"run_id": primary["run_id"], "aliases": []}
+                    entry["aliases"].append(run_id)
+                    return entry["run_id"]
+                self._entries[fingerprint] = {
+                    "run_id": run_id, "aliases": [], "pending_until": time.monotonic() + RUN_DEDUP_PENDING_SECONDS,
+                }
+                self._registered += 1
+                prune = self._registered % RUN_DEDUP_PRUNE_EVERY == 0
+            break
+        if prune:
+            self._prune()
+        return None
+
+    def forget(self, fingerprint: str, run_id: str) -> None:
+        """Drop a registration whose run never started (e.g. rejected by a full queue)."""
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry and entry["run_id"] == run_id:
+                del self._entries[fingerprint]
+
+    def settle(self, run: dict) -> None:
+        """Copy a finished run's outcome onto its aliases (their result is read from the run itself)."""
+        fingerprint = run.get("fingerprint")
+        if not fingerprint:
+            return
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if not entry or entry["run_id"] != run["run_id"]:
+                return
+            aliases, entry["aliases"] = entry["aliases"], []
+            if run.get("status") == "failed" or not RUN_DEDUP_REUSE_SECONDS:
+                del self._entries[fingerprint]
+        for alias_id in aliases:
+            settle_alias(alias_id, run)
+
+    def _prune(self) -> None:
+        with self._lock:
+            entries = list(self._entries.items())
+        for fingerprint, entry in entries:
+            primary = RUN_STORE.get(entry["run_id"])
+            if self._reusable(primary, entry):
+                continue
+            with self._lock:
+                if self._entries.get(fingerprint) is not entry:
+                    continue
+                del self._entries[fingerprint]
+                aliases = entry["aliases"]
+            # Runs executed by another replica or worker are never settled here
+            if primary is not None and primary.get("status") in FINISHED_STATUSES:
+                for alias_id in aliases:
+                    settle_alias(alias_id, primary)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"tracked": len(self._entries), "aliases_pending": sum(len(e["aliases"]) for e in self._entries.values())}
+
+
+RUN_COALESCER = RunCoalescer()
+
+
+def settle_alias(alias_id: str, primary: dict) -> None:
+    """Persist the final status of an alias run once the run it is attached to has finished."""
+    RUN_STORE.amend(alias_id, {
+        "status": primary["status"],
+        "current_step": None,
+        "completed_at": primary.get("completed_at"),
+        "error": primary.get("error"),
+    })
+
+
+def resolve_run(run_id: str) -> tuple[dict | None, str]:
+    """A run as clients see it, plus the run_id holding its result and trace.
+
+    An alias takes its status, progress and result from the run it is attached
+    to; once that run has finished, the alias is settled in the store.
+    """
+    run = RUN_STORE.get(run_id)
+    alias_of = run.get("alias_of") if run else None
+    if not alias_of:
+        return run, run_id
+    primary = RUN_STORE.get(alias_of)
+    if primary is None:
+        # The original run has been evicted; whatever the alias last recorded is all there is
+        return run, run_id
+    if run.get("status") not in FINISHED_STATUSES and primary.get("status") in FINISHED_STATUSES:
+        settle_alias(run_id, primary)
+    view = {key: value for key, value in primary.items() if key not in ("run_id", "created_at", "tenant_id", "input")}
+    return {**run, **view, "alias_of": alias_of}, alias_of
+
+
+# Batch submission settings
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "100000"))
+# Share of the run queue batch items may occupy, so single POST /runs are not starved by a large batch
+# (local mode; in queue mode the job queue hands out single runs before batch items)
+BATCH_QUEUE_SHARE = float(os.environ.get("BATCH_QUEUE_SHARE", "0.5"))
+BATCH_FEED_POLL_SECONDS = float(os.environ.get("BATCH_FEED_POLL_SECONDS", "0.05"))
+BATCH_EXPORT_PAGE = 500
+
+
+class BatchFeeder:
+    """Submits batch items to the in-process scheduler as it has room, round-robin across batches (local mode).
+
+    Items are persisted as queued runs up front; only their hand-off to
+    execution is paced here, so a batch of any size costs one request. Items
+    still queued when the process stops are fed again by the next process, on its
+    first request (resume_batches_once).
+    """
+
+    def __init__(self):
+        self._batches: OrderedDict[str, dict] = OrderedDict()
+        self._cond = Condition()
+        self._thread: Thread | None = None
+
+    def add(self, batch_id: str, flow_id: str, workflow: dict, items: list[tuple[str, dict]]) -> None:
+        """Queue (run_id, input) items of a batch for submission."""
+        if not items:
+            return
+        with self._cond:
+            self._batches[batch_id] = {"flow_id": flow_id, "workflow": workflow, "pending": deque(items)}
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="batch-feeder", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def pending(self, batch_id: str) -> int:
+        """Items of a batch not yet handed to the scheduler by this process."""
+        with self._cond:
+            batch = self._batches.get(batch_id)
+            return len(batch["pending"]) if batch else 0
+
+    def _room(self) -> int:
+        stats = SCHEDULER.stats()
+        return max(int(stats["queue_size"] * BATCH_QUEUE_SHARE) - stats["queued"], 0)
+
+    def _next(self) -> tuple[str, dict, str, dict] | None:
+        with self._cond:
+            if not self._batches:
+                return None
+            batch_id, batch = next(iter(self._batches.items()))
+            run_id, input_data = batch["pending"].popleft()
+            if batch["pending"]:
+                self._batches.move_to_end(batch_id)
+            else:
+                del self._batches[batch_id]
+            return batch_id, batch, run_id, input_data
+
+    def _requeue(self, batch_id: str, batch: dict, run_id: str, input_data: dict) -> None:
+        with self._cond:
+            self._batches.setdefault(batch_id, batch)["pending"].appendleft((run_id, input_data))
+            self._batches.move_to_end(batch_id, last=False)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._batches:
+                    self._cond.wait()
+            room = self._room()
+            if not room:
+                time.sleep(BATCH_FEED_POLL_SECONDS)
+                continue
+            for _ in range(room):
+                item = self._next()
+                if item is None:
+                    break
+                batch_id, batch, run_id, input_data = item
+                if not self._submit(batch, run_id, input_data):
+                    # Single POST /runs took the room; retry this item first
+                    self._requeue(batch_id, batch, run_id, input_data)
+                    time.sleep(BATCH_FEED_POLL_SECONDS)
+                    break
+
+    def _submit(self, batch: dict, run_id: str, input_data: dict) -> bool:
+        """Hand one item to execution; False if the queue filled up in the meantime."""
+        try:
+            stored = RUN_STORE.get(run_id)
+            if stored is None:
+                return True
+            RUN_STORE.put(stored if isinstance(stored, LiveRun) else LiveRun(stored))
+            SCHEDULER.submit(run_id, run_scheduled, run_id, batch["workflow"], input_data, batch["flow_id"])
+            return True
+        except SchedulerFull:
+            return False
+        except Exception as e:
+            logger.error(f"Batch item {run_id} could not be submitted: {e}")
+            RUN_STORE.amend(run_id, {"status": "failed", "completed_at": datetime.utcnow().isoformat(), "error": str(e)})
+            return True
+
+
+BATCH_FEEDER = BatchFeeder()
+
+
+def resume_batches() -> None:
+    """Feed batch items left queued by a previous process back to the scheduler (local mode)."""
+    pending: dict[str, list[dict]] = {}
+    for run in RUN_STORE.queued_batch_runs():
+        pending.setdefault(run["batch_id"], []).append(run)
+    for batch_id, runs in pending.items():
+        batch = RUN_STORE.get_batch(batch_id)
+        workflow = (batch or {}).get("workflow")
+        if workflow is None:
+            # Batches stored before their workflow was kept with them cannot be resumed
+            for run in runs:
+                RUN_STORE.amend(run["run_id"], {
+                    "status": "failed",
+                    "completed_at": datetime.utcnow().isoformat(),
+                    "error": "Interrupted by runner restart",
+                })
+            continue
+        runs.sort(key=lambda run: run.get("batch_index", 0))
+        BATCH_FEEDER.add(batch_id, batch["flow_id"], workflow, [(run["run_id"], run.get("input") or {}) for run in runs])
+        logger.info(f"Resuming batch {batch_id}: {len(runs)} items still queued")
+
+
+_batches_resumed = False
+_batches_resumed_lock = Lock()
+
+
+def resume_batches_once() -> None:
+    """resume_batches on the first request served by a local-mode process with a durable store.
+
+    Not done at import, so the Flask reloader parent (or a script importing the module)
+    never executes batch items next to the process serving the API.
+    """
+    global _batches_resumed
+    if _batches_resumed:
+        return
+    with _batches_resumed_lock:
+        if _batches_resumed:
+            return
+        _batches_resumed = True
+    if RUNNER_MODE == "local" and RUN_STORE_BACKEND == "sqlite":
+        resume_batches()
+
+
+def batch_status(batch: dict, failures_limit: int = 100, failures_offset: int = 0) -> dict:
+    """Aggregate progress of a batch: counts by status, throughput, ETA and a page of failed items."""
+    counts = RUN_STORE.batch_counts(batch["batch_id"])
+    by_status = {status: entry["runs"] for status, entry in counts.items()}
+    finished = sum(by_status.get(status, 0) for status in FINISHED_STATUSES)
+    remaining = batch["total"] - finished
+    last_completed = max(filter(None, (entry["last_completed_at"] for entry in counts.values())), default=None)
+
+    # Throughput over the batch's lifetime so far (until its last run finished)
+    end = datetime.fromisoformat(last_completed) if remaining == 0 and last_completed else datetime.utcnow()
+    elapsed = max((end - datetime.fromisoformat(batch["created_at"])).total_seconds(), 1e-3)
+    per_minute = finished / elapsed * 60
+
+    failures = RUN_STORE.list(batch_id=batch["batch_id"], status="failed", limit=failures_limit, offset=failures_offset)
+    return {
+        **{key: value for key, value in batch.items() if key != "workflow"},
+        "status": "completed" if remaining == 0 else "running",
+        "counts": by_status,
+        "finished": finished,
+        "pending_submission": BATCH_FEEDER.pending(batch["batch_id"]),
+        "throughput_per_minute": round(per_minute, 2),
+        "eta_seconds": 0 if remaining == 0 else (round(remaining / per_minute * 60, 1) if per_minute else None),
+        "completed_at": last_completed if remaining == 0 else None,
+        "failures": {
+            "total": by_status.get("failed", 0),
+            "limit": failures_limit,
+            "offset": failures_offset,
+            "items": [
+                {"run_id": run["run_id"], "index": run.get("batch_index"), "error": run.get("error")}
+                for run in failures
+            ],
+        },
+    }
+
+
+# Callback wait settings: seconds between sweeps expiring waiting runs past their deadline
+CALLBACK_SWEEP_SECONDS = float(os.environ.get("CALLBACK_SWEEP_SECONDS", "30"))
+
+
+def resume_run(run: dict, callbacks: dict[str, Any]) -> None:
+    """Hand a run claimed out of waiting (RUN_STORE.transition) back to execution with callback
+    payloads for some of its waiting steps.
+
+    If the queue is full the run is put back to waiting, unchanged, and SchedulerFull is raised.
+    """
+    suspended = run["suspended"]
+    waiting = {
+        name: {**wait, "callback": callbacks[name]} if name in callbacks else wait
+        for name, wait in suspended["waiting"].items()
+    }
+    resumed = {**run, "status": "queued", "current_step": None, "suspended": {**suspended, "waiting": waiting}}
+    run_id, workflow, input_data = run["run_id"], suspended["workflow"], run.get("input") or {}
+    try:
+        if RUNNER_MODE == "queue":
+            RUN_STORE.put(resumed, live=False)
+            JOB_QUEUE.enqueue(run_id, run["flow_id"], workflow, input_data)
+        else:
+            RUN_STORE.put(LiveRun(resumed))
+            SCHEDULER.submit(run_id, run_scheduled, run_id, workflow, input_data, run["flow_id"])
+    except SchedulerFull:
+        RUN_STORE.release(run_id)
+        RUN_STORE.put({**run, "status": WAITING_STATUS}, live=False)
+        raise
+
+
+def expire_waiting_runs() -> int:
+    """Expire callback steps past their deadline: the run fails, unless every expired step was
+    declared with on_timeout: continue, in which case it resumes with {"timed_out": true} payloads."""
+    now = datetime.utcnow().isoformat()
+    expired = 0
+    for run_id in RUN_STORE.waiting_expired(now):
+        # Another process (or a callback) may have got there first
+        if not RUN_STORE.transition(run_id, WAITING_STATUS, "queued"):
+            continue
+        run = RUN_STORE.get(run_id)
+        due = {
+            name: wait for name, wait in run["suspended"]["waiting"].items()
+            if wait["expires_at"] <= now and wait.get("callback") is None
+        }
+        failing = sorted(name for name, wait in due.items() if wait.get("on_timeout") != "continue")
+        if failing:
+            error = f"Timed out waiting for callback on {', '.join(failing)}"
+            logger.warning(f"Run {run_id} expired: {error}")
+            RUN_STORE.amend(run_id, {
+                "status": "failed",
+                "current_step": None,
+                "completed_at": now,
+                "error": error,
+                "suspended": None,
+                "waiting_for": None,
+                "expires_at": None,
+            })
+            finished = RUN_STORE.get(run_id)
+            RUNS_FINISHED.inc(flow_id=finished.get("flow_id"), status="failed")
+            publish_run_finished(finished)
+        else:
+            try:
+                resume_run(run, {name: {"timed_out": True} for name in due})
+            except SchedulerFull:
+                # Still waiting; the next sweep retries
+                continue
+            logger.info(f"Run {run_id} resumed after its callback on {', '.join(sorted(due))} timed out")
+        expired += 1
+    return expired
+
+
+class CallbackSweeper:
+    """Background thread expiring waiting runs; started on first use in each API or worker process."""
+
+    def __init__(self):
+        self._thread: Thread | None = None
+        self._lock = Lock()
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="callback-sweeper", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                expired = expire_waiting_runs()
+                if expired:
+                    logger.info(f"Expired {expired} waiting runs")
+            except Exception as e:
+                logger.error(f"Callback sweep failed: {e}")
+            time.sleep(CALLBACK_SWEEP_SECONDS)
+
+
+CALLBACK_SWEEPER = CallbackSweeper()
+
+
+# API response settings
+# JSON bodies at least this large are gzipped for clients that accept it
+API_GZIP_MIN_BYTES = int(os.environ.get("API_GZIP_MIN_BYTES", "1024"))
+API_GZIP_LEVEL = int(os.environ.get("API_GZIP_LEVEL", "6"))
+RESULT_PAGE_MAX = 1000
+
 # API Routes
 
+@app.before_request
+def start_background_threads():
+    CALLBACK_SWEEPER.start()
+    resume_batches_once()
+
+
 @app.route("/health", methods=["GET"])
 def health():
     """Health check endpoint."""
-    return jsonify({"status": "healthy", "service": "workflow-runner"})
+    return jsonify({
+        "status": "healthy",
+        "service": "workflow-runner",
+        "mode": RUNNER_MODE,
+        "scheduler": JOB_QUEUE.stats() if RUNNER_MODE == "queue" else SCHEDULER.stats(),
+        "waiting_runs": RUN_STORE.count(status=WAITING_STATUS),
+        "events": EVENT_BUS.stats(),
+    })
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus metrics (text exposition format)."""
+    return app.response_class(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/stats/http-pool", methods=["GET"])
+def http_pool_stats():
+    """Shared HTTP connection pool statistics."""
+    return jsonify(HTTP_POOL.stats())
+
+
+@app.route("/stats/cache", methods=["GET"])
+def cache_stats():
+    """Response cache hit/miss counters."""
+    if RESPONSE_CACHE is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, "ttls": CACHE_TTLS, **RESPONSE_CACHE.stats()})
+
+
+@app.route("/stats/result-sink", methods=["GET"])
+def result_sink_stats():
+    """Result sink partitions and write counters."""
+    if RESULT_SINK is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **RESULT_SINK.stats()})
+
+
+@app.route("/stats/expressions", methods=["GET"])
+def expression_stats():
+    """Per-expression evaluation timings of compiled workflow specs."""
+    flow_id = request.args.get("flow_id")
+    with _COMPILED_SPECS_LOCK:
+        specs = [spec for spec in _COMPILED_SPECS.values() if flow_id is None or spec.flow_id == flow_id]
+    return jsonify({"specs": [spec.stats() for spec in specs]})
 
 
 @app.route("/runs", methods=["POST"])
@@ -873,43 +5922,297 @@ def create_run():
     if not flow_id:
         return jsonify({"error": "flow_id is required"}), 400
 
-    # Load workflow
-    workflow = load_workflow(flow_id)
-    if not workflow:
+    entry = WORKFLOWS.get(flow_id)
+    if not entry:
+        invalid = WORKFLOWS.invalid(flow_id)
+        if invalid:
+            return jsonify({"error": f"Workflow '{flow_id}' is invalid", "details": invalid["errors"]}), 422
         return jsonify({"error": f"Workflow '{flow_id}' not found"}), 404
+    workflow = entry["spec"]
+
+    input_data = data.get("input", {})
+    if not isinstance(input_data, dict):
+        return jsonify({"error": "input must be an object"}), 400
+    # The spec's input defaults apply to every executor, so the run is stored and executed with them
+    input_data = {**workflow.get("input", {}), **input_data}
+    if "input_schema" in workflow:
+        errors = validate_input(input_data, workflow["input_schema"])
+        if errors:
+            return jsonify({"error": "Invalid input", "details": errors}), 400
 
     # Create run
     run_id = str(uuid.uuid4())[:8]
-    run = {
+    run = LiveRun({
         "run_id": run_id,
         "flow_id": flow_id,
         "tenant_id": tenant_id,
-        "status": "starting",
+        "status": "queued",
         "current_step": None,
         "created_at": datetime.utcnow().isoformat(),
-        "input": data.get("input", {})
-    }
-    RUNS[run_id] = run
-
-    # Execute in background
-    input_data = data.get("input", {})
-    thread = Thread(target=execute_workflow, args=(run_id, workflow, input_data, flow_id))
-    thread.start()
+        "spec_version": entry["version"],
+        "input": input_data
+    })
+
+    fingerprint = None
+    if data.get("dedup", RUN_DEDUP):
+        # Defaults are part of the input, so omitting one matches passing it explicitly
+        fingerprint = run_fingerprint(tenant_id, flow_id, input_data, entry["version"])
+        primary_id = RUN_COALESCER.attach(fingerprint, run_id)
+        if primary_id:
+            RUN_STORE.put({**run, "alias_of": primary_id, "fingerprint": fingerprint}, live=False)
+            RUNS_COALESCED.inc(flow_id=flow_id)
+            alias, _ = resolve_run(run_id)
+            logger.info(f"Run {run_id} for workflow {flow_id} attached to identical run {primary_id}")
+            return jsonify({
+                "run_id": run_id,
+                "flow_id": flow_id,
+                "status": alias["status"],
+                "spec_version": entry["version"],
+                "alias_of": primary_id,
+                "message": f"Identical to run {primary_id}, sharing its execution. Check status at GET /runs/{run_id}"
+            }), 201
+        run["fingerprint"] = fingerprint
+    # In queue mode a worker process executes the run, so this process only persists it
+    RUN_STORE.put(run, live=RUNNER_MODE == "local")
+
+    # Queue for the worker pool; reject with 429 when the queue is full
+    try:
+        if RUNNER_MODE == "queue":
+            position = JOB_QUEUE.enqueue(run_id, flow_id, workflow, input_data)
+        else:
+            position = SCHEDULER.submit(run_id, run_scheduled, run_id, workflow, input_data, flow_id)
+    except SchedulerFull as e:
+        RUN_STORE.delete(run_id)
+        if fingerprint:
+            RUN_COALESCER.forget(fingerprint, run_id)
+        logger.warning(f"Rejected run for workflow {flow_id}: {e}")
+        return jsonify({"error": str(e), "retry_after": e.retry_after}), 429, {"Retry-After": str(e.retry_after)}
 
-    logger.info(f"Started run {run_id} for workflow {flow_id}")
+    logger.info(f"Queued run {run_id} for workflow {flow_id} at position {position}")
 
     return jsonify({
         "run_id": run_id,
         "flow_id": flow_id,
-        "status": "starting",
-        "message": f"Workflow started. Check status at GET /runs/{run_id}"
+        "status": "queued",
+        "spec_version": entry["version"],
+        "queue_position": position,
+        "message": f"Workflow queued. Check status at GET /runs/{run_id}"
     }), 201
 
 
+@app.route("/runs:batch", methods=["POST"])
+def create_batch():
+    """Start one run per item of a batch.
+
+    JSON body: {"flow_id", "tenant_id", "input": shared input, "items": [input, ...]}.
+    NDJSON body (application/x-ndjson): one input per line, flow_id and tenant_id as query parameters.
+    """
+    if request.mimetype in ("application/x-ndjson", "application/jsonl"):
+        params, shared, items = request.args, {}, []
+        for line_no, line in enumerate(request.stream, 1):
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                return jsonify({"error": f"Invalid JSON on line {line_no}: {e}"}), 400
+            if len(items) > BATCH_MAX_ITEMS:
+                break
+    else:
+        params = request.json or {}
+        shared, items = params.get("input", {}), params.get("items")
+        if not isinstance(items, list):
+            return jsonify({"error": "items must be an array of inputs"}), 400
+        if not isinstance(shared, dict):
+            return jsonify({"error": "input must be an object"}), 400
+
+    if not items:
+        return jsonify({"error": "A batch needs at least one item"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"A batch holds at most {BATCH_MAX_ITEMS} items"}), 413
+
+    tenant_id = params.get("tenant_id", "default")
+    flow_id = params.get("flow_id")
+    if not flow_id:
+        return jsonify({"error": "flow_id is required"}), 400
+    entry = WORKFLOWS.get(flow_id)
+    if not entry:
+        invalid = WORKFLOWS.invalid(flow_id)
+        if invalid:
+            return jsonify({"error": f"Workflow '{flow_id}' is invalid", "details": invalid["errors"]}), 422
+        return jsonify({"error": f"Workflow '{flow_id}' not found"}), 404
+    workflow = entry["spec"]
+
+    batch_id = str(uuid.uuid4())[:8]
+    created_at = datetime.utcnow().isoformat()
+    RUN_STORE.put_batch({
+        "batch_id": batch_id,
+        "flow_id": flow_id,
+        "tenant_id": tenant_id,
+        "spec_version": entry["version"],
+        "created_at": created_at,
+        "total": len(items),
+        # Kept so items still queued can be fed again after a restart
+        "workflow": workflow,
+    })
+
+    # Items failing validation are recorded as failed runs, so they show up among the batch's failures
+    runs, accepted = [], []
+    for index, item in enumerate(items):
+        run = {
+            "run_id": f"{batch_id}-{index}",
+            "flow_id": flow_id,
+            "tenant_id": tenant_id,
+            "batch_id": batch_id,
+            "batch_index": index,
+            "status": "queued",
+            "current_step": None,
+            "created_at": created_at,
+            "spec_version": entry["version"],
+        }
+        if not isinstance(item, dict):
+            errors = ["item must be an object"]
+        else:
+            input_data = {**workflow.get("input", {}), **shared, **item}
+            run["input"] = input_data
+            errors = []
+            if "input_schema" in workflow:
+                errors = validate_input(input_data, workflow["input_schema"])
+        if errors:
+            run.update(status="failed", completed_at=created_at, error=f"Invalid input: {'; '.join(errors)}")
+        else:
+            accepted.append((index, run["run_id"], input_data))
+        runs.append(run)
+    RUN_STORE.put_many(runs)
+    if RUNNER_MODE == "queue":
+        # Durable straight away; the job queue paces them at claim time
+        JOB_QUEUE.enqueue_batch(batch_id, flow_id, workflow, accepted)
+    else:
+        BATCH_FEEDER.add(batch_id, flow_id, workflow, [(run_id, input_data) for _, run_id, input_data in accepted])
+
+    logger.info(f"Queued batch {batch_id} for workflow {flow_id}: {len(accepted)} runs, {len(runs) - len(accepted)} rejected")
+
+    return jsonify({
+        "batch_id": batch_id,
+        "flow_id": flow_id,
+        "status": "queued",
+        "spec_version": entry["version"],
+        "total": len(runs),
+        "accepted": len(accepted),
+        "rejected": len(runs) - len(accepted),
+        "message": f"Batch queued. Check status at GET /batches/{batch_id}"
+    }), 201
+
+
+@app.route("/batches/<batch_id>", methods=["GET"])
+def get_batch(batch_id: str):
+    """Aggregate status of a batch; failed items are paginated with failures_limit and failures_offset."""
+    batch = RUN_STORE.get_batch(batch_id)
+    if not batch:
+        return jsonify({"error": "Batch not found"}), 404
+    limit = min(max(request.args.get("failures_limit", 100, type=int), 0), 1000)
+    offset = max(request.args.get("failures_offset", 0, type=int), 0)
+    return jsonify(batch_status(batch, limit, offset))
+
+
+@app.route("/batches/<batch_id>/export", methods=["GET"])
+def export_batch(batch_id: str):
+    """All items of a batch as NDJSON (run_id, index, status, error, result), optionally filtered by status."""
+    batch = RUN_STORE.get_batch(batch_id)
+    if not batch:
+        return jsonify({"error": "Batch not found"}), 404
+    status = request.args.get("status")
+
+    def lines():
+        offset = 0
+        while True:
+            runs = RUN_STORE.list(batch_id=batch_id, status=status, limit=BATCH_EXPORT_PAGE, offset=offset)
+            for run in runs:
+                yield json.dumps({
+                    "run_id": run["run_id"],
+                    "index": run.get("batch_index"),
+                    "status": run.get("status"),
+                    "error": run.get("error"),
+                    "result": RUN_STORE.get_result(run["run_id"]) if run.get("status") == "completed" else None,
+                }, default=str) + "\n"
+            if len(runs) < BATCH_EXPORT_PAGE:
+                return
+            offset += BATCH_EXPORT_PAGE
+
+    return app.response_class(lines(), mimetype="application/x-ndjson", headers={
+        "Content-Disposition": f"attachment; filename=batch-{batch_id}.ndjson",
+    })
+
+
+RUN_FIELDS = (
+    "run_id", "flow_id", "status", "current_step", "created_at", "spec_version", "alias_of",
+    "queue_position", "estimated_start_at", "progress", "waiting", "result", "completed_at", "error",
+)
+
+
+def run_etag(run: dict, *variant) -> str:
+    """Strong ETag of a run's state, hashed from its metadata so the result payload is never loaded.
+
+    A result only changes with completed_at, or updated_at when a finished run is amended.
+    """
+    state = {key: value for key, value in dict(run).items() if key != "result"}
+    payload = json.dumps([state, variant], sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:24]
+
+
+def _not_modified(etag: str):
+    """304 response if the client already holds this state (in either encoding), else None."""
+    for candidate in (etag, f"{etag}-gzip"):
+        if request.if_none_match.contains(candidate):
+            response = app.response_class(status=304)
+            response.set_etag(candidate)
+            response.vary.add("Accept-Encoding")
+            return response
+    return None
+
+
+def _json_response(payload: Any, etag: str | None = None):
+    """JSON response, gzipped when large and accepted; the gzip variant gets its own ETag."""
+    response = jsonify(payload)
+    if response.content_length >= API_GZIP_MIN_BYTES and request.accept_encodings["gzip"]:
+        response.set_data(gzip.compress(response.get_data(), API_GZIP_LEVEL))
+        response.headers["Content-Encoding"] = "gzip"
+        etag = etag and f"{etag}-gzip"
+    response.vary.add("Accept-Encoding")
+    if etag:
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+    return response
+
+
+def paginate_lists(value: Any, offset: int, limit: int, path: str, totals: dict) -> Any:
+    """Slice every list inside value to [offset, offset + limit), recording full lengths by dotted path."""
+    if isinstance(value, list):
+        totals[path or "."] = len(value)
+        return value[offset:offset + limit]
+    if isinstance(value, dict):
+        return {
+            key: paginate_lists(item, offset, limit, f"{path}.{key}" if path else key, totals)
+            for key, item in value.items()
+        }
+    return value
+
+
 @app.route("/runs/<run_id>", methods=["GET"])
 def get_run(run_id: str):
-    """Get run status and details."""
-    run = RUNS.get(run_id)
+    """Get run status and details; ?fields= returns only the listed fields (e.g. status,current_step).
+
+    Responses carry an ETag: polls with If-None-Match get a 304 while the run is unchanged.
+    """
+    fields = None
+    if request.args.get("fields"):
+        fields = tuple(dict.fromkeys(field.strip() for field in request.args["fields"].split(",") if field.strip()))
+        unknown = sorted(set(fields) - set(RUN_FIELDS))
+        if unknown:
+            return jsonify({"error": f"Unknown fields: {', '.join(unknown)}", "fields": RUN_FIELDS}), 400
+    wanted = set(fields or RUN_FIELDS)
+
+    run, source_id = resolve_run(run_id)
     if not run:
         return jsonify({"error": "Run not found"}), 404
 
@@ -919,51 +6222,334 @@ def get_run(run_id: str):
         "status": run["status"],
         "current_step": run.get("current_step"),
         "created_at": run["created_at"],
+        "spec_version": run.get("spec_version"),
     }
+    if source_id != run_id:
+        response["alias_of"] = source_id
+
+    if run["status"] == "queued" and wanted & {"queue_position", "estimated_start_at"}:
+        position = (JOB_QUEUE if RUNNER_MODE == "queue" else SCHEDULER).position(source_id)
+        if position is not None:
+            response["queue_position"] = position
+            if RUNNER_MODE == "local":
+                wait = SCHEDULER.estimated_wait(position)
+                response["estimated_start_at"] = datetime.utcfromtimestamp(time.time() + wait).isoformat()
+
+    if run.get("progress"):
+        response["progress"] = run["progress"]
+
+    if run["status"] == WAITING_STATUS:
+        response["waiting"] = {"steps": run.get("waiting_for"), "expires_at": run.get("expires_at")}
 
     if run["status"] == "completed":
-        response["result"] = run.get("result")
         response["completed_at"] = run.get("completed_at")
 
     if run["status"] == "failed":
         response["error"] = run.get("error")
 
-    return jsonify(response)
+    if fields:
+        response = {field: response[field] for field in fields if field in response}
 
+    with_result = run["status"] == "completed" and "result" in wanted
+    if with_result:
+        # Hashed from the run's metadata, so an unchanged result is never loaded
+        etag = run_etag(run, fields)
+    else:
+        # The start estimate moves with the clock alone
+        state = {key: value for key, value in response.items() if key != "estimated_start_at"}
+        etag = hashlib.sha1(json.dumps(state, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:24]
+    not_modified = _not_modified(etag)
+    if not_modified is not None:
+        return not_modified
+
+    if with_result:
+        response["result"] = RUN_STORE.get_result(source_id)
+        if fields:
+            response = {field: response[field] for field in fields if field in response}
+        if response["result"] is None:
+            # Completed but the result is still being stored: do not let clients cache this state
+            etag = None
+    return _json_response(response, etag)
+
+
+@app.route("/runs/<run_id>/result", methods=["GET"])
+def get_run_result(run_id: str):
+    """Result of a completed run. ?path= selects part of it (e.g. urls.gemini); with ?limit= and
+    ?offset=, every list in the selection is paginated and its full length reported."""
+    run, source_id = resolve_run(run_id)
+    if not run:
+        return jsonify({"error": "Run not found"}), 404
+    if run["status"] != "completed":
+        return jsonify({"error": f"Run is {run['status']}", "status": run["status"]}), 409
+
+    path = request.args.get("path")
+    limit = request.args.get("limit", type=int)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    if limit is not None:
+        limit = min(max(limit, 1), RESULT_PAGE_MAX)
+    etag = run_etag(run, "result", path, limit, offset)
+    not_modified = _not_modified(etag)
+    if not_modified is not None:
+        return not_modified
+
+    result = RUN_STORE.get_result(source_id)
+    if result is None:
+        return jsonify({"error": "Run has no result"}), 404
+    node = result
+    for key in path.split(".") if path else ():
+        if isinstance(node, dict) and key in node:
+            node = node[key]
+        elif isinstance(node, list) and key.isdigit() and int(key) < len(node):
+            node = node[int(key)]
+        else:
+            return jsonify({"error": f"No '{path}' in the result"}), 404
+
+    payload = {"run_id": run_id, "path": path, "result": node}
+    if limit is not None:
+        totals = {}
+        payload["result"] = paginate_lists(node, offset, limit, "", totals)
+        payload["pagination"] = {
+            "offset": offset,
+            "limit": limit,
+            "totals": totals,
+            "next_offset": offset + limit if any(total > offset + limit for total in totals.values()) else None,
+        }
+    return _json_response(payload, etag)
 
-@app.route("/workflows", methods=["GET"])
-def list_workflows():
-    """List available workflows."""
-    workflow_dir = Path(WORKFLOW_DIR)
-    workflows = []
 
-    for f in workflow_dir.glob("*.json"):
-        try:
-            with open(f) as fh:
-                spec = json.load(fh)
-                workflows.append({
-                    "flow_id": f.stem,
-                    "name": spec.get("name", f.stem),
-                    "description": spec.get("metadata", {}).get("description", "")
-                })
-        except Exception:
-            pass
+@app.route("/runs/<run_id>/callback", methods=["POST"])
+def run_callback(run_id: str):
+    """Resume a run waiting at a callback step; the JSON body becomes that step's payload.
 
-    return jsonify({"workflows": workflows})
+    The token (query parameter or X-Callback-Token header) and step come from the callback_url
+    delivered by the step; step may be omitted while only one step is waiting.
+    """
+    run = RUN_STORE.get(run_id)
+    if not run:
+        return jsonify({"error": "Run not found"}), 404
+    if run.get("status") != WAITING_STATUS:
+        return jsonify({"error": f"Run is {run.get('status')}, not waiting for a callback"}), 409
+    suspended = run["suspended"]
+    token = request.args.get("token") or request.headers.get("X-Callback-Token") or ""
+    if not hmac.compare_digest(token, suspended["token"]):
+        return jsonify({"error": "Invalid callback token"}), 403
+    step = request.args.get("step")
+    if step is None and len(suspended["waiting"]) == 1:
+        step = next(iter(suspended["waiting"]))
+    if step not in suspended["waiting"]:
+        return jsonify({"error": "step must name a waiting step", "waiting_for": sorted(suspended["waiting"])}), 400
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({"error": "Callback body must be a JSON object"}), 400
+
+    # Only one callback (or the expiry sweep) can claim a waiting run
+    if not RUN_STORE.transition(run_id, WAITING_STATUS, "queued"):
+        return jsonify({"error": "Run is no longer waiting"}), 409
+    try:
+        resume_run(RUN_STORE.get(run_id), {step: payload})
+    except SchedulerFull as e:
+        return jsonify({"error": str(e), "retry_after": e.retry_after}), 429, {"Retry-After": str(e.retry_after)}
 
+    logger.info(f"Run {run_id} resumed by callback on step {step}")
+    return jsonify({"run_id": run_id, "status": "queued", "step": step}), 202
 
-@app.route("/output/<filename>", methods=["GET"])
+
+@app.route("/runs/<run_id>/trace", methods=["GET"])
+def get_run_trace(run_id: str):
+    """Span tree of a run (in progress or finished); ?format=otlp returns OTLP/JSON."""
+    run, source_id = resolve_run(run_id)
+    if not run:
+        return jsonify({"error": "Run not found"}), 404
+    trace = RUN_STORE.get_trace(source_id)
+    if trace is None:
+        return jsonify({"error": "No trace recorded for this run"}), 404
+    if request.args.get("format") == "otlp":
+        return jsonify(trace_to_otlp(trace))
+    return jsonify(trace_tree(trace))
+
+
+def _stored_terminal_event(run_id: str) -> str | None:
+    """Synthesized terminal SSE event of a run the store reports as finished."""
+    run = RUN_STORE.get(run_id)
+    if not run or run.get("status") not in FINISHED_STATUSES:
+        return None
+    data = {"result": RUN_STORE.get_result(run_id)} if run["status"] == "completed" else {"error": run.get("error")}
+    return format_sse({"id": 0, "type": run["status"], "run_id": run_id, "at": run.get("completed_at"), "data": data})
+
+
+def _event_stream(subscription: EventSubscription, replay: list[dict] = (), run_id: str | None = None,
+                  last_event_id: int = 0):
+    """SSE body: replayed events, then live ones, with keepalive comments; a run stream ends at its terminal event."""
+    try:
+        yield "retry: 2000\n\n"
+        sent = last_event_id
+        for event in replay:
+            if event["id"] > sent:
+                yield format_sse(event)
+                sent = event["id"]
+                if run_id and event["type"] in TERMINAL_EVENTS:
+                    return
+        if run_id:
+            # Finished before its history could be replayed (expired or from an earlier process)
+            terminal = _stored_terminal_event(run_id)
+            if terminal and not any(e["type"] in TERMINAL_EVENTS for e in replay):
+                yield terminal
+                return
+        while True:
+            try:
+                event = subscription.queue.get(timeout=RUN_EVENT_HEARTBEAT_SECONDS)
+            except queue.Empty:
+                # Runs executed by worker processes publish no events here; end on their stored status
+                terminal = _stored_terminal_event(run_id) if run_id and RUNNER_MODE == "queue" else None
+                if terminal:
+                    yield terminal
+                    return
+                yield ": keepalive\n\n"
+                continue
+            if event["id"] <= sent:
+                continue
+            yield format_sse(event)
+            sent = event["id"]
+            if run_id and event["type"] in TERMINAL_EVENTS:
+                return
+    finally:
+        EVENT_BUS.unsubscribe(subscription)
+
+
+def _sse_response(body):
+    return app.response_class(body, mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
+@app.route("/runs/<run_id>/events", methods=["GET"])
+def run_events(run_id: str):
+    """Server-sent events for one run: status, step transitions and timings, partial and final results."""
+    run, source_id = resolve_run(run_id)
+    if not run:
+        return jsonify({"error": "Run not found"}), 404
+    # An alias streams the execution it is attached to
+    run_id = source_id
+    # Replay everything after the client's last event; an unparseable ID replays from the start
+    try:
+        last_event_id = int(request.headers.get("Last-Event-ID") or request.args.get("last_event_id") or 0)
+    except ValueError:
+        last_event_id = 0
+    # Subscribe before reading the history so no event falls between the two
+    subscription = EVENT_BUS.subscribe(lambda event: event["run_id"] == run_id)
+    return _sse_response(_event_stream(subscription, EVENT_BUS.history(run_id), run_id, last_event_id))
+
+
+@app.route("/events", methods=["GET"])
+def events():
+    """Server-sent events for every run matching tenant_id, flow_id and/or batch_id."""
+    filters = {key: request.args[key] for key in ("tenant_id", "flow_id", "batch_id") if request.args.get(key)}
+    types = set(request.args["types"].split(",")) if request.args.get("types") else None
+    subscription = EVENT_BUS.subscribe(
+        lambda event: all(event.get(key) == value for key, value in filters.items())
+        and (types is None or event["type"] in types)
+    )
+    return _sse_response(_event_stream(subscription))
+
+
+@app.route("/runs", methods=["GET"])
+def list_runs():
+    """List runs (newest first), filtered by tenant_id, flow_id and status."""
+    # Non-numeric values fall back to the defaults; negative ones would mean "no limit" to SQLite
+    limit = min(max(request.args.get("limit", 100, type=int), 0), 1000)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    filters = {key: request.args.get(key) for key in ("tenant_id", "flow_id", "status")}
+    runs = RUN_STORE.list(**filters, limit=limit, offset=offset)
+    fields = ("run_id", "flow_id", "tenant_id", "status", "current_step", "created_at", "completed_at", "spec_version")
+    waiting_fields = ("waiting_for", "expires_at")
+    runs = [(resolve_run(run["run_id"])[0] or run) if run.get("alias_of") else run for run in runs]
+    return jsonify({
+        "runs": [
+            {field: run.get(field) for field in fields + (waiting_fields if run.get("status") == WAITING_STATUS else ())}
+            for run in runs
+        ],
+        "total": RUN_STORE.count(**filters),
+        "limit": limit,
+        "offset": offset,
+    })
+
+
+@app.route("/workflows", methods=["GET"])
+def list_workflows():
+    """List available workflows, plus any specs that failed validation."""
+    fields = ("flow_id", "name", "description", "version", "modified_at")
+    return jsonify({
+        "workflows": [{field: entry[field] for field in fields} for entry in WORKFLOWS.list()],
+        "invalid": WORKFLOWS.invalid(),
+    })
+
+
+# Output download settings
+OUTPUT_CHUNK_SIZE = int(os.environ.get("OUTPUT_CHUNK_SIZE", str(64 * 1024)))
+# Compress text outputs on the fly for clients that accept gzip
+OUTPUT_GZIP_MIN_BYTES = int(os.environ.get("OUTPUT_GZIP_MIN_BYTES", "1024"))
+OUTPUT_GZIP_LEVEL = int(os.environ.get("OUTPUT_GZIP_LEVEL", "6"))
+
+OUTPUT_MIMETYPES = {
+    ".csv": "text/csv",
+    ".json": "application/json",
+    ".jsonl": "application/x-ndjson",
+    ".txt": "text/plain",
+    ".parquet": "application/vnd.apache.parquet",
+    ".gz": "application/gzip",
+}
+COMPRESSIBLE_OUTPUTS = (".csv", ".json", ".jsonl", ".txt")
+
+
+def _gzip_chunks(path: Path):
+    """Stream a file gzip-compressed, one chunk at a time."""
+    compressor = zlib.compressobj(OUTPUT_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    with open(path, "rb") as f:
+        while chunk := f.read(OUTPUT_CHUNK_SIZE):
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+    yield compressor.flush()
+
+
+@app.route("/output/<path:filename>", methods=["GET"])
 def get_output(filename: str):
-    """Download output file."""
-    filepath = OUTPUT_DIR / filename
-    if not filepath.exists():
+    """Download output file (streamed, with Range, conditional GET and gzip support)."""
+    # safe_join rejects absolute paths and anything escaping OUTPUT_DIR
+    joined = safe_join(str(OUTPUT_DIR), filename)
+    filepath = Path(joined) if joined else None
+    if filepath is None or not filepath.is_file():
         return jsonify({"error": "File not found"}), 404
 
-    with open(filepath, "r") as f:
-        content = f.read()
-
-    return content, 200, {"Content-Type": "text/csv"}
+    suffix = filepath.suffix.lower()
+    mimetype = OUTPUT_MIMETYPES.get(suffix, "application/octet-stream")
+    stat = filepath.stat()
+    compressible = suffix in COMPRESSIBLE_OUTPUTS and stat.st_size >= OUTPUT_GZIP_MIN_BYTES
+
+    # Range requests address bytes of the file itself, so they are always served uncompressed
+    if compressible and request.accept_encodings["gzip"] and "Range" not in request.headers:
+        response = app.response_class(_gzip_chunks(filepath), mimetype=mimetype)
+        response.headers["Content-Encoding"] = "gzip"
+        response.set_etag(f"{stat.st_mtime_ns:x}-{stat.st_size:x}-gzip")
+        response.last_modified = datetime.utcfromtimestamp(stat.st_mtime)
+        response.cache_control.no_cache = True
+    else:
+        # send_file streams via the server's file wrapper and handles Range, ETag and Last-Modified
+        response = send_file(filepath, mimetype=mimetype, conditional=True, etag=True, max_age=0)
+    if compressible:
+        response.vary.add("Accept-Encoding")
+    return response.make_conditional(request)
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8015, debug=True)
+    parser = argparse.ArgumentParser(description="Workflow runner API server, or a job queue worker")
+    parser.add_argument("command", nargs="?", choices=("serve", "worker"), default="serve")
+    parser.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY, help="runs a worker executes at once")
+    args = parser.parse_args()
+    if args.command == "worker":
+        if RUNNER_MODE != "queue":
+            raise SystemExit("workflow_runner worker requires RUNNER_MODE=queue")
+        JobWorker(args.concurrency).run()
+    else:
+        app.run(host="0.0.0.0", port=8015, debug=True)